@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Reputation history of users kept in the default cache. History is read from user snapshots,
+so accounts.tasks.create_accounts_snapshot invalidates it after every run and all users'
+histories are computed again on their next read. Reset accounts get new keys, as the key
+contains reset date.
+"""
+from django.utils import translation
+
+from bladepolska.versioned_cache import VersionedCache
+
+
+# snapshots are taken hourly, timeout only limits staleness if the snapshot task stops
+history_cache = VersionedCache('reputation_history', 2 * 60 * 60)
+
+
+def invalidate():
+    """
+    Make reputation history of all users stale
+    """
+    history_cache.invalidate()
+
+
+def get_reputation_history(user, compute):
+    """
+    Reputation history of user from the cache, computed and cached when missing
+    :param user: user
+    :type user: UserProfile
+    :param compute: function computing history of the user
+    :type compute: function
+    :return: chart points: dates and reputation
+    :rtype: {int, [], []}
+    """
+    return history_cache.get(
+        user.id, (translation.get_language(), user.reset_date.isoformat()), compute
+    )
@@ -2,7 +2,9 @@
 from datetime import timedelta
 
 from django.contrib.auth.models import BaseUserManager
-from django.db.models import Count
+from django.db import connection
+from django.db.models import Count, F
+from django.db.models.expressions import RawSQL
 from django.http import HttpResponseForbidden
 from django.utils.timezone import now
 
@@ -101,6 +103,57 @@ class UserProfileManager(BaseUserManager):
 
         return user
 
+    ADD_CASH_BATCH_SIZE = 1000
+
+    def add_cash(self, amounts):
+        """
+        Add (or take for negative amount) cash of many users, in batches of ADD_CASH_BATCH_SIZE
+        users per UPDATE. Reputation is not recalculated.
+        :param amounts: amount by user id
+        :type amounts: {int: int}
+        """
+        amounts = sorted(amounts.items())
+        if connection.vendor == 'postgresql':
+            qn = connection.ops.quote_name
+            for i in range(0, len(amounts), self.ADD_CASH_BATCH_SIZE):
+                batch = amounts[i:i + self.ADD_CASH_BATCH_SIZE]
+                sql = """
+                    UPDATE {user_table} AS u
+                    SET total_cash = u.total_cash + amounts.amount
+                    FROM (VALUES {values}) AS amounts (id, amount)
+                    WHERE u.id = amounts.id
+                """.format(
+                    user_table=qn(self.model._meta.db_table),
+                    values=', '.join(['(%s, %s)'] * len(batch)),
+                )
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [value for row in batch for value in row])
+        else:
+            # one UPDATE per amount
+            users = {}
+            for user_id, amount in amounts:
+                users.setdefault(amount, []).append(user_id)
+            for amount, user_ids in users.items():
+                for i in range(0, len(user_ids), self.ADD_CASH_BATCH_SIZE):
+                    self.filter(id__in=user_ids[i:i + self.ADD_CASH_BATCH_SIZE]).\
+                        update(total_cash=F('total_cash') + amount)
+
+    def recalculate_reputation(self, queryset=None):
+        """
+        Set reputation of users with one UPDATE, the same as UserProfile.calculate_reputation
+        :param queryset: users, all users by default
+        :type queryset: QuerySet
+        :return: updated users count
+        :rtype: int
+        """
+        if queryset is None:
+            queryset = self.get_queryset()
+        if config.STARTING_CASH == 0:
+            return queryset.update(reputation=None)
+        return queryset.update(reputation=RawSQL(
+            '(portfolio_value + total_cash) * 100.0 / %s', (config.STARTING_CASH,)
+        ))
+
     def get_users(self):
         return self.get_queryset().filter(is_active=True, is_deleted=False)
 
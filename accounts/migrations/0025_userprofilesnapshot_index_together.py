@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0024_auto_20170531_0031'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='userprofilesnapshot',
+            index_together=set([('snapshot_of', 'created_at')]),
+        ),
+    ]
@@ -17,6 +17,7 @@ from bladepolska.snapshots import SnapshotAddon
 from constance import config
 from politikon.templatetags.format import formatted
 
+from . import history
 from .managers import UserProfileManager
 
 from events.models import Bet, Event, Transaction
@@ -86,7 +87,7 @@ class UserProfile(AbstractBaseUser):
         'total_cash',
         'total_given_cash',
         'portfolio_value'
-    ])
+    ], only_on_change=True, hourly_retention_days=35, partition_by_month=True)
 
     username = models.CharField(u"username", max_length=100, unique=True)
     email = models.CharField(u"email", max_length=255, null=True, blank=True)
@@ -436,28 +437,47 @@ class UserProfile(AbstractBaseUser):
 
     def get_reputation_history(self):
         """
-        Get historical data for user reputation (7 days)
+        Get historical data for user reputation (7 days), cached until the next snapshot of
+        accounts
         :return: chart points: dates and reputation
         :rtype: {int, [], []}
         """
+        return history.get_reputation_history(self, self._compute_reputation_history)
+
+    def _compute_reputation_history(self):
         start_date = self.reset_date if self.reset_date > now() - timedelta(days=7) else now() - timedelta(days=7)
-        snapshots = self.snapshots.filter(
-            snapshot_of_id=self.id,
-            created_at__gte=start_date,
-        ).order_by('created_at')
+
+        # first hourly snapshot of every day; unchanged snapshots aren't stored, so the latest
+        # one taken before the end of the first hour is carried forward
+        days = []
+        day = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day <= now():
+            days.append(max(day, start_date))
+            day += timedelta(days=1)
+        snapshots = self.snapshots.get_snapshots_at(
+            [moment + timedelta(hours=1) for moment in days], since=self.reset_date
+        )
+        first_snapshot = None
+        if None in snapshots:
+            first_snapshot = self.snapshots.filter(
+                snapshot_of_id=self.id,
+                created_at__gte=start_date,
+            ).order_by('created_at', 'id').first()
 
         labels = []
         points = []
-        old_created_at = ''
-        for snapshot in snapshots:
-            if old_created_at != snapshot.created_at.strftime('%m%d'):
-                labels.append(u'{0} {1}'.format(
-                    snapshot.created_at.day,
-                    _(snapshot.created_at.strftime('%B'))
-                ))
-                reputation = self.reputation_formula(snapshot.portfolio_value, snapshot.total_cash)
-                points.append(str(int(reputation)))
-            old_created_at = snapshot.created_at.strftime('%m%d')
+        for day, snapshot in zip(days, snapshots):
+            if snapshot is None:
+                # user's first snapshot later this day
+                if first_snapshot is None or first_snapshot.created_at.date() != day.date():
+                    continue
+                snapshot = first_snapshot
+            labels.append(u'{0} {1}'.format(
+                day.day,
+                _(day.strftime('%B'))
+            ))
+            reputation = self.reputation_formula(snapshot.portfolio_value, snapshot.total_cash)
+            points.append(str(int(reputation)))
 
         return {
             'id': self.id,
@@ -472,13 +492,18 @@ class UserProfile(AbstractBaseUser):
         :rtype: int
         """
         start_date = self.reset_date if self.reset_date > date else date
-        snapshots = self.snapshots.filter(
-            snapshot_of_id=self.id,
-            created_at__gte=start_date,
-        ).order_by('created_at')
-        if len(snapshots):
+        # the latest snapshot is carried forward, unchanged snapshots aren't stored
+        snapshot = self.snapshots.get_snapshots_at(
+            [start_date + timedelta(hours=1)], since=self.reset_date
+        )[0]
+        if snapshot is None:
+            snapshot = self.snapshots.filter(
+                snapshot_of_id=self.id,
+                created_at__gte=start_date,
+            ).order_by('created_at', 'id').first()
+        if snapshot is not None:
             old_reputation = self.reputation_formula(
-                snapshots[0].portfolio_value, snapshots[0].total_cash
+                snapshot.portfolio_value, snapshot.total_cash
             )
             if old_reputation == 0:
                 old_reputation = 100
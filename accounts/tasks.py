@@ -5,6 +5,7 @@ from constance import config
 from django.db import transaction
 from django.db.models import Avg
 
+from accounts import history
 from accounts.models import UserProfile, Team
 from events.models import Transaction
 
@@ -70,16 +71,23 @@ def update_teams_score():
 def create_accounts_snapshot():
     logger.debug("'accounts:tasks:create_accounts_snapshot' worker up")
 
-    queryset = UserProfile.objects.all()
+    count = UserProfile.snapshots.bulk_snapshot(UserProfile.objects.all())
+    history.invalidate()
+
+    logger.debug("'accounts:tasks:create_accounts_snapshot' finished snapshotting %d Users."
+                 % count)
 
-    for user in queryset.iterator():
-        try:
-            logger.debug("'accounts:tasks:create_accounts_snapshot' snapshotting user <%s>" % unicode(user.pk))
-            user.snapshots.create_snapshot()
-        except:
-            logger.exception("Fatal error during create_accounts_snapshot of user #%d" % (user.id,))
 
-    logger.debug("'accounts:tasks:create_accounts_snapshot' finished snapshotting Users.")
+@task
+def compact_accounts_snapshots():
+    """
+    Roll up user snapshots older than their hourly retention to daily ones and create
+    partitions for next months if the snapshot table is partitioned
+    """
+    deleted = UserProfile.snapshots.compact()
+    logger.debug("'accounts:tasks:compact_accounts_snapshots' deleted %d snapshots." % deleted)
+    for partition in UserProfile.snapshots.create_partitions():
+        logger.debug("'accounts:tasks:compact_accounts_snapshots' created partition %s" % partition)
 
 
 @task
@@ -3,12 +3,16 @@
 Test accounts module
 """
 import os
+from datetime import timedelta
 from decimal import Decimal
+from freezegun import freeze_time
 from mock import patch
 
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseForbidden
 from django.test import TestCase
+from django.utils.timezone import now
 
 from .factories import UserFactory, UserWithAvatarFactory, AdminFactory
 from .models import UserProfile, get_user_avatar_path
@@ -109,11 +113,11 @@ class UserProfileModelTestCase(TestCase):
         self.assertEqual(0, user.current_portfolio_value)
         event = EventFactory()
         bet = BetFactory(user=user, event=event)
-        self.assertEqual(50, user.current_portfolio_value)
+        self.assertEqual(48, user.current_portfolio_value)
         bet.outcome = Bet.NO
         bet.has = 2
         bet.save()
-        self.assertEqual(100, user.current_portfolio_value)
+        self.assertEqual(96, user.current_portfolio_value)
 
     def test_get_avatar_url(self):
         """
@@ -462,8 +466,15 @@ class UserTasksTestCase(TestCase):
 
     def test_create_accounts_snapshot(self):
         user = UserFactory()
+        user.total_cash = 1234
+        user.portfolio_value = 56
+        user.save()
         create_accounts_snapshot()
-        # TODO mock logger and create_snapshot()
+
+        snapshot = user.snapshots.get(snapshot_of=user)
+        self.assertEqual(1234, snapshot.total_cash)
+        self.assertEqual(56, snapshot.portfolio_value)
+        self.assertEqual(UserProfile.objects.count(), UserProfile.snapshots.count())
 
     def test_update_users_classification(self):
         users = UserFactory.create_batch(6)
@@ -516,7 +527,51 @@ class UserTemplatetagsTestCase(TestCase):
         """
         Get reputation history
         """
-        # TODO
+        initial_time = now().replace(hour=0, minute=31, second=0, microsecond=0) - timedelta(days=3)
+        with freeze_time(initial_time - timedelta(hours=1)):
+            user = UserFactory()
+        with freeze_time(initial_time) as frozen_time:
+            create_accounts_snapshot()
+            frozen_time.tick(delta=timedelta(days=1))
+            create_accounts_snapshot()
+            frozen_time.tick(delta=timedelta(days=1))
+            user.total_cash += 1000
+            user.save()
+            create_accounts_snapshot()
+            frozen_time.tick(delta=timedelta(days=1))
+            create_accounts_snapshot()
+
+            # unchanged snapshots are not stored but carried forward
+            self.assertEqual(2, user.snapshots.filter(snapshot_of=user).count())
+            old_reputation = str(int(UserProfile.reputation_formula(
+                user.portfolio_value, user.total_cash - 1000
+            )))
+            new_reputation = str(int(UserProfile.reputation_formula(
+                user.portfolio_value, user.total_cash
+            )))
+            history = user.get_reputation_history()
+            self.assertEqual([old_reputation, old_reputation, new_reputation, new_reputation],
+                             history['points'])
+            self.assertEqual(4, len(history['labels']))
+
+    def test_reputation_history_cache(self):
+        """
+        Reputation history is cached until the next snapshot of accounts
+        """
+        cache.clear()
+        user = UserFactory()
+        create_accounts_snapshot()
+        history = user.get_reputation_history()
+        self.assertEqual(1, len(history['points']))
+
+        user.total_cash += 1000
+        user.save()
+        user.snapshots.create_snapshot()
+        with self.assertNumQueries(0):
+            self.assertEqual(history, user.get_reputation_history())
+
+        create_accounts_snapshot()
+        self.assertNotEqual(history['points'], user.get_reputation_history()['points'])
 
     def test_get_reputation_change(self):
         """
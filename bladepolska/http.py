@@ -51,3 +51,7 @@ class JSONResponseCreated(JSONResponse):
 
 class JSONResponseBadRequest(JSONResponse):
     status_code = 400
+
+
+class JSONResponseConflict(JSONResponse):
+    status_code = 409
@@ -24,7 +24,12 @@
 #    distribution.
 #
 
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, router, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .sql import fetch_instances
 
 import datetime
 
@@ -66,6 +71,13 @@ class SnapshotAddon(object):
             # set reference fields on newly created Snapshot, so it knows relevant SnapshotDelivery model and which model it snapshots.
             setattr(model, 'snapshots_model', cls)
             setattr(model, 'snapshotted_fields', fields)
+            # with only_on_change=True a snapshot is not stored if snapshotted fields didn't change
+            # since the latest one; readers have to carry the latest snapshot forward
+            setattr(model, 'only_on_change', self.init_kwargs.get('only_on_change', False))
+            # snapshots older than hourly_retention_days are rolled up to one a day, see compact()
+            setattr(model, 'hourly_retention_days', self.init_kwargs.get('hourly_retention_days'))
+            # snapshot table may be converted to monthly partitions on PostgreSQL, see partition()
+            setattr(model, 'partition_by_month', self.init_kwargs.get('partition_by_month', False))
 
             # registers AdminModel for this model.
             # admin.site.register(model, create_admin_model(model))
@@ -80,13 +92,14 @@ class SnapshotAddon(object):
         models.signals.class_prepared.connect(_contribute, sender=cls, weak=False)
 
 
-def create_snapshot_manager_with_pk(manager, pk_attribute, instance):
+def create_snapshot_manager_with_pk_class(manager, pk_attribute):
     """
-    Create an Snapshot manager for a model instance, which already exists in the DB.
-    Otherwise create_snapshot_manager_class is called instead.
+    Create an Snapshot manager class for model instances, which already exist in the DB.
+    Otherwise create_snapshot_manager_class is used instead.
+    The class is created once per model by SnapshotDescriptor and bound to the instance.
     """
     class SnapshotWithPkManager(manager.__class__):
-        def __init__(self, *arg, **kw):
+        def __init__(self, instance, *arg, **kw):
             super(SnapshotWithPkManager, self).__init__(*arg, **kw)
             # reference to the model class being snapshoted
             self.model = manager.model
@@ -95,35 +108,467 @@ def create_snapshot_manager_with_pk(manager, pk_attribute, instance):
 
         def get_snapshots(self):
             """ Forces query set to return only the relevant row as a safety precaution. """
-            qs = super(SnapshotWithPkManager, self).get_query_set().filter(**{pk_attribute: instance})
+            qs = super(SnapshotWithPkManager, self).get_query_set().\
+                filter(**{pk_attribute: self.instance})
             if self._db is not None:
                 qs = qs.using(self._db)
             return qs
 
-        def create_snapshot(self):
-            new_snapshot = self.model(**{pk_attribute: instance, 'created_at': datetime.datetime.now()})
+        def get_latest_snapshot(self):
+            snapshots = self.filter(**{pk_attribute: self.instance})
+            return snapshots.order_by('-created_at', '-id').first()
+
+        def get_snapshots_at(self, times, since=None):
+            """
+            Carry forward snapshots: for every moment returns the latest snapshot taken before it
+            or None if there was none. On PostgreSQL only the latest snapshot between every two
+            moments is read (DISTINCT ON width_bucket), e.g. one row per day for daily moments.
+            :param times: moments in ascending order
+            :type times: [datetime]
+            :param since: ignore snapshots taken before
+            :type since: datetime
+            :rtype: [Snapshot or None]
+            """
+            if not times:
+                return []
+            snapshots = self.filter(**{pk_attribute: self.instance})
+            if since is not None:
+                snapshots = snapshots.filter(created_at__gte=since)
+            current = snapshots.filter(
+                created_at__lt=times[0]
+            ).order_by('-created_at', '-id').first()
+            later = snapshots.filter(
+                created_at__gte=times[0], created_at__lt=times[-1]
+            ).order_by('created_at', 'id')
+
+            using = router.db_for_read(self.model)
+            connection = connections[using]
+            if connection.vendor == 'postgresql' and len(times) > 1:
+                qn = connection.ops.quote_name
+                created_at = qn(self.model._meta.get_field('created_at').column)
+                select_sql, select_params = later.order_by().query.sql_with_params()
+                sql = (
+                    "SELECT DISTINCT ON (width_bucket(%(created_at)s, %%s::timestamptz[]))"
+                    " snapshots.* FROM (%(select)s) AS snapshots"
+                    " ORDER BY width_bucket(%(created_at)s, %%s::timestamptz[]),"
+                    " %(created_at)s DESC, %(id)s DESC"
+                ) % {
+                    'created_at': created_at,
+                    'select': select_sql,
+                    'id': qn(self.model._meta.pk.column),
+                }
+                later = fetch_instances(
+                    self.model, sql, (list(times),) + tuple(select_params) + (list(times),),
+                    using
+                )
+
+            later = iter(later)
+            next_snapshot = next(later, None)
+            result = []
+            for moment in times:
+                while next_snapshot is not None and next_snapshot.created_at < moment:
+                    current = next_snapshot
+                    next_snapshot = next(later, None)
+                result.append(current)
+            return result
 
+        def create_snapshot(self):
             fields = self.model.snapshotted_fields
+            if self.model.only_on_change:
+                latest = self.get_latest_snapshot()
+                if latest is not None and all(
+                    getattr(latest, field_name) == getattr(self.instance, field_name)
+                    for field_name in fields
+                ):
+                    return None
+
+            new_snapshot = self.model(**{
+                pk_attribute: self.instance, 'created_at': datetime.datetime.now()
+            })
+
             for field_name in fields:
                 field_value = getattr(self.instance, field_name)
                 setattr(new_snapshot, field_name, field_value)
 
             new_snapshot.save(force_insert=True)
+            return new_snapshot
 
-    return SnapshotWithPkManager()
+    return SnapshotWithPkManager
 
 
 def create_snapshot_manager_class(manager):
     """
-    Create an Snapshot manager for a model instance, which does not exist in the DB (a static class field for instance).
+    Create an Snapshot manager class for a model instance, which does not exist in the DB
+    (a static class field for instance).
     """
     class SnapshotManager(manager.__class__):
+        BULK_SNAPSHOT_BATCH_SIZE = 1000
+        COMPACT_BATCH_SIZE = 5000
+
         def __init__(self, *arg, **kw):
             super(SnapshotManager, self).__init__(*arg, **kw)
             # reference to the model class being snapshoted
             self.model = manager.model
 
-    return SnapshotManager()
+        def bulk_snapshot(self, queryset):
+            """
+            Snapshot every instance of the queryset at once. On PostgreSQL it's a single
+            INSERT INTO ... SELECT executed by the database, elsewhere snapshots are created with
+            bulk_create in batches of BULK_SNAPSHOT_BATCH_SIZE.
+            With only_on_change instances equal to their latest snapshot are skipped.
+            Returns number of created snapshots.
+            """
+            fields = list(self.model.snapshotted_fields)
+            created_at = timezone.now()
+            using = router.db_for_write(self.model)
+            connection = connections[using]
+            rows = queryset.using(using).order_by().values_list('pk', *fields)
+
+            if connection.vendor == 'postgresql':
+                qn = connection.ops.quote_name
+                meta = self.model._meta
+                snapshot_of = qn(meta.get_field('snapshot_of').column)
+                columns = [qn(meta.get_field(name).column) for name in fields]
+                select_sql, select_params = rows.query.sql_with_params()
+                sql = (
+                    "INSERT INTO %s (%s, %s, %s)"
+                    " SELECT instances.*, %%s FROM (%s) AS instances (%s, %s)"
+                ) % (
+                    qn(meta.db_table),
+                    snapshot_of,
+                    ', '.join(columns),
+                    qn(meta.get_field('created_at').column),
+                    select_sql,
+                    snapshot_of,
+                    ', '.join(columns),
+                )
+                if self.model.only_on_change:
+                    sql += (
+                        " WHERE NOT EXISTS (SELECT 1 FROM (SELECT %(columns)s FROM %(table)s"
+                        " WHERE %(snapshot_of)s = instances.%(snapshot_of)s"
+                        " ORDER BY %(created_at)s DESC, %(id)s DESC LIMIT 1) AS latest"
+                        " WHERE %(unchanged)s)"
+                    ) % {
+                        'columns': ', '.join(columns),
+                        'table': qn(meta.db_table),
+                        'snapshot_of': snapshot_of,
+                        'created_at': qn(meta.get_field('created_at').column),
+                        'id': qn(meta.pk.column),
+                        'unchanged': ' AND '.join(
+                            'latest.%s IS NOT DISTINCT FROM instances.%s' % (column, column)
+                            for column in columns
+                        ),
+                    }
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, tuple(select_params) + (created_at,))
+                    return cursor.rowcount
+
+            count = 0
+            batch = []
+            for row in rows.iterator():
+                batch.append(row)
+                if len(batch) == self.BULK_SNAPSHOT_BATCH_SIZE:
+                    count += self._bulk_create_snapshots(batch, created_at, using)
+                    batch = []
+            if batch:
+                count += self._bulk_create_snapshots(batch, created_at, using)
+            return count
+
+        def _bulk_create_snapshots(self, rows, created_at, using):
+            fields = self.model.snapshotted_fields
+            manager = self.model._default_manager.using(using)
+
+            if self.model.only_on_change:
+                latest_ids = manager.filter(
+                    snapshot_of_id__in=[row[0] for row in rows]
+                ).order_by().values('snapshot_of_id').annotate(
+                    latest_id=Max('id')
+                ).values_list('latest_id', flat=True)
+                latest = dict(
+                    (values[0], values[1:])
+                    for values in manager.filter(id__in=list(latest_ids)).values_list(
+                        'snapshot_of_id', *fields
+                    )
+                )
+                rows = [row for row in rows if latest.get(row[0]) != tuple(row[1:])]
+
+            snapshots = []
+            for row in rows:
+                snapshot = self.model(snapshot_of_id=row[0], created_at=created_at)
+                for field_name, value in zip(fields, row[1:]):
+                    setattr(snapshot, field_name, value)
+                snapshots.append(snapshot)
+            manager.bulk_create(snapshots)
+            return len(snapshots)
+
+        def get_compaction_cutoff(self):
+            """
+            Snapshots are rolled up in days starting at 1 a.m. (current timezone), so the kept
+            snapshot is the one read at midnight. Returns start of the day hourly_retention_days
+            ago, only whole days are rolled up.
+            """
+            hour = datetime.timedelta(hours=1)
+            moment = timezone.now() - datetime.timedelta(days=self.model.hourly_retention_days)
+            day = (timezone.localtime(moment) - hour).date()
+            return timezone.make_aware(datetime.datetime.combine(day, datetime.time())) + hour
+
+        def compact(self, batch_size=None):
+            """
+            Roll up snapshots older than hourly_retention_days to the latest snapshot of every
+            day per instance. Day starts at 1 a.m., so daily readers carrying forward the latest
+            snapshot taken before 1 a.m. get the same values. Deletes in batches of batch_size.
+            Returns number of deleted snapshots.
+            """
+            if self.model.hourly_retention_days is None:
+                return 0
+            batch_size = batch_size or self.COMPACT_BATCH_SIZE
+            cutoff = self.get_compaction_cutoff()
+            using = router.db_for_write(self.model)
+            connection = connections[using]
+
+            if connection.vendor == 'postgresql':
+                return self._compact_postgresql(connection, cutoff, batch_size)
+
+            hour = datetime.timedelta(hours=1)
+            manager = self.model._default_manager.using(using)
+            rows = manager.filter(created_at__lt=cutoff).order_by(
+                'snapshot_of_id', '-created_at', '-id'
+            ).values_list('id', 'snapshot_of_id', 'created_at')
+            deleted = 0
+            kept_day = None
+            after = models.Q()
+            while True:
+                # keyset pagination, deleted rows are always before the next page
+                page = list(rows.filter(after)[:batch_size])
+                ids = []
+                for snapshot_id, snapshot_of_id, created_at in page:
+                    day = (snapshot_of_id, (timezone.localtime(created_at) - hour).date())
+                    if day == kept_day:
+                        ids.append(snapshot_id)
+                    kept_day = day
+                if ids:
+                    manager.filter(id__in=ids).delete()
+                    deleted += len(ids)
+                if len(page) < batch_size:
+                    return deleted
+                snapshot_id, snapshot_of_id, created_at = page[-1]
+                after = models.Q(snapshot_of_id__gt=snapshot_of_id) | models.Q(
+                    snapshot_of_id=snapshot_of_id, created_at__lt=created_at
+                ) | models.Q(snapshot_of_id=snapshot_of_id, created_at=created_at,
+                             id__lt=snapshot_id)
+
+        def _compact_postgresql(self, connection, cutoff, batch_size):
+            """
+            Rank old snapshots once into a temporary table of ids to delete, then delete them
+            in batches ordered by id.
+            """
+            qn = connection.ops.quote_name
+            meta = self.model._meta
+            names = {
+                'table': qn(meta.db_table),
+                'compacted': qn('%s_compacted' % meta.db_table),
+                'id': qn(meta.pk.column),
+                'snapshot_of': qn(meta.get_field('snapshot_of').column),
+                'created_at': qn(meta.get_field('created_at').column),
+            }
+            deleted = 0
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS %(compacted)s" % names)
+                cursor.execute((
+                    "CREATE TEMPORARY TABLE %(compacted)s (id bigint PRIMARY KEY)"
+                ) % names)
+                try:
+                    cursor.execute((
+                        "INSERT INTO %(compacted)s (id)"
+                        " SELECT %(id)s FROM ("
+                        " SELECT %(id)s, row_number() OVER (PARTITION BY %(snapshot_of)s,"
+                        " ((%(created_at)s AT TIME ZONE %%s) - interval '1 hour')::date"
+                        " ORDER BY %(created_at)s DESC, %(id)s DESC) AS position"
+                        " FROM %(table)s WHERE %(created_at)s < %%s"
+                        ") AS days WHERE position > 1"
+                    ) % names, (timezone.get_current_timezone_name(), cutoff))
+                    last_id = 0
+                    while True:
+                        cursor.execute((
+                            "SELECT id FROM %(compacted)s WHERE id > %%s ORDER BY id LIMIT %%s"
+                        ) % names, (last_id, batch_size))
+                        ids = [row[0] for row in cursor.fetchall()]
+                        if not ids:
+                            return deleted
+                        cursor.execute(
+                            "DELETE FROM %(table)s WHERE %(id)s = ANY(%%s)" % names, (ids,)
+                        )
+                        deleted += cursor.rowcount
+                        last_id = ids[-1]
+                finally:
+                    cursor.execute("DROP TABLE IF EXISTS %(compacted)s" % names)
+
+        def get_partitions(self, start, end):
+            """
+            Monthly partitions covering days from start to end
+            :type start: date
+            :type end: date
+            :return: partition table name, first day of the month, first day of the next month
+            :rtype: [(str, date, date)]
+            """
+            partitions = []
+            month = start.replace(day=1)
+            while month <= end:
+                next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+                partitions.append((
+                    '%s_%04d%02d' % (self.model._meta.db_table, month.year, month.month),
+                    month,
+                    next_month,
+                ))
+                month = next_month
+            return partitions
+
+        def is_partitioned(self):
+            connection = connections[router.db_for_write(self.model)]
+            # declarative partitioning is available since PostgreSQL 10
+            if connection.vendor != 'postgresql' or connection.pg_version < 100000:
+                return False
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+                    [self.model._meta.db_table]
+                )
+                return cursor.fetchone() is not None
+
+        def _create_partitions(self, cursor, start, end):
+            qn = connections[router.db_for_write(self.model)].ops.quote_name
+            created = []
+            for name, month, next_month in self.get_partitions(start, end):
+                cursor.execute("SELECT to_regclass(%s)", [name])
+                if cursor.fetchone()[0] is not None:
+                    continue
+                cursor.execute(
+                    "CREATE TABLE %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+                        qn(name), qn(self.model._meta.db_table),
+                        month.isoformat(), next_month.isoformat(),
+                    )
+                )
+                created.append(name)
+            return created
+
+        def create_partitions(self, months_ahead=2):
+            """
+            Create partitions from this month to months_ahead, if the table is partitioned.
+            Returns names of created partitions.
+            """
+            if not self.model.partition_by_month or not self.is_partitioned():
+                return []
+            today = timezone.now().date()
+            end = today + datetime.timedelta(days=31 * months_ahead)
+            connection = connections[router.db_for_write(self.model)]
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                return self._create_partitions(cursor, today, end)
+
+        def drop_partitions(self, before):
+            """
+            Drop partitions of months ending before the day, it's how old snapshots of
+            a partitioned table are removed instead of deleting rows.
+            Returns names of dropped partitions.
+            """
+            if not self.model.partition_by_month or not self.is_partitioned():
+                return []
+            table = self.model._meta.db_table
+            connection = connections[router.db_for_write(self.model)]
+            qn = connection.ops.quote_name
+            dropped = []
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT child.relname FROM pg_inherits"
+                    " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+                    " WHERE pg_inherits.inhparent = %s::regclass",
+                    [table]
+                )
+                for name, in cursor.fetchall():
+                    suffix = name[len(table) + 1:]
+                    if not suffix.isdigit() or len(suffix) != 6:
+                        # default partition
+                        continue
+                    month = datetime.date(int(suffix[:4]), int(suffix[4:]), 1)
+                    if self.get_partitions(month, month)[0][2] <= before:
+                        cursor.execute("DROP TABLE %s" % qn(name))
+                        dropped.append(name)
+            return dropped
+
+        def partition(self, months_ahead=2):
+            """
+            Convert the snapshot table to a table partitioned by month of created_at
+            (PostgreSQL 11 or newer) and copy existing snapshots. The primary key becomes
+            (id, created_at), rows outside of created partitions go to the default partition.
+            Returns names of created partitions, raises ImproperlyConfigured on other databases.
+            """
+            connection = connections[router.db_for_write(self.model)]
+            # default partitions are available since PostgreSQL 11
+            if connection.vendor != 'postgresql' or connection.pg_version < 110000:
+                raise ImproperlyConfigured("Partitioned snapshots need PostgreSQL 11 or newer")
+            if self.is_partitioned():
+                return []
+            meta = self.model._meta
+            qn = connection.ops.quote_name
+            table = meta.db_table
+            old_table = '%s_unpartitioned' % table
+            snapshot_of = meta.get_field('snapshot_of')
+            columns = {
+                'id': qn(meta.pk.column),
+                'snapshot_of': qn(snapshot_of.column),
+                'created_at': qn(meta.get_field('created_at').column),
+            }
+
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, meta.pk.column])
+                sequence = cursor.fetchone()[0]
+                cursor.execute("SELECT min(%(created_at)s), max(%(created_at)s) FROM %(table)s" % {
+                    'created_at': columns['created_at'], 'table': qn(table),
+                })
+                first, last = cursor.fetchone()
+                today = timezone.now().date()
+                first = first.date() if first else today
+                last = max(last.date() if last else today, today)
+
+                cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(table), qn(old_table)))
+                cursor.execute(
+                    "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                    " PARTITION BY RANGE (%s)" % (
+                        qn(table), qn(old_table), columns['created_at']
+                    )
+                )
+                # names of the old table constraints are still taken until it's dropped
+                cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (%s, %s)" % (
+                    qn(table), qn('%s_partitioned_pkey' % table),
+                    columns['id'], columns['created_at'],
+                ))
+                cursor.execute(
+                    "ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s (%s)"
+                    " DEFERRABLE INITIALLY DEFERRED" % (
+                        qn(table), qn('%s_partitioned_snapshot_of_fk' % table),
+                        columns['snapshot_of'],
+                        qn(snapshot_of.rel.to._meta.db_table),
+                        qn(snapshot_of.rel.to._meta.pk.column),
+                    )
+                )
+                cursor.execute("CREATE INDEX %s ON %s (%s, %s)" % (
+                    qn('%s_snapshot_of_created_at' % table), qn(table),
+                    columns['snapshot_of'], columns['created_at'],
+                ))
+                cursor.execute("CREATE TABLE %s PARTITION OF %s DEFAULT" % (
+                    qn('%s_default' % table), qn(table)
+                ))
+                created = self._create_partitions(
+                    cursor, first, last + datetime.timedelta(days=31 * months_ahead)
+                )
+                cursor.execute("INSERT INTO %s SELECT * FROM %s" % (qn(table), qn(old_table)))
+                if sequence:
+                    cursor.execute("ALTER SEQUENCE %s OWNED BY %s.%s" % (
+                        sequence, qn(table), columns['id']
+                    ))
+                cursor.execute("DROP TABLE %s" % qn(old_table))
+            return created
+
+    return SnapshotManager
 
 
 class SnapshotDescriptor(object):
@@ -135,12 +580,17 @@ class SnapshotDescriptor(object):
     def __init__(self, manager):
         self.manager = manager
         self.pk_attribute = 'snapshot_of'
+        # manager classes are created once per model, not on every access
+        self.class_manager = create_snapshot_manager_class(manager)()
+        self.manager_with_pk_class = create_snapshot_manager_with_pk_class(
+            manager, self.pk_attribute
+        )
 
     def __get__(self, instance=None, owner=None):
         if instance is None:
-            return create_snapshot_manager_class(self.manager)
+            return self.class_manager
         else:
-            return create_snapshot_manager_with_pk(self.manager, self.pk_attribute, instance)
+            return self.manager_with_pk_class(instance)
 
     def __set__(self, instance, value):
         raise AttributeError("Snapshot manager may not be edited in this manner.")
@@ -157,6 +607,8 @@ def create_snapshot_model(cls, fields=[]):
         verbose_name = u'%s - snapshot' % cls._meta.verbose_name
         verbose_name_plural = u'%s - snapshoty' % cls._meta.verbose_name
         ordering = ['-created_at']
+        # every reader filters snapshots of an instance by time
+        index_together = [('snapshot_of', 'created_at')]
 
     # Set up a dictionary to simulate declarations within a class.
     attrs = {
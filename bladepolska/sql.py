@@ -29,3 +29,25 @@ def construct_where_clause(filters):
         where_clause = "WHERE %s" % where_clause
 
     return where_clause
+
+
+def fetch_instances(model, sql, params, using='default'):
+    """
+    Execute sql returning whole rows of model table (eg. UPDATE ... RETURNING *) and build model
+    instances from them.
+    """
+    from django.db import connections
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+
+    instances = []
+    for row in rows:
+        instance = model(**dict(zip(columns, row)))
+        instance._state.adding = False
+        instance._state.db = using
+        instances.append(instance)
+
+    return instances
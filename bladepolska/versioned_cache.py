@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned keys in the default cache. Cached values are never deleted; invalidation bumps
+a version which is a part of their keys, so stale values are not read anymore and expire
+after timeout. Every key has two versions: one of the whole namespace and one of its scope
+(e.g. an object id), so values of a single scope can be invalidated too.
+"""
+import time
+
+from django.core.cache import cache
+
+
+class VersionedCache(object):
+    def __init__(self, namespace, timeout):
+        """
+        :param namespace: prefix of all keys
+        :type namespace: str
+        :param timeout: seconds values and scope versions are kept in the cache for
+        :type timeout: int
+        """
+        self.namespace = namespace
+        self.timeout = timeout
+
+    def get_version_key(self, scope=None):
+        if scope is None:
+            return '%s_version' % self.namespace
+        return '%s_version:%s' % (self.namespace, scope)
+
+    def get_versions(self, scopes):
+        """
+        Versions of scopes with one get_many. Versions missing in the cache start from current
+        time, so an evicted version doesn't reuse old keys.
+        :param scopes: scopes
+        :type scopes: list
+        :return: namespace and scope version by scope
+        :rtype: {object: str}
+        """
+        version_keys = dict((self.get_version_key(scope), scope) for scope in scopes)
+        version_keys[self.get_version_key()] = None
+        versions = dict(
+            (version_keys[key], version)
+            for key, version in cache.get_many(list(version_keys)).items()
+        )
+        for key, scope in version_keys.items():
+            if scope not in versions:
+                # the namespace version lives until it's evicted
+                cache.add(key, int(time.time()), self.timeout if scope is not None else None)
+                versions[scope] = cache.get(key, int(time.time()))
+        return dict(
+            (scope, '%d.%d' % (versions[None], versions[scope])) for scope in scopes
+        )
+
+    def invalidate(self, scope=None):
+        """
+        Make cached values of the scope stale, or all of them if scope is None
+        """
+        version_key = self.get_version_key(scope)
+        timeout = self.timeout if scope is not None else None
+        cache.add(version_key, int(time.time()), timeout)
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            # evicted between add and incr
+            cache.set(version_key, int(time.time()), timeout)
+
+    def get_many(self, keys, compute):
+        """
+        Values from the cache, missing ones are computed and cached
+        :param keys: key parts by scope
+        :type keys: {object: tuple}
+        :param compute: function computing values of missing scopes by scope
+        :type compute: function
+        :return: value by scope
+        :rtype: {}
+        """
+        versions = self.get_versions(list(keys))
+        scopes = dict(
+            (u':'.join(u'%s' % part for part in (self.namespace, scope, versions[scope]) + parts),
+             scope)
+            for scope, parts in keys.items()
+        )
+        values = dict(
+            (scopes[key], value) for key, value in cache.get_many(list(scopes)).items()
+        )
+        missing = dict((key, scope) for key, scope in scopes.items() if scope not in values)
+        if missing:
+            computed = compute(list(missing.values()))
+            values.update(computed)
+            cache.set_many(
+                dict((key, computed[scope]) for key, scope in missing.items()), self.timeout
+            )
+        return values
+
+    def get(self, scope, parts, compute):
+        """
+        Value from the cache, computed and cached when missing
+        :param scope: scope of the value
+        :param parts: key parts
+        :type parts: tuple
+        :param compute: function computing the value
+        :type compute: function
+        """
+        return self.get_many({scope: parts}, lambda scopes: {scope: compute()})[scope]
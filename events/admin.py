@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
+import json
+
+from django.conf.urls import url
 from django.contrib import admin
 from django.db import models
 from django.forms import Textarea, TextInput
+from django.shortcuts import get_object_or_404
+from django.utils.html import format_html
 
 from .forms import EventForm
-from .models import Bet, Event, Transaction, EventCategory
+from .models import Bet, Event, Transaction, EventCategory, LimitOrder, EventSettlement
+from bladepolska.http import JSONResponse
 
 
 class EventAdmin(admin.ModelAdmin):
@@ -30,7 +36,7 @@ class EventAdmin(admin.ModelAdmin):
         }),
         (u'Rozwiązanie wydarzenia', {
             'fields': (
-                'end_date', 'outcome', 'outcome_reason'
+                'end_date', 'outcome', 'outcome_reason', 'settlement_progress'
             )
         }),
         ('Dane statystyczne', {
@@ -47,6 +53,7 @@ class EventAdmin(admin.ModelAdmin):
     readonly_fields = [
         'end_date',
         'outcome',
+        'settlement_progress',
         'current_buy_for_price',
         'current_buy_against_price',
         'current_sell_for_price',
@@ -75,6 +82,31 @@ class EventAdmin(admin.ModelAdmin):
             obj.created_by = request.user
         obj.save()
 
+    def get_urls(self):
+        return [
+            url(r'^(?P<event_id>\d+)/settlement/$',
+                self.admin_site.admin_view(self.settlement_view),
+                name='events_event_settlement'),
+        ] + super(EventAdmin, self).get_urls()
+
+    def settlement_view(self, request, event_id):
+        """
+        Settlement progress polled by change_form
+        """
+        settlement = get_object_or_404(EventSettlement, event_id=event_id)
+        return JSONResponse(json.dumps(settlement.settlement_dict))
+
+    def settlement_progress(self, obj):
+        settlement = EventSettlement.objects.filter(event_id=obj.id).first()
+        if settlement is None:
+            return '-'
+        return format_html(
+            u'<span id="settlement-progress">{}: {}% ({}/{})</span>',
+            settlement.get_status_display(), settlement.progress, settlement.processed,
+            settlement.total
+        )
+    settlement_progress.short_description = u'rozliczenie'
+
 
 class BetAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'event', 'outcome', 'has', 'bought', 'sold', 'bought_avg_price',
@@ -83,12 +115,28 @@ class BetAdmin(admin.ModelAdmin):
 
 
 class TransactionAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'event', 'type', 'date', 'quantity', 'price']
+    list_display = ['id', 'user', 'event', 'type', 'date', 'quantity', 'price', 'price_remainder']
     list_filter = ['user', 'event', 'type', 'date']
 
 
+class EventSettlementAdmin(admin.ModelAdmin):
+    list_display = ['id', 'event', 'outcome', 'status', 'processed', 'total', 'created_date',
+                    'finished_date']
+    list_filter = ['status']
+    readonly_fields = ['event', 'outcome', 'status', 'last_id', 'processed', 'total',
+                       'finished_date']
+
+
+class LimitOrderAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'event', 'outcome', 'direction', 'quantity', 'limit_price',
+                    'status', 'created_date', 'executed_date']
+    list_filter = ['event', 'status']
+
+
 EventAdmin.list_per_page = 10000
 admin.site.register(Event, EventAdmin)
 admin.site.register(Bet, BetAdmin)
 admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(LimitOrder, LimitOrderAdmin)
+admin.site.register(EventSettlement, EventSettlementAdmin)
 admin.site.register(EventCategory)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Event charts kept in the default cache. Chart points change only when
+events.tasks.create_open_events_snapshot writes price days, which makes all charts stale, or an
+event is finished, which makes stale only charts of the event. Charts are computed again on the
+first read after that. Listing pages get charts of all events with one get_many.
+"""
+from django.utils import translation
+
+from bladepolska.versioned_cache import VersionedCache
+
+
+# charts are invalidated hourly, timeout only limits staleness if the snapshot task stops
+charts_cache = VersionedCache('event_charts', 2 * 60 * 60)
+
+
+def invalidate(event_id=None):
+    """
+    Make cached charts of the event stale, or of all events if event_id is None
+    :type event_id: int
+    """
+    charts_cache.invalidate(event_id)
+
+
+def get_charts(events, days, compute):
+    """
+    Charts of events from the cache, missing ones are computed and cached
+    :param events: events
+    :type events: [Event]
+    :param days: chart range
+    :type days: int
+    :param compute: function computing charts of events missing in the cache by event id
+    :type compute: function
+    :return: chart of every event by event id
+    :rtype: {int: {}}
+    """
+    language = translation.get_language()
+    events_by_id = dict((event.id, event) for event in events)
+    return charts_cache.get_many(
+        dict((event.id, (language, days)) for event in events),
+        lambda event_ids: compute([events_by_id[event_id] for event_id in event_ids])
+    )
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Trading counters kept in the default cache, so the price mismatch and retry rate of every trading
+mode can be followed (manage.py trading_stats). Counters are best effort: locmem cache counts per
+process only and memcached may evict them.
+
+Trades don't talk to the cache: increments are summed in the process and flushed at most every
+FLUSH_INTERVAL seconds, one cache call per changed counter. Counts not flushed yet are lost when
+the process exits.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+
+
+KEY = 'trading_counter:%s'
+FLUSH_INTERVAL = 10
+
+ORDERS = 'orders'
+TOLERANT_ORDERS = 'tolerant_orders'
+PRICE_MISMATCHES = 'price_mismatches'
+TOLERANT_PRICE_MISMATCHES = 'tolerant_price_mismatches'
+OPTIMISTIC_RETRIES = 'optimistic_retries'
+
+COUNTERS = (ORDERS, TOLERANT_ORDERS, PRICE_MISMATCHES, TOLERANT_PRICE_MISMATCHES,
+            OPTIMISTIC_RETRIES)
+
+_lock = threading.Lock()
+_pending = {}
+_flushed_at = [time.time()]
+
+
+def incr(name, delta=1):
+    """
+    Increase counter
+    :param name: one of COUNTERS
+    :type name: str
+    :param delta: increase by
+    :type delta: int
+    """
+    with _lock:
+        _pending[name] = _pending.get(name, 0) + delta
+        due = time.time() - _flushed_at[0] >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def flush():
+    """
+    Add increments summed in this process to the cache
+    """
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _flushed_at[0] = time.time()
+
+    for name, delta in pending.items():
+        key = KEY % name
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # first increment or evicted; someone else may have added it meanwhile
+            if not cache.add(key, delta, None):
+                cache.incr(key, delta)
+
+
+def get_counters():
+    """
+    :return: value of every counter
+    :rtype: {str: int}
+    """
+    flush()
+    values = cache.get_many([KEY % name for name in COUNTERS])
+    return dict((name, values.get(KEY % name, 0)) for name in COUNTERS)
+
+
+def reset_counters():
+    with _lock:
+        _pending.clear()
+        _flushed_at[0] = time.time()
+    cache.delete_many([KEY % name for name in COUNTERS])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Downsampling of long price series for charts with Largest-Triangle-Three-Buckets (Sveinn
+Steinarsson, 2013): the first and the last point are kept, points between them are split into
+equal buckets and from every bucket the point making the largest triangle with the point kept
+from the previous bucket and the average of the next bucket is kept. Peaks and swings survive,
+flat stretches don't cost points.
+
+Buckets are processed in order (each depends on the point kept from the previous one), work
+inside a bucket and bucket averages are NumPy vectorized, so the Python loop runs threshold
+times however long the series is.
+"""
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """
+    Indices of points kept by LTTB
+    :param x: ascending x values (time)
+    :type x: np.ndarray
+    :param y: y values
+    :type y: np.ndarray
+    :param threshold: number of points to keep
+    :type threshold: int
+    :return: indices of kept points, ascending
+    :rtype: np.ndarray
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # threshold - 2 buckets between the first and the last point, edges[i]:edges[i + 1]
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    counts = np.diff(edges)
+    average_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    average_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    # the last bucket is followed by the last point
+    average_x = np.append(average_x[1:], x[n - 1])
+    average_y = np.append(average_y[1:], y[n - 1])
+
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs(
+            (x[a] - average_x[i]) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (average_y[i] - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Single writer market engine.
+
+Every event is traded by exactly one writer which keeps the event (quantities, B and prices) in
+memory and commits orders in micro-batches: one transaction and one event UPDATE per batch instead
+of one locked event per order. Web processes put orders on the inbound queue and wait for the
+answer on their own reply queue, so the engine runs in a single process (manage.py
+run_market_engine) and BetManager.execute_order uses it when settings.TRADING_MODE is 'engine'.
+Any other trading mode is a fallback to the regular BetManager path.
+
+The ledger, bets and cash are written in the same transaction as the event, so state can always
+be rebuilt from the Transaction ledger (MarketEngine.recover_event).
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from django.conf import settings
+from django.contrib import auth
+from django.db import connection, models, transaction
+from django.utils.module_loading import import_string
+from django.utils.translation import ugettext as _
+
+from bladepolska.redis_connection import RedisConnection
+from .exceptions import (
+    NonexistantEvent, DraftEvent, PriceMismatch, EventNotInProgress, UnknownOutcome,
+    InsufficientCash, InsufficientBets, InvalidQuantity, PriceVersionConflict, MarketEngineError,
+    MarketEngineTimeout
+)
+from .models import Bet, Event, Transaction
+
+
+logger = logging.getLogger(__name__)
+
+ORDERS_QUEUE = 'market_engine:orders'
+REPLY_QUEUE = 'market_engine:reply:%s'
+# replies nobody waits for anymore (client timed out) are removed after this many seconds
+REPLY_QUEUE_TTL = 60
+
+ORDER_ERRORS = dict((e.__name__, e) for e in (
+    NonexistantEvent, DraftEvent, PriceMismatch, EventNotInProgress,
+    UnknownOutcome, InsufficientCash, InsufficientBets, InvalidQuantity
+))
+
+
+class LocalQueue(object):
+    """
+    In-process queue with the RedisQueue interface, used in tests and when web server and
+    engine share one process.
+    """
+    queues = {}
+    lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        with self.lock:
+            self.queue = self.queues.setdefault(name, Queue())
+
+    def put(self, item, ttl=None):
+        # ttl is ignored, in-process queues are dropped with the process
+        self.queue.put(json.dumps(item))
+
+    def get(self, timeout=None):
+        try:
+            return json.loads(self.queue.get(timeout=timeout))
+        except Empty:
+            return None
+
+    def delete(self):
+        with self.lock:
+            self.queues.pop(self.name, None)
+
+
+class RedisQueue(object):
+    """
+    Queue shared between processes, stored in a redis list.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def put(self, item, ttl=None):
+        pipeline = RedisConnection.redis().pipeline()
+        pipeline.rpush(self.name, json.dumps(item))
+        if ttl is not None:
+            pipeline.expire(self.name, ttl)
+        pipeline.execute()
+
+    def get(self, timeout=None):
+        # redis blocks forever for timeout 0
+        item = RedisConnection.redis().blpop(self.name, timeout=max(1, int(timeout or 0)))
+        if item is None:
+            return None
+        return json.loads(item[1])
+
+    def delete(self):
+        RedisConnection.redis().delete(self.name)
+
+
+def get_queue_class():
+    return import_string(getattr(settings, 'MARKET_ENGINE_QUEUE', 'events.engine.RedisQueue'))
+
+
+class EventWriter(object):
+    """
+    The only writer of one event. Keeps the event in memory and saves it at the end of every
+    batch with a compare-and-swap on price_version, so trades made outside of the engine (or event
+    resolution) in the meantime are detected and the batch is replayed on fresh state.
+    """
+    def __init__(self, engine, event_id):
+        self.engine = engine
+        self.event_id = event_id
+        self.event = None
+        self.loaded_at = 0
+        self.orders = Queue()
+
+    def refresh_state(self):
+        """
+        Reload event if it was traded outside of the engine (only its price_version is read) or
+        if it's kept in memory longer than state_ttl seconds (eg. B or publication changes)
+        """
+        if self.event is not None and time.time() - self.loaded_at <= self.engine.state_ttl:
+            price_version = Event.objects.filter(id=self.event_id).\
+                values_list('price_version', flat=True).first()
+            if price_version == self.event.price_version:
+                return
+
+        self.event = Event.objects.filter(id=self.event_id).first()
+        self.loaded_at = time.time()
+
+    def next_batch(self, timeout=None):
+        try:
+            batch = [self.orders.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(batch) < self.engine.batch_size:
+            try:
+                batch.append(self.orders.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def execute_batch(self, batch):
+        """
+        Execute orders in one transaction and reply to every order
+        :param batch: orders
+        :type batch: [{}]
+        """
+        results = None
+        for attempt in range(self.engine.max_attempts):
+            self.refresh_state()
+            if self.event is None:
+                results = [self.error(NonexistantEvent(_("Requested event does not exist.")))
+                           for order in batch]
+                break
+
+            price_version = self.event.price_version
+            try:
+                with transaction.atomic():
+                    # users and bets are locked before the event, like in every other trade
+                    users, bets = self.lock_users_and_bets(batch)
+                    if not self.event.lock_if_price_version(price_version):
+                        raise PriceVersionConflict()
+                    results = [self.execute_order(order, users, bets) for order in batch]
+                    traded = self.event.price_version != price_version
+                    if traded and not self.event.save_if_price_version(price_version):
+                        raise PriceVersionConflict()
+                break
+            except PriceVersionConflict:
+                self.event = None
+            except Exception:
+                logger.exception("Market engine failed to execute batch of event #%d" %
+                                 self.event_id)
+                self.event = None
+                results = [self.error(MarketEngineError(_("Something went wrong.")))
+                           for order in batch]
+                break
+        else:
+            results = [self.error(PriceMismatch(_("Price has changed."), None))
+                       for order in batch]
+
+        for order, result in zip(batch, results):
+            self.engine.reply(order, result)
+
+    def lock_users_and_bets(self, batch):
+        """
+        Lock users of all orders in id order and their bets, so writers of different events
+        can't deadlock on users trading in both of them
+        :param batch: orders
+        :type batch: [{}]
+        :return: users by id and bets by user id and outcome
+        :rtype: ({int: UserProfile}, {(int, bool): Bet})
+        """
+        user_ids = sorted(set(order['user_id'] for order in batch))
+        users = dict(
+            (user.id, user) for user in
+            auth.get_user_model().objects.select_for_update().filter(id__in=user_ids).order_by('id')
+        )
+        bets = {}
+        for user_id, outcome in sorted(set((order['user_id'], order['outcome']) for order in batch
+                                           if order['outcome'] in (True, False))):
+            if user_id in users:
+                bets[(user_id, outcome)] = Bet.objects.get_bet_for_update(
+                    users[user_id], self.event, outcome
+                )
+        return users, bets
+
+    def execute_order(self, order, users, bets):
+        """
+        Execute one order on in-memory event; user and bet rows are already locked, see
+        lock_users_and_bets.
+        """
+        try:
+            if order['outcome'] not in (True, False):
+                raise UnknownOutcome()
+            Bet.objects.check_event_for_transaction(self.event)
+            with transaction.atomic():
+                user = users[order['user_id']]
+                bet = bets[(user.id, order['outcome'])]
+                trade = Bet.objects.buy_locked_bet if order['buy'] else Bet.objects.sell_locked_bet
+                user, event, bet = trade(
+                    user, self.event, bet, order['outcome'], order['price'], order['quantity'],
+                    order.get('price_limit'), save_event=False
+                )
+        except tuple(ORDER_ERRORS.values()) as e:
+            return self.error(e)
+
+        return {
+            'user_id': user.id,
+            'event_id': event.id,
+            'bet_id': bet.id,
+        }
+
+    @staticmethod
+    def error(e):
+        return {
+            'error': type(e).__name__,
+            'message': e.message,
+        }
+
+
+class MarketEngine(object):
+    """
+    Routes orders from the inbound queue to per-event writers
+    """
+    def __init__(self, queue_class=None, batch_size=50, state_ttl=5, max_attempts=3,
+                 idle_timeout=60):
+        self.queue_class = queue_class or get_queue_class()
+        self.orders = self.queue_class(ORDERS_QUEUE)
+        self.batch_size = batch_size
+        self.state_ttl = state_ttl
+        self.max_attempts = max_attempts
+        self.idle_timeout = idle_timeout
+        self.writers = {}
+        self.writers_lock = threading.Lock()
+        self.threads = {}
+        self.stopped = threading.Event()
+
+    def writer_for(self, event_id, start=False):
+        if event_id not in self.writers:
+            writer = EventWriter(self, event_id)
+            self.writers[event_id] = writer
+            if start:
+                thread = threading.Thread(target=self.run_writer, args=(writer,))
+                thread.daemon = True
+                self.threads[event_id] = thread
+                thread.start()
+        return self.writers[event_id]
+
+    def reply(self, order, result):
+        self.queue_class(order['reply_to']).put(result, ttl=REPLY_QUEUE_TTL)
+
+    def run(self):
+        """
+        Route orders until stop() is called; every traded event gets its own writer thread,
+        which stops after idle_timeout seconds without orders
+        """
+        while not self.stopped.is_set():
+            order = self.orders.get(timeout=1)
+            if order is not None:
+                # writer can't be dropped as idle between being found and getting the order
+                with self.writers_lock:
+                    self.writer_for(order['event_id'], start=True).orders.put(order)
+
+    def run_writer(self, writer):
+        idle_since = time.time()
+        while not self.stopped.is_set():
+            batch = writer.next_batch(timeout=1)
+            if batch:
+                writer.execute_batch(batch)
+                idle_since = time.time()
+            elif time.time() - idle_since > self.idle_timeout:
+                with self.writers_lock:
+                    if writer.orders.empty():
+                        del self.writers[writer.event_id]
+                        self.threads.pop(writer.event_id, None)
+                        break
+        connection.close()
+
+    def run_once(self):
+        """
+        Execute all waiting orders in the current thread, used in tests
+        """
+        while True:
+            order = self.orders.get(timeout=0)
+            if order is None:
+                break
+            self.writer_for(order['event_id']).orders.put(order)
+        for writer in self.writers.values():
+            batch = writer.next_batch(timeout=0)
+            while batch:
+                writer.execute_batch(batch)
+                batch = writer.next_batch(timeout=0)
+
+    def stop(self):
+        self.stopped.set()
+        with self.writers_lock:
+            threads = list(self.threads.values())
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def recover_event(event_id):
+        """
+        Rebuild event quantities and prices from the whole Transaction ledger, summed up by the
+        database. Snapshots are no starting point: they copy the event row, which may be the very
+        state being repaired, and they aren't written in the transactions of the trades.
+        :param event_id: event id
+        :type event_id: int
+        :return: True if event was out of sync with the ledger
+        :rtype: bool
+        """
+        with transaction.atomic():
+            event = Event.objects.select_for_update().get(id=event_id)
+            # every transaction, including ones made before users' account resets
+            ledger = Transaction._base_manager.filter(event_id=event_id).values('type').\
+                annotate(quantity=models.Sum('quantity'))
+            quantities = dict((row['type'], row['quantity']) for row in ledger)
+
+            Q_for = quantities.get(Transaction.BUY_YES, 0) - quantities.get(Transaction.SELL_YES, 0)
+            Q_against = quantities.get(Transaction.BUY_NO, 0) - \
+                quantities.get(Transaction.SELL_NO, 0)
+            if (event.Q_for, event.Q_against) == (Q_for, Q_against):
+                return False
+
+            logger.warning("Event #%d out of sync with ledger: Q_for %d->%d, Q_against %d->%d" % (
+                event_id, event.Q_for, Q_for, event.Q_against, Q_against
+            ))
+            event.Q_for = Q_for
+            event.Q_against = Q_against
+            event.price_version += 1
+            event.recalculate_prices()
+            event.save(force_update=True)
+            return True
+
+
+class MarketEngineClient(object):
+    """
+    Sends orders to MarketEngine and waits for the result
+    """
+    def __init__(self, queue_class=None, timeout=10):
+        self.queue_class = queue_class or get_queue_class()
+        self.orders = self.queue_class(ORDERS_QUEUE)
+        self.timeout = timeout
+
+    def submit(self, user, event_id, buy, bet_outcome, price, quantity=1, price_limit=None):
+        """
+        :return: name of the reply queue
+        :rtype: str
+        """
+        reply_to = REPLY_QUEUE % uuid.uuid4().hex
+        self.orders.put({
+            'user_id': user.id,
+            'event_id': int(event_id),
+            'buy': buy,
+            'outcome': bet_outcome,
+            'price': price,
+            'quantity': quantity,
+            'price_limit': price_limit,
+            'reply_to': reply_to,
+        })
+        return reply_to
+
+    def wait(self, reply_to, user, event_id, bet_outcome):
+        """
+        Wait for the order result. If the engine doesn't answer in time, the order may still be
+        executed later, MarketEngineTimeout is raised.
+        :return: trio
+        :rtype: (UserProfile, Event, Bet)
+        """
+        reply_queue = self.queue_class(reply_to)
+        result = reply_queue.get(timeout=self.timeout)
+        reply_queue.delete()
+        if result is None:
+            raise MarketEngineTimeout(_("Market engine is not responding."))
+
+        if 'error' in result:
+            raise self.build_error(result, user, event_id, bet_outcome)
+
+        return (
+            auth.get_user_model().objects.get(id=result['user_id']),
+            Event.objects.get(id=result['event_id']),
+            Bet.objects.get(id=result['bet_id']),
+        )
+
+    def execute_order(self, user, event_id, buy, bet_outcome, price, quantity=1, price_limit=None):
+        reply_to = self.submit(user, event_id, buy, bet_outcome, price, quantity, price_limit)
+        return self.wait(reply_to, user, event_id, bet_outcome)
+
+    @staticmethod
+    def build_error(result, user, event_id, bet_outcome):
+        error_class = ORDER_ERRORS.get(result['error'])
+        message = result['message']
+        if error_class is PriceMismatch:
+            return PriceMismatch(message, Event.objects.get(id=event_id))
+        if error_class is InsufficientCash:
+            return InsufficientCash(message, auth.get_user_model().objects.get(id=user.id))
+        if error_class is InsufficientBets:
+            bet, created = Bet.objects.get_or_create(
+                user_id=user.id, event_id=event_id, outcome=bet_outcome
+            )
+            return InsufficientBets(message, bet)
+        if error_class is None:
+            return MarketEngineError(message)
+        return error_class(message)
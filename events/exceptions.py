@@ -13,6 +13,10 @@ class PriceMismatch(Exception):
         self.updated_event = updated_event
 
 
+class PriceVersionConflict(Exception):
+    pass
+
+
 class EventNotInProgress(Exception):
     pass
 
@@ -33,3 +37,23 @@ class InsufficientBets(Exception):
         super(InsufficientBets, self).__init__(message)
 
         self.updated_bet = updated_bet
+
+
+class InvalidQuantity(Exception):
+    pass
+
+
+class InvalidLimitPrice(Exception):
+    pass
+
+
+class DuplicateIdempotencyKey(Exception):
+    pass
+
+
+class MarketEngineError(Exception):
+    pass
+
+
+class MarketEngineTimeout(MarketEngineError):
+    pass
@@ -1,14 +1,18 @@
 from datetime import timedelta
 
+from django.conf import settings
 from django.contrib import auth
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
 from django.db.models import Q
-from django.utils.timezone import now
+from django.utils.timezone import localtime, now
 from django.utils.translation import ugettext as _
 
+from bladepolska.sql import fetch_instances
+from . import charts, counters, pricing
 from .exceptions import (
     NonexistantEvent, DraftEvent, PriceMismatch, EventNotInProgress,
-    UnknownOutcome, InsufficientCash, InsufficientBets
+    UnknownOutcome, InsufficientCash, InsufficientBets, InvalidQuantity, PriceVersionConflict,
+    InvalidLimitPrice, MarketEngineError
 )
 # from vendor.Pubnub import Pubnub as PubNub
 
@@ -38,6 +42,51 @@ class EventManager(models.Manager):
         return self.ongoing_only_queryset().filter(is_featured=True).exclude(id__in=excluded)\
             .order_by('estimated_end_date')
 
+    def charts_for(self, events, days):
+        """
+        Charts of many events at once, for listing pages: cached charts are read with one
+        get_many and price days of the rest with one query. Charts are attached to events,
+        so Event.get_chart(days) doesn't touch the cache nor the database afterwards.
+        :param events: events on the page
+        :type events: [Event]
+        :param days: number of days in past on chart
+        :type days: int
+        :return: chart of every event by event id
+        :rtype: {int: {}}
+        """
+        events = [
+            event for event in events
+            if days not in getattr(event, 'attached_charts', {})
+        ]
+        if not events:
+            return {}
+        event_charts = charts.get_charts(
+            events, days, lambda missing: self._compute_charts(missing, days)
+        )
+        for event in events:
+            if not hasattr(event, 'attached_charts'):
+                event.attached_charts = {}
+            event.attached_charts[days] = event_charts[event.id]
+        return event_charts
+
+    def _compute_charts(self, events, days):
+        from .models import EventPriceDay
+
+        chart_ranges = [event.get_chart_range(days) for event in events]
+        # price day before the first chart day carries forward its last point
+        first_day = min(localtime(first_date).date() for first_date, last_date in chart_ranges) - \
+            timedelta(days=1)
+        last_day = max(localtime(last_date).date() for first_date, last_date in chart_ranges)
+        price_days = dict((event.id, []) for event in events)
+        for price_day in EventPriceDay.objects.filter(
+            event_id__in=list(price_days), day__gte=first_day, day__lte=last_day
+        ).order_by('event_id', 'day'):
+            price_days[price_day.event_id].append(price_day)
+
+        return dict(
+            (event.id, event.get_chart_points(days, price_days[event.id])) for event in events
+        )
+
     # TODO: what is this?
     #  def associate_people_with_events(self, user, events_list):
         #  from events.models import Bet
@@ -60,6 +109,61 @@ class EventManager(models.Manager):
 
         #  return result
 
+    def change_vote_counts(self, event_id, add_vote, remove_vote=None):
+        """
+        Increment counter of add_vote and decrement counter of remove_vote in one UPDATE with
+        F() expressions, so concurrent votes are never lost. Only events in progress are voted.
+
+        :param event_id: event id
+        :type event_id: int
+        :param add_vote: SolutionVote outcome
+        :type add_vote: int
+        :param remove_vote: SolutionVote outcome taken back or None
+        :type remove_vote: int
+        :return: vote_yes_count, vote_no_count, vote_cancel_count after the UPDATE
+        :rtype: (int, int, int)
+        """
+        from .models import SolutionVote
+
+        counters = {
+            SolutionVote.YES: 'vote_yes_count',
+            SolutionVote.NO: 'vote_no_count',
+            SolutionVote.CANCEL: 'vote_cancel_count',
+        }
+        changes = [(counters[add_vote], 1)]
+        if remove_vote is not None:
+            changes.append((counters[remove_vote], -1))
+
+        if connection.vendor == 'postgresql':
+            qn = connection.ops.quote_name
+            sql = """
+                UPDATE {event_table}
+                SET {changes}
+                WHERE id = %s AND outcome = %s
+                RETURNING vote_yes_count, vote_no_count, vote_cancel_count
+            """.format(
+                event_table=qn(self.model._meta.db_table),
+                changes=', '.join(
+                    '{0} = {0} + %s'.format(qn(counter)) for counter, change in changes
+                ),
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [change for counter, change in changes] +
+                               [event_id, self.model.IN_PROGRESS])
+                counts = cursor.fetchone()
+        else:
+            updated = self.filter(id=event_id, outcome=self.model.IN_PROGRESS).update(**dict(
+                (counter, models.F(counter) + change) for counter, change in changes
+            ))
+            counts = None
+            if updated:
+                counts = self.filter(id=event_id).\
+                    values_list('vote_yes_count', 'vote_no_count', 'vote_cancel_count').first()
+
+        if counts is None:
+            raise EventNotInProgress(_("Event is no longer in progress."))
+        return counts
+
     def vote_for_solution(self, user, event_id, outcome):
         """
         User votes for a solution of an event.
@@ -94,21 +198,9 @@ class EventManager(models.Manager):
             raise UnknownOutcome(_("Unknown outcome."))
 
         if created or vote.outcome != outcome_vote:
-            if vote.outcome != outcome_vote:
-                if vote.outcome == SolutionVote.YES:
-                    event.vote_yes_count -= 1
-                elif vote.outcome == SolutionVote.NO:
-                    event.vote_no_count -= 1
-                elif vote.outcome == SolutionVote.CANCEL:
-                    event.vote_cancel_count -= 1
-                event.save()
+            # previous vote of the user is taken back in the same UPDATE
+            event.vote(outcome_vote, vote.outcome)
             vote.outcome = outcome_vote
-            if outcome == 'YES':
-                event.vote_yes()
-            elif outcome == 'NO':
-                event.vote_no()
-            elif outcome == 'CANCEL':
-                event.vote_cancel()
             vote.save()
         return {
             'YES': event.vote_yes_count,
@@ -118,12 +210,26 @@ class EventManager(models.Manager):
 
 
 class BetManager(models.Manager):
+    MAX_ORDERS_IN_BASKET = 50
+    MAX_QUANTITY = 1000
+    OPTIMISTIC_MAX_ATTEMPTS = 5
+
     def get_user_bets_for_events(self, user, events):
         return self.filter(user__id=user.id, event__in=events)
 
+    def check_event_for_transaction(self, event):
+        """
+        Check if bets of event can be bought or sold
+        :param event: locked event
+        :type event: Event
+        """
+        if not event.is_in_progress:
+            raise EventNotInProgress(_("Event is no longer in progress."))
+
     def get_user_event_and_bet_for_update(self, user, event_id, bet_outcome):
         """
-        Return user event and bet info
+        Return user event and bet info. Rows are locked in the order used by every trade: user,
+        bet, event; trade_optimistic locks the event last with its guarded UPDATE.
         :param user:
         :param event_id:
         :param bet_outcome: True if bet on 'YES' and if 'NO' then False
@@ -133,26 +239,104 @@ class BetManager(models.Manager):
         """
 
         from events.models import Event
-        event = list(Event.objects.select_for_update().filter(id=event_id))
-        try:
-            event = event[0]
-        except IndexError:
-            raise NonexistantEvent(_("Requested event does not exist."))
-
-        if not event.is_in_progress:
-            raise EventNotInProgress(_("Event is no longer in progress."))
+        event = self.get_event(event_id)
 
         if bet_outcome not in (True, False, None):
             raise UnknownOutcome()
 
-        bet, created = self.get_or_create(user_id=user.id, event_id=event.id, outcome=bet_outcome)
-        bet = list(self.select_for_update().filter(id=bet.id))[0]
-
         user = list(auth.get_user_model().objects.select_for_update().filter(id=user.id))[0]
 
+        bet = self.get_bet_for_update(user, event, bet_outcome)
+
+        event = list(Event.objects.select_for_update().filter(id=event_id))[0]
+        self.check_event_for_transaction(event)
+
         return user, event, bet
 
-    def buy_a_bet(self, user, event_id, bet_outcome, price):
+    def get_event(self, event_id):
+        """
+        Read event without locking it
+        :param event_id: PK for event
+        :type event_id: int
+        :return: event in progress
+        :rtype: Event
+        """
+        from events.models import Event
+        event = Event.objects.filter(id=event_id).first()
+        if event is None:
+            raise NonexistantEvent(_("Requested event does not exist."))
+
+        self.check_event_for_transaction(event)
+        return event
+
+    def get_bet_for_update(self, user, event, bet_outcome):
+        """
+        Get or create user bet and lock it
+        :param user: logged user
+        :type user: UserProfile
+        :param event: locked event
+        :type event: Event
+        :param bet_outcome: True if bet on 'YES' and if 'NO' then False
+        :type bet_outcome: bool
+        :return: locked bet
+        :rtype: Bet
+        """
+        bet, created = self.get_or_create(user_id=user.id, event_id=event.id, outcome=bet_outcome)
+        return list(self.select_for_update().filter(id=bet.id))[0]
+
+    def check_quantity(self, quantity):
+        """
+        Bets count of one order must be from 1 to MAX_QUANTITY
+        :type quantity: int
+        """
+        if quantity < 1 or quantity > self.MAX_QUANTITY:
+            raise InvalidQuantity(_("Invalid quantity."))
+
+    def check_cash(self, user, event, bet_outcome, quantity):
+        """
+        Reject buying bets user can't afford before the order is priced: price only goes up
+        while buying, so quantity bets cost at least quantity times the current exact price
+        :param user: locked user
+        :type user: UserProfile
+        :param event: event
+        :type event: Event
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param quantity: bets count
+        :type quantity: int
+        """
+        if bet_outcome:
+            price = pricing.price(event.Q_for, event.Q_against, event.B)
+        else:
+            price = pricing.price(event.Q_against, event.Q_for, event.B)
+        if user.total_cash < quantity * event.PRIZE_FOR_WINNING * price - event.PRICE_PRECISION:
+            raise InsufficientCash(_("You don't have enough cash."), user)
+
+    def check_price(self, event, bet_outcome, direction, price, quantity=1, price_limit=None):
+        """
+        Check price requested by user against the price user is charged or paid. Without
+        price_limit the average price of quantity bets (Event.price_for_quantity, for one bet it's
+        the current price of event) must be equal to the requested price, with price_limit it must
+        not be worse than the limit (not higher for buy, not lower for sell).
+        :return: price of all bets, see Event.get_total_price
+        :rtype: int
+        """
+        from events.models import Bet
+
+        total = event.get_total_price(bet_outcome, direction, quantity)
+        if price_limit is None:
+            mismatch = price != event.price_for_quantity(bet_outcome, direction, quantity)
+        elif direction == Bet.BUY:
+            mismatch = total > price_limit * quantity
+        else:
+            mismatch = total < price_limit * quantity
+
+        if mismatch:
+            raise PriceMismatch(_("Price has changed."), event)
+
+        return total
+
+    def buy_a_bet(self, user, event_id, bet_outcome, price, quantity=1, price_limit=None):
         """
         Buy a bet
         NOTE: Always remember about wrapping this in a transaction!
@@ -165,38 +349,62 @@ class BetManager(models.Manager):
         :type bet_outcome: bool
         :param price: current price for bet
         :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
         :return: trio
         :rtype: (UserProfile, Event, Bet)
         """
-        from events.models import Transaction, Bet
-
         user, event, bet = self.get_user_event_and_bet_for_update(user, event_id, bet_outcome)
 
+        return self.buy_locked_bet(user, event, bet, bet_outcome, price, quantity, price_limit)
+
+    def buy_locked_bet(self, user, event, bet, bet_outcome, price, quantity=1, price_limit=None,
+                       save_event=True, price_version=None):
+        """
+        Buy a bet when user, event and bet are already locked for update
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: locked user
+        :type user: UserProfile
+        :param event: locked event
+        :type event: Event
+        :param bet: locked bet
+        :type bet: Bet
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param price: current price for bet
+        :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
+        :param save_event: False if caller saves event by itself
+        :type save_event: bool
+        :param price_version: if given, event isn't locked and it's saved only if it still has
+            this price_version (see Event.save_if_price_version), PriceVersionConflict otherwise
+        :type price_version: int
+        :return: trio
+        :rtype: (UserProfile, Event, Bet)
+        """
+        from events.models import Candle, Transaction, Bet
+
+        self.check_quantity(quantity)
+
         if not event.is_published:
             raise DraftEvent(_("Event is currently a draft."))
 
         # bet on 'YES' if bet_outcome is True else bet on 'NO'
         transaction_type = Transaction.BUY_YES if bet_outcome else Transaction.BUY_NO
 
-        requested_price = price
-        current_tx_price = event.price_for_outcome(bet_outcome, direction=Bet.BUY)
-        if requested_price != current_tx_price:
-            raise PriceMismatch(_("Price has changed."), event)
-
-        quantity = 1
-        bought_for_total = current_tx_price * quantity
+        self.check_cash(user, event, bet_outcome, quantity)
+        bought_for_total = self.check_price(event, bet_outcome, Bet.BUY, price, quantity,
+                                            price_limit)
 
         if user.total_cash < bought_for_total:
             raise InsufficientCash(_("You don't have enough cash."), user)
 
-        Transaction.objects.create(
-            user_id=user.id,
-            event_id=event.id,
-            type=transaction_type,
-            quantity=quantity,
-            price=current_tx_price * -1
-        )
-
         event_total_bought_price = (bet.bought_avg_price * bet.bought)
         after_bought_quantity = bet.bought + quantity
 
@@ -212,7 +420,12 @@ class BetManager(models.Manager):
         event.increment_quantity(bet_outcome, by_amount=quantity)
         """ Increment turnover only for buying bets """
         event.increment_turnover(quantity)
-        event.save(force_update=True)
+        self.save_traded_event(event, save_event, price_version)
+
+        # candles are locked after the event
+        tx = Transaction.objects.create_trade(user.id, event.id, transaction_type, quantity,
+                                              bought_for_total)
+        Candle.objects.record_trade(event.id, transaction_type, tx.price, tx.quantity, tx.date)
 
         # from canvas.models import ActivityLog
         # ActivityLog.objects.register_transaction_activity(user, transaction)
@@ -229,7 +442,7 @@ class BetManager(models.Manager):
 
         return user, event, bet
 
-    def sell_a_bet(self, user, event_id, bet_outcome, price):
+    def sell_a_bet(self, user, event_id, bet_outcome, price, quantity=1, price_limit=None):
         """
         Sell a bet
         NOTE: Always remember about wrapping this in a transaction!
@@ -242,38 +455,61 @@ class BetManager(models.Manager):
         :type bet_outcome: bool
         :param price: current price for bet
         :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
         :return: trio
         :rtype: (UserProfile, Event, Bet)
         """
-        from events.models import Transaction, Bet
-
         user, event, bet = self.get_user_event_and_bet_for_update(user, event_id, bet_outcome)
 
-        if not event.is_published:
-            raise DraftEvent(_("Event is currently a draft."))
+        return self.sell_locked_bet(user, event, bet, bet_outcome, price, quantity, price_limit)
 
-        requested_price = price
-        current_tx_price = event.price_for_outcome(bet_outcome, direction=Bet.SELL)
-        if requested_price != current_tx_price:
-            raise PriceMismatch(_("Price has changed."), event)
+    def sell_locked_bet(self, user, event, bet, bet_outcome, price, quantity=1, price_limit=None,
+                        save_event=True, price_version=None):
+        """
+        Sell a bet when user, event and bet are already locked for update
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: locked user
+        :type user: UserProfile
+        :param event: locked event
+        :type event: Event
+        :param bet: locked bet
+        :type bet: Bet
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param price: current price for bet
+        :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
+        :param save_event: False if caller saves event by itself
+        :type save_event: bool
+        :param price_version: if given, event isn't locked and it's saved only if it still has
+            this price_version (see Event.save_if_price_version), PriceVersionConflict otherwise
+        :type price_version: int
+        :return: trio
+        :rtype: (UserProfile, Event, Bet)
+        """
+        from events.models import Candle, Transaction, Bet
 
-        quantity = 1
-        sold_for_total = current_tx_price * quantity
+        self.check_quantity(quantity)
+
+        if not event.is_published:
+            raise DraftEvent(_("Event is currently a draft."))
 
         if bet.has < quantity:
             raise InsufficientBets(_("You don't have enough shares."), bet)
 
+        sold_for_total = self.check_price(event, bet_outcome, Bet.SELL, price, quantity,
+                                          price_limit)
+
         # bet on 'YES' if bet_outcome is True else bet on 'NO'
         transaction_type = Transaction.SELL_YES if bet_outcome else Transaction.SELL_NO
 
-        Transaction.objects.create(
-            user_id=user.id,
-            event_id=event.id,
-            type=transaction_type,
-            quantity=quantity,
-            price=current_tx_price
-        )
-
         event_total_sold_price = (bet.sold_avg_price * bet.sold)
         after_sold_quantity = bet.sold + quantity
 
@@ -288,7 +524,12 @@ class BetManager(models.Manager):
 
         event.increment_quantity(bet_outcome, by_amount=-quantity)
         event.increment_turnover(quantity)
-        event.save(force_update=True)
+        self.save_traded_event(event, save_event, price_version)
+
+        # candles are locked after the event
+        tx = Transaction.objects.create_trade(user.id, event.id, transaction_type, quantity,
+                                              sold_for_total)
+        Candle.objects.record_trade(event.id, transaction_type, tx.price, tx.quantity, tx.date)
 
         # from canvas.models import ActivityLog
         # ActivityLog.objects.register_transaction_activity(user, transaction)
@@ -305,6 +546,501 @@ class BetManager(models.Manager):
 
         return user, event, bet
 
+    def save_traded_event(self, event, save_event=True, price_version=None):
+        """
+        Save quantities and prices of traded event, see buy_locked_bet
+        """
+        if price_version is not None:
+            if not event.save_if_price_version(price_version):
+                raise PriceVersionConflict()
+        elif save_event:
+            event.save(force_update=True)
+
+    def execute_order(self, user, event_id, buy, bet_outcome, price, quantity=1, price_limit=None,
+                      mode=None):
+        """
+        Buy or sell a bet using trading mode, settings.TRADING_MODE by default:
+         - 'locking': lock event, bet and user rows and save every object (default),
+         - 'returning': guarded UPDATE ... RETURNING statements (PostgreSQL only),
+         - 'optimistic': compare-and-swap on event price_version instead of locking the event.
+         - 'engine': send the order to the single writer market engine (events.engine).
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: logged user
+        :type user: UserProfile
+        :param event_id: PK for current event
+        :type event_id: int
+        :param buy: True for buy, False for sell
+        :type buy: bool
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param price: current price for bet
+        :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
+        :param mode: trading mode
+        :type mode: str
+        :return: trio
+        :rtype: (UserProfile, Event, Bet)
+        """
+        counters.incr(counters.ORDERS)
+        if price_limit is not None:
+            counters.incr(counters.TOLERANT_ORDERS)
+        try:
+            return self._execute_order(user, event_id, buy, bet_outcome, price, quantity,
+                                       price_limit, mode)
+        except PriceMismatch:
+            counters.incr(counters.PRICE_MISMATCHES)
+            if price_limit is not None:
+                counters.incr(counters.TOLERANT_PRICE_MISMATCHES)
+            raise
+
+    def _execute_order(self, user, event_id, buy, bet_outcome, price, quantity, price_limit,
+                       mode):
+        mode = mode or getattr(settings, 'TRADING_MODE', 'locking')
+        if mode == 'returning' and connection.vendor == 'postgresql':
+            return self.trade_returning(user, event_id, buy, bet_outcome, price, quantity,
+                                        price_limit)
+        if mode == 'optimistic':
+            return self.trade_optimistic(user, event_id, buy, bet_outcome, price, quantity,
+                                         price_limit)
+        if mode == 'engine':
+            from .engine import MarketEngineClient
+            return MarketEngineClient().execute_order(
+                user, event_id, buy, bet_outcome, price, quantity, price_limit
+            )
+
+        if buy:
+            return self.buy_a_bet(user, event_id, bet_outcome, price, quantity, price_limit)
+        else:
+            return self.sell_a_bet(user, event_id, bet_outcome, price, quantity, price_limit)
+
+    def trade_optimistic(self, user, event_id, buy, bet_outcome, price, quantity=1,
+                         price_limit=None):
+        """
+        Buy or sell a bet without locking the event: event is read without a lock, user and bet
+        are locked (the same order as in every other trade, the event comes last) and the event
+        is saved with one UPDATE guarded by the price_version that was read. When that UPDATE
+        finds no row, the trade is rolled back to a savepoint and tried again, at most
+        OPTIMISTIC_MAX_ATTEMPTS times.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: logged user
+        :type user: UserProfile
+        :param event_id: PK for current event
+        :type event_id: int
+        :param buy: True for buy, False for sell
+        :type buy: bool
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param price: current price for bet
+        :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
+        :return: trio
+        :rtype: (UserProfile, Event, Bet)
+        """
+        from events.models import Event
+
+        for attempt in range(self.OPTIMISTIC_MAX_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return self._trade_optimistic_attempt(
+                        user, event_id, buy, bet_outcome, price, quantity, price_limit
+                    )
+            except PriceVersionConflict:
+                counters.incr(counters.OPTIMISTIC_RETRIES)
+                continue
+
+        raise PriceMismatch(_("Price has changed."), Event.objects.get(id=event_id))
+
+    def _trade_optimistic_attempt(self, user, event_id, buy, bet_outcome, price, quantity,
+                                  price_limit):
+        """
+        One attempt of trade_optimistic, raises PriceVersionConflict if event has changed.
+        """
+        event = self.get_event(event_id)
+
+        if bet_outcome not in (True, False):
+            raise UnknownOutcome()
+
+        user = list(auth.get_user_model().objects.select_for_update().filter(id=user.id))[0]
+        bet = self.get_bet_for_update(user, event, bet_outcome)
+
+        trade = self.buy_locked_bet if buy else self.sell_locked_bet
+        return trade(user, event, bet, bet_outcome, price, quantity, price_limit,
+                     price_version=event.price_version)
+
+    def trade_returning(self, user, event_id, buy, bet_outcome, price, quantity=1,
+                        price_limit=None):
+        """
+        Buy or sell a bet with guarded UPDATE ... RETURNING statements instead of locking and
+        saving every object. The event row is read without a lock; cash, ledger and bet are
+        changed first and then event quantities are saved, only if its price_version hasn't
+        changed meanwhile, so rows are locked in the same order as in every other trade.
+        3 statements, 4 when user buys a bet for the first time. On conflict the trade is rolled
+        back to a savepoint and tried again, like in trade_optimistic.
+        Raises the same exceptions as buy_a_bet and sell_a_bet. PostgreSQL only.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: logged user
+        :type user: UserProfile
+        :param event_id: PK for current event
+        :type event_id: int
+        :param buy: True for buy, False for sell
+        :type buy: bool
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param price: current price for bet
+        :type price: int
+        :param quantity: bets count
+        :type quantity: int
+        :param price_limit: worst accepted average price of one bet, replaces exact price check
+        :type price_limit: int
+        :return: trio
+        :rtype: (UserProfile, Event, Bet)
+        """
+        from events.models import Event
+
+        self.check_quantity(quantity)
+
+        for attempt in range(self.OPTIMISTIC_MAX_ATTEMPTS):
+            try:
+                with transaction.atomic():
+                    return self._trade_returning_attempt(
+                        user, event_id, buy, bet_outcome, price, quantity, price_limit
+                    )
+            except PriceVersionConflict:
+                counters.incr(counters.OPTIMISTIC_RETRIES)
+                continue
+
+        raise PriceMismatch(_("Price has changed."), Event.objects.get(id=event_id))
+
+    def _trade_returning_attempt(self, user, event_id, buy, bet_outcome, price, quantity,
+                                 price_limit):
+        """
+        One attempt of trade_returning, raises PriceVersionConflict if event has changed.
+        """
+        from events.models import Candle, Transaction
+
+        event = self.get_event(event_id)
+
+        if bet_outcome not in (True, False):
+            raise UnknownOutcome()
+
+        if not event.is_published:
+            raise DraftEvent(_("Event is currently a draft."))
+
+        if buy:
+            self.check_cash(user, event, bet_outcome, quantity)
+        total = self.check_price(event, bet_outcome, buy, price, quantity, price_limit)
+
+        if buy:
+            transaction_type = Transaction.BUY_YES if bet_outcome else Transaction.BUY_NO
+            user, tx = self._update_cash_returning(user, event, transaction_type, quantity,
+                                                   -total)
+            bet = self._update_bet_returning(user, event, bet_outcome, quantity, total)
+        else:
+            transaction_type = Transaction.SELL_YES if bet_outcome else Transaction.SELL_NO
+            user, tx = self._update_cash_returning(user, event, transaction_type, quantity,
+                                                   total)
+            bet = self._update_bet_returning(user, event, bet_outcome, -quantity, total)
+
+        price_version = event.price_version
+        event.increment_quantity(bet_outcome, by_amount=quantity if buy else -quantity)
+        event = self._update_event_returning(event, quantity, price_version)
+
+        # candles are locked after the event
+        Candle.objects.record_trade(event.id, transaction_type, tx.price, tx.quantity, tx.date)
+
+        return user, event, bet
+
+    def _update_cash_returning(self, user, event, transaction_type, quantity, total):
+        """
+        Change user cash and portfolio and write transaction to the ledger in one statement.
+        User must have enough cash to pay for bought bets (total < 0).
+        :return: user and transaction, which isn't read back from the database
+        :rtype: (UserProfile, Transaction)
+        """
+        user_model = auth.get_user_model()
+        from events.models import Transaction
+
+        price, price_remainder = Transaction.objects.unit_price(quantity, total)
+        qn = connection.ops.quote_name
+        sql = """
+            WITH cash AS (
+                UPDATE {user_table}
+                SET total_cash = total_cash + %(total)s,
+                    portfolio_value = portfolio_value - %(total)s
+                WHERE id = %(user_id)s AND total_cash + %(total)s >= 0
+                RETURNING *
+            ), ledger AS (
+                INSERT INTO {transaction_table} (
+                    user_id, event_id, type, date, quantity, price, price_remainder
+                )
+                SELECT cash.id, %(event_id)s, %(type)s, %(date)s, %(quantity)s, %(price)s,
+                    %(price_remainder)s
+                FROM cash
+            )
+            SELECT * FROM cash
+        """.format(
+            user_table=qn(user_model._meta.db_table),
+            transaction_table=qn(Transaction._meta.db_table),
+        )
+        params = {
+            'user_id': user.id,
+            'event_id': event.id,
+            'type': transaction_type,
+            'date': now(),
+            'total': total,
+            'quantity': quantity,
+            'price': price,
+            'price_remainder': price_remainder,
+        }
+        users = fetch_instances(user_model, sql, params)
+        if not users:
+            user = user_model.objects.get(id=user.id)
+            raise InsufficientCash(_("You don't have enough cash."), user)
+
+        return users[0], Transaction(
+            user_id=user.id, event_id=event.id, type=transaction_type, date=params['date'],
+            quantity=quantity, price=price, price_remainder=price_remainder
+        )
+
+    def _update_bet_returning(self, user, event, bet_outcome, quantity, total):
+        """
+        Add bought (quantity > 0) or remove sold (quantity < 0) bets. User must have enough bets
+        to sell them.
+        """
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        bet_id_sql = """
+            SELECT id FROM {table}
+            WHERE user_id = %(user_id)s AND event_id = %(event_id)s AND outcome = %(outcome)s
+            ORDER BY id LIMIT 1
+        """.format(table=table)
+        if quantity > 0:
+            sql = """
+                UPDATE {table}
+                SET bought_avg_price = (bought_avg_price * bought + %(total)s) /
+                        (bought + %(quantity)s),
+                    has = has + %(quantity)s,
+                    bought = bought + %(quantity)s
+                WHERE id = ({bet_id_sql})
+                RETURNING *
+            """.format(table=table, bet_id_sql=bet_id_sql)
+        else:
+            sql = """
+                UPDATE {table}
+                SET sold_avg_price = (sold_avg_price * sold + %(total)s) / (sold + %(quantity)s),
+                    has = has - %(quantity)s,
+                    sold = sold + %(quantity)s
+                WHERE id = ({bet_id_sql}) AND has >= %(quantity)s
+                RETURNING *
+            """.format(table=table, bet_id_sql=bet_id_sql)
+        params = {
+            'user_id': user.id,
+            'event_id': event.id,
+            'outcome': bet_outcome,
+            'quantity': abs(quantity),
+            'total': total,
+        }
+        bets = fetch_instances(self.model, sql, params)
+        if bets:
+            return bets[0]
+
+        if quantity < 0:
+            bet, created = self.get_or_create(
+                user_id=user.id, event_id=event.id, outcome=bet_outcome
+            )
+            raise InsufficientBets(_("You don't have enough shares."), bet)
+
+        sql = """
+            INSERT INTO {table} (
+                user_id, event_id, outcome, has, bought, sold, bought_avg_price, sold_avg_price,
+                rewarded_total, is_new_resolved
+            )
+            VALUES (
+                %(user_id)s, %(event_id)s, %(outcome)s, %(quantity)s, %(quantity)s, 0,
+                %(total)s / %(quantity)s::float, 0, 0, false
+            )
+            RETURNING *
+        """.format(table=table)
+        return fetch_instances(self.model, sql, params)[0]
+
+    def _update_event_returning(self, event, quantity, price_version):
+        """
+        Save new event quantities and prices if event is still in progress and nobody has changed
+        them since event had price_version.
+        """
+        qn = connection.ops.quote_name
+        fields = [
+            'Q_for', 'Q_against', 'current_buy_for_price', 'current_buy_against_price',
+            'current_sell_for_price', 'current_sell_against_price', 'price_version'
+        ]
+        sql = """
+            UPDATE {table}
+            SET {assignments}, turnover = turnover + %(quantity)s
+            WHERE id = %(event_id)s AND outcome = %(in_progress)s
+                AND price_version = %(old_price_version)s
+            RETURNING *
+        """.format(
+            table=qn(event._meta.db_table),
+            assignments=', '.join('{0} = %({1})s'.format(qn(f), f) for f in fields),
+        )
+        params = {f: getattr(event, f) for f in fields}
+        params.update({
+            'event_id': event.id,
+            'in_progress': event.IN_PROGRESS,
+            'quantity': quantity,
+            'old_price_version': price_version,
+        })
+        events = fetch_instances(type(event), sql, params)
+        if not events:
+            if type(event).objects.filter(id=event.id, outcome=event.IN_PROGRESS).exists():
+                raise PriceVersionConflict()
+            raise EventNotInProgress(_("Event is no longer in progress."))
+
+        return events[0]
+
+    def execute_orders(self, user, orders):
+        """
+        Buy or sell bets of many events at once.
+        The user is locked once, then bets and then events in id order, the same order as for
+        a single transaction, so baskets and single transactions can't deadlock.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: logged user
+        :type user: UserProfile
+        :param orders: orders with keys: event_id, buy, outcome, for_price, quantity and optional
+            price_limit
+        :type orders: [{}]
+        :return: user, changed events and changed bets
+        :rtype: (UserProfile, [Event], [Bet])
+        """
+        from events.models import Event
+
+        if not orders or len(orders) > self.MAX_ORDERS_IN_BASKET:
+            raise InvalidQuantity(_("Invalid number of orders."))
+
+        for order in orders:
+            if order['outcome'] not in (True, False):
+                raise UnknownOutcome()
+            self.check_quantity(order['quantity'])
+
+        event_ids = sorted(set(order['event_id'] for order in orders))
+        events = Event.objects.in_bulk(event_ids)
+        if len(events) != len(event_ids):
+            raise NonexistantEvent(_("Requested event does not exist."))
+
+        user = list(auth.get_user_model().objects.select_for_update().filter(id=user.id))[0]
+
+        bets = {}
+        for event_id, outcome in sorted(set((o['event_id'], o['outcome']) for o in orders)):
+            bets[(event_id, outcome)] = self.get_bet_for_update(user, events[event_id], outcome)
+
+        events = {
+            event.id: event
+            for event in Event.objects.select_for_update().filter(id__in=event_ids).order_by('id')
+        }
+        for event_id in event_ids:
+            self.check_event_for_transaction(events[event_id])
+
+        for order in orders:
+            event = events[order['event_id']]
+            bet_key = (event.id, order['outcome'])
+
+            if order['buy']:
+                execute = self.buy_locked_bet
+            else:
+                execute = self.sell_locked_bet
+            counters.incr(counters.ORDERS)
+            if order.get('price_limit') is not None:
+                counters.incr(counters.TOLERANT_ORDERS)
+            try:
+                execute(
+                    user, event, bets[bet_key], order['outcome'], order['for_price'],
+                    order['quantity'], order.get('price_limit')
+                )
+            except PriceMismatch:
+                counters.incr(counters.PRICE_MISMATCHES)
+                if order.get('price_limit') is not None:
+                    counters.incr(counters.TOLERANT_PRICE_MISMATCHES)
+                raise
+
+        return (
+            user,
+            [events[event_id] for event_id in event_ids],
+            [bets[bet_key] for bet_key in sorted(bets)],
+        )
+
+    def settle_bets(self, event, winning_outcome, after_id=0, limit=None):
+        """
+        Pay prizes for winning bets of finished event with a few set-based statements: one
+        EVENT_WON_PRIZE transaction per winning bet (also for bets with has=0, like it always
+        was), bulk UPDATEs of cash and reputation of users and two UPDATEs of bets. Bets are
+        settled in id order, limit bets with id greater than after_id at once.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param event: finished event
+        :type event: Event
+        :param winning_outcome: True if YES won, False if NO won
+        :type winning_outcome: bool
+        :param after_id: last settled bet id
+        :type after_id: int
+        :param limit: bets count, all bets if None
+        :type limit: int
+        :return: number of settled bets and id of the last one (None if there were no bets)
+        :rtype: (int, int)
+        """
+        from events.models import Transaction
+
+        user_model = auth.get_user_model()
+        prize = event.PRIZE_FOR_WINNING
+        bets = self.filter(event=event, id__gt=after_id).order_by('id').\
+            values_list('id', 'user_id', 'outcome', 'has')
+        if limit is not None:
+            bets = bets[:limit]
+        bets = list(bets)
+        if not bets:
+            return 0, None
+
+        bet_ids = [bet_id for bet_id, user_id, outcome, has in bets]
+        winning_bets = [
+            (bet_id, user_id, has) for bet_id, user_id, outcome, has in bets
+            if outcome == winning_outcome
+        ]
+
+        Transaction.objects.bulk_create([
+            Transaction(
+                user_id=user_id,
+                event=event,
+                type=Transaction.EVENT_WON_PRIZE,
+                quantity=has,
+                price=prize
+            )
+            for bet_id, user_id, has in winning_bets
+        ])
+
+        prizes = {}
+        for bet_id, user_id, has in winning_bets:
+            if has:
+                prizes[user_id] = prizes.get(user_id, 0) + has * prize
+        user_model.objects.add_cash(prizes)
+        user_model.objects.recalculate_reputation(
+            user_model.objects.filter(id__in=set(bet[1] for bet in bets))
+        )
+
+        self.filter(id__in=[bet_id for bet_id, user_id, has in winning_bets]).\
+            update(rewarded_total=models.F('has') * prize)
+        self.filter(id__in=bet_ids).update(is_new_resolved=True)
+
+        return len(bets), bet_ids[-1]
+
     def get_in_progress(self):
         """
         Get bets in progress and attribute has > 0, that bets are in user
@@ -334,6 +1070,494 @@ class BetManager(models.Manager):
             order_by('-event__end_date').select_related('event')
 
 
+class EventSettlementManager(models.Manager):
+    """
+    Settlement of finished and cancelled events in chunks, one transaction per chunk
+    """
+    CHUNK_SIZE = 500
+
+    def start(self, event):
+        """
+        Remember that event has to be settled; event outcome must be already set.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param event: finished or cancelled event
+        :type event: Event
+        :return: settlement
+        :rtype: EventSettlement
+        """
+        from events.models import Bet, Transaction
+
+        if event.outcome == event.CANCELLED:
+            total = Transaction.objects.filter(event=event, type__in=Transaction.BUY_SELL_TYPES).\
+                values('user_id').distinct().count()
+        else:
+            total = Bet.objects.filter(event=event).count()
+        return self.create(event=event, outcome=event.outcome, total=total)
+
+    def settle_chunk(self, settlement_id):
+        """
+        Settle next chunk of bets (or users for cancelled event) in its own transaction and save
+        the checkpoint in the same transaction, so settlement can be continued after a crash.
+        Settlement row is locked, so chunks of one event are never settled concurrently.
+
+        :param settlement_id: settlement id
+        :type settlement_id: int
+        :return: settlement after the chunk
+        :rtype: EventSettlement
+        """
+        from events.models import Bet, Transaction
+
+        with transaction.atomic():
+            settlement = self.select_for_update().select_related('event').get(id=settlement_id)
+            if settlement.status == self.model.DONE:
+                return settlement
+
+            event = settlement.event
+            if settlement.outcome == event.CANCELLED:
+                count, last_id = Transaction.objects.refund_cancelled_event(
+                    event, settlement.last_id, self.CHUNK_SIZE
+                )
+            else:
+                count, last_id = Bet.objects.settle_bets(
+                    event, event.BOOLEAN_OUTCOME_DICT[settlement.outcome], settlement.last_id,
+                    self.CHUNK_SIZE
+                )
+
+            if last_id is None:
+                settlement.status = self.model.DONE
+                settlement.finished_date = now()
+            else:
+                settlement.last_id = last_id
+                settlement.processed += count
+            settlement.save()
+
+        return settlement
+
+    def settle(self, settlement_id):
+        """
+        Settle all chunks
+        :return: settled settlement
+        :rtype: EventSettlement
+        """
+        settlement = self.settle_chunk(settlement_id)
+        while settlement.status != self.model.DONE:
+            settlement = self.settle_chunk(settlement_id)
+        return settlement
+
+    def pending(self):
+        return self.filter(status=self.model.PENDING)
+
+
+class LimitOrderManager(models.Manager):
+    """
+    Resting limit orders, executed through BetManager when the price reaches their limit
+    """
+    MATCHING_BATCH_SIZE = 50
+    MAX_MATCHING_BATCHES = 20
+
+    def place(self, user, event_id, buy, bet_outcome, quantity, limit_price):
+        """
+        Place limit order; it's executed at once if the limit is already marketable (by the
+        caller, with match_event after commit).
+
+        :param user: logged user
+        :type user: UserProfile
+        :param event_id: PK for current event
+        :type event_id: int
+        :param buy: True for buy, False for sell
+        :type buy: bool
+        :param bet_outcome: True if YES, False if NO
+        :type bet_outcome: bool
+        :param quantity: bets count
+        :type quantity: int
+        :param limit_price: highest average price for buy, lowest for sell
+        :type limit_price: int
+        :return: limit order
+        :rtype: LimitOrder
+        """
+        from events.models import Bet, Event
+
+        if bet_outcome not in (Bet.YES, Bet.NO):
+            raise UnknownOutcome()
+        Bet.objects.check_quantity(quantity)
+        if not 0 < limit_price < Event.PRIZE_FOR_WINNING:
+            raise InvalidLimitPrice(_("Invalid limit price."))
+
+        event = Event.objects.filter(id=event_id).first()
+        if event is None:
+            raise NonexistantEvent(_("Requested event does not exist."))
+        Bet.objects.check_event_for_transaction(event)
+
+        return self.create(
+            user=user, event=event, outcome=bet_outcome, direction=buy, quantity=quantity,
+            limit_price=limit_price
+        )
+
+    def cancel(self, user, limit_order_id):
+        """
+        Cancel open limit order of the user
+        :return: True if order was cancelled
+        :rtype: bool
+        """
+        return self.filter(id=limit_order_id, user=user, status=self.model.OPEN).\
+            update(status=self.model.CANCELLED) > 0
+
+    def marketable(self, event):
+        """
+        Open orders which limit is reached by the exact current price of one bet, oldest first.
+        Orders are executed at the average price of their whole quantity, which is never better
+        than that, so these are the only orders which may be executed. Every alternative is a
+        range scan of (event, outcome, direction, limit_price) index.
+        :param event: event with current quantities
+        :type event: Event
+        :return: limit orders
+        :rtype: QuerySet[LimitOrder]
+        """
+        from events.models import Bet
+
+        marketable = Q()
+        for outcome in (Bet.YES, Bet.NO):
+            if outcome == Bet.YES:
+                price = pricing.price(event.Q_for, event.Q_against, event.B)
+            else:
+                price = pricing.price(event.Q_against, event.Q_for, event.B)
+            price *= event.PRIZE_FOR_WINNING
+            marketable |= Q(
+                outcome=outcome, direction=Bet.BUY, limit_price__gte=price - event.PRICE_PRECISION
+            )
+            marketable |= Q(
+                outcome=outcome, direction=Bet.SELL,
+                limit_price__lte=price + event.PRICE_PRECISION
+            )
+        return self.filter(marketable, event=event, status=self.model.OPEN).\
+            select_related('user').order_by('created_date', 'id')
+
+    def match_event(self, event_id):
+        """
+        Execute marketable orders of the event in batches, one transaction per order. Every
+        executed order moves the price, so after a batch with executed orders all marketable
+        orders are read again. Orders which can't be executed at the current price (the average
+        price of their quantity is beyond the limit) are skipped and matching goes on with the
+        next ones, until no order is left or MAX_MATCHING_BATCHES is reached.
+        Call it after the trade that changed prices is committed.
+
+        :param event_id: PK for event
+        :type event_id: int
+        :return: executed orders
+        :rtype: [LimitOrder]
+        """
+        from events.models import Event
+
+        filled = []
+        skipped = set()
+        for i in range(self.MAX_MATCHING_BATCHES):
+            event = Event.objects.filter(id=event_id).first()
+            if event is None:
+                break
+            if not event.is_in_progress:
+                self.filter(event=event, status=self.model.OPEN).\
+                    update(status=self.model.CANCELLED)
+                break
+            batch = list(
+                self.marketable(event).exclude(id__in=skipped)[:self.MATCHING_BATCH_SIZE]
+            )
+            if not batch:
+                break
+            executed = []
+            for order in batch:
+                if self.execute(order):
+                    executed.append(order)
+                else:
+                    skipped.add(order.id)
+
+            filled.extend(order for order in executed if order.status == self.model.FILLED)
+            if executed:
+                # prices have moved, skipped orders may be executed now
+                skipped = set()
+
+        return filled
+
+    def execute(self, limit_order):
+        """
+        Execute one limit order in its own transaction with Bet.objects.execute_order, so the
+        configured trading mode is used. The order row is locked first, so it can't be executed
+        twice by concurrent matchers or cancelled meanwhile. Order stays open if the average price
+        for its quantity is beyond the limit and it's rejected if user can't afford it anymore.
+        :return: True if order is not open anymore
+        :rtype: bool
+        """
+        from events.models import Bet
+
+        with transaction.atomic():
+            if not list(self.select_for_update().filter(
+                id=limit_order.id, status=self.model.OPEN
+            ).values_list('id', flat=True)):
+                # executed or cancelled by someone else
+                return True
+            try:
+                with transaction.atomic():
+                    Bet.objects.execute_order(
+                        limit_order.user, limit_order.event_id, limit_order.direction,
+                        limit_order.outcome, limit_order.limit_price, limit_order.quantity,
+                        limit_order.limit_price
+                    )
+            except PriceMismatch:
+                return False
+            except (InsufficientCash, InsufficientBets, DraftEvent, EventNotInProgress,
+                    MarketEngineError):
+                limit_order.status = self.model.REJECTED
+            else:
+                limit_order.status = self.model.FILLED
+                limit_order.executed_date = now()
+            limit_order.save(update_fields=['status', 'executed_date'])
+        return True
+
+
+class IdempotencyKeyManager(models.Manager):
+    """
+    Idempotency-Key headers of trading requests with the response they got
+    """
+    TTL = timedelta(days=1)
+
+    def expired(self):
+        return self.filter(created_date__lt=now() - self.TTL)
+
+    def get_response(self, user, key):
+        """
+        Response of the request with the same key, if it was committed and is not expired
+        :return: json response or None
+        :rtype: str
+        """
+        return self.filter(user=user, key=key, created_date__gte=now() - self.TTL).\
+            exclude(response='').values_list('response', flat=True).first()
+
+    def claim(self, user, key):
+        """
+        Store the key before the request is executed. Concurrent request with the same key
+        waits on the unique index until the transaction which stores the key ends.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param user: logged user
+        :type user: UserProfile
+        :param key: Idempotency-Key header
+        :type key: str
+        :return: key to save response in, None if the key is already used
+        :rtype: IdempotencyKey
+        """
+        self.expired().filter(user=user, key=key).delete()
+        try:
+            with transaction.atomic():
+                return self.create(user=user, key=key)
+        except IntegrityError:
+            return None
+
+
+class EventPriceDayManager(models.Manager):
+    """
+    Packed daily price history of events, see EventPriceDay
+    """
+    def append_points(self, events, moment=None):
+        """
+        Append the current point of every event to its price day; on PostgreSQL it's a single
+        INSERT ... ON CONFLICT concatenating packed points in the database.
+        :param events: events to append
+        :type events: QuerySet
+        :param moment: time of the point, now by default
+        :type moment: datetime
+        :return: number of appended points
+        :rtype: int
+        """
+        moment = localtime(moment or now())
+        day = moment.date()
+        minute = moment.hour * 60 + moment.minute
+        fields = self.model.POINT_FIELDS
+        rows = events.order_by().values_list('id', *fields)
+
+        if connection.vendor == 'postgresql':
+            qn = connection.ops.quote_name
+            meta = self.model._meta
+            table = qn(meta.db_table)
+            event = qn(meta.get_field('event').column)
+            values = ['value%d' % i for i in range(len(fields))]
+            select_sql, select_params = rows.query.sql_with_params()
+            sql = (
+                "INSERT INTO %(table)s (%(event)s, day, points)"
+                " SELECT events.id, %%s, int4send(%%s::integer) || %(packed)s"
+                " FROM (%(select)s) AS events (id, %(values)s)"
+                " ON CONFLICT (%(event)s, day)"
+                " DO UPDATE SET points = %(table)s.points || EXCLUDED.points"
+            ) % {
+                'table': table,
+                'event': event,
+                'packed': ' || '.join('int4send(events.%s)' % value for value in values),
+                'select': select_sql,
+                'values': ', '.join(values),
+            }
+            with connection.cursor() as cursor:
+                cursor.execute(sql, (day, minute) + tuple(select_params))
+                return cursor.rowcount
+
+        rows = list(rows)
+        points_by_event = dict(
+            (row[0], {day: [(minute,) + tuple(row[1:])]}) for row in rows
+        )
+        self.merge_points(points_by_event)
+        return len(rows)
+
+    def merge_points(self, points_by_event):
+        """
+        Add points to price days of events, keeping the stored point if there is one from the
+        same minute
+        :param points_by_event: {event_id: {day: [(minute, POINT_FIELDS values...)]}}
+        :type points_by_event: {}
+        """
+        days = set(day for points_by_day in points_by_event.values() for day in points_by_day)
+        existing = dict(
+            ((price_day.event_id, price_day.day), price_day)
+            for price_day in self.filter(event_id__in=list(points_by_event), day__in=days)
+        )
+        new_price_days = []
+        for event_id, points_by_day in points_by_event.items():
+            for day, points in points_by_day.items():
+                price_day = existing.get((event_id, day))
+                if price_day is None:
+                    new_price_days.append(self.model(
+                        event_id=event_id, day=day, points=self.model.pack_points(points)
+                    ))
+                    continue
+                merged = dict((point[0], point) for point in points)
+                merged.update(
+                    (point[0], point) for point in self.model.unpack_points(price_day.points)
+                )
+                price_day.points = self.model.pack_points(
+                    [merged[minute] for minute in sorted(merged)]
+                )
+                price_day.save(update_fields=['points'])
+        self.bulk_create(new_price_days)
+
+
+class CandleManager(models.Manager):
+    """
+    OHLC candles of events, see Candle
+    """
+    def record_trade(self, event_id, transaction_type, price, quantity, date):
+        """
+        Add an order to candles of every interval as one trade; on PostgreSQL it's a single
+        INSERT ... ON CONFLICT. Trades lock the event row, so candles of one event are never
+        updated concurrently.
+        NOTE: Always remember about wrapping this in a transaction with the trade!
+        :param event_id: PK of traded event
+        :type event_id: int
+        :param transaction_type: one of Transaction.BUY_SELL_TYPES
+        :type transaction_type: int
+        :param price: average unit price of the order, negative for bought bets
+        :type price: int
+        :param quantity: bets count of the whole order
+        :type quantity: int
+        :param date: time of the transaction
+        :type date: datetime
+        """
+        yes_price = self.model.get_yes_price(transaction_type, price)
+        starts = [
+            (interval, self.model.get_start(date, interval)) for interval in self.model.INTERVALS
+        ]
+
+        if connection.vendor == 'postgresql':
+            qn = connection.ops.quote_name
+            meta = self.model._meta
+            table = qn(meta.db_table)
+            columns = [
+                qn(meta.get_field(name).column) for name in (
+                    'event', 'interval', 'start', 'open', 'high', 'low', 'close', 'volume',
+                    'trades'
+                )
+            ]
+            event, interval, start, open_, high, low, close, volume, trades = columns
+            sql = (
+                "INSERT INTO %(table)s (%(columns)s) VALUES %(values)s"
+                " ON CONFLICT (%(event)s, %(interval)s, %(start)s) DO UPDATE SET"
+                " %(high)s = GREATEST(%(table)s.%(high)s, EXCLUDED.%(high)s),"
+                " %(low)s = LEAST(%(table)s.%(low)s, EXCLUDED.%(low)s),"
+                " %(close)s = EXCLUDED.%(close)s,"
+                " %(volume)s = %(table)s.%(volume)s + EXCLUDED.%(volume)s,"
+                " %(trades)s = %(table)s.%(trades)s + EXCLUDED.%(trades)s"
+            ) % {
+                'table': table,
+                'columns': ', '.join(columns),
+                'values': ', '.join(['(%s)' % ', '.join(['%s'] * len(columns))] * len(starts)),
+                'event': event,
+                'interval': interval,
+                'start': start,
+                'high': high,
+                'low': low,
+                'close': close,
+                'volume': volume,
+                'trades': trades,
+            }
+            params = []
+            for interval_seconds, start_date in starts:
+                params.extend([
+                    event_id, interval_seconds, start_date, yes_price, yes_price, yes_price,
+                    yes_price, quantity, 1
+                ])
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+            return
+
+        for interval_seconds, start_date in starts:
+            candle, created = self.get_or_create(
+                event_id=event_id, interval=interval_seconds, start=start_date, defaults={
+                    'open': yes_price,
+                    'high': yes_price,
+                    'low': yes_price,
+                    'close': yes_price,
+                    'volume': quantity,
+                    'trades': 1,
+                }
+            )
+            if not created:
+                candle.high = max(candle.high, yes_price)
+                candle.low = min(candle.low, yes_price)
+                candle.close = yes_price
+                candle.volume += quantity
+                candle.trades += 1
+                candle.save(update_fields=['high', 'low', 'close', 'volume', 'trades'])
+
+    def rebuild(self, event_id, trades):
+        """
+        Replace candles of an event with candles of given trades
+        :param event_id: PK of the event
+        :type event_id: int
+        :param trades: (date, type, price, quantity) of trades sorted by date, may be an iterator
+        :type trades: iterable
+        :return: number of created candles
+        :rtype: int
+        """
+        candles = {}
+        for date, transaction_type, price, quantity in trades:
+            yes_price = self.model.get_yes_price(transaction_type, price)
+            for interval in self.model.INTERVALS:
+                key = (interval, self.model.get_start(date, interval))
+                candle = candles.get(key)
+                if candle is None:
+                    candles[key] = self.model(
+                        event_id=event_id, interval=interval, start=key[1], open=yes_price,
+                        high=yes_price, low=yes_price, close=yes_price, volume=quantity, trades=1
+                    )
+                    continue
+                candle.high = max(candle.high, yes_price)
+                candle.low = min(candle.low, yes_price)
+                candle.close = yes_price
+                candle.volume += quantity
+                candle.trades += 1
+
+        with transaction.atomic():
+            self.filter(event_id=event_id).delete()
+            self.bulk_create(candles.values(), batch_size=1000)
+        return len(candles)
+
+
 class TransactionManager(models.Manager):
     """
     Transactions Manager between user and event
@@ -344,6 +1568,97 @@ class TransactionManager(models.Manager):
         """
         super(TransactionManager, self).__init__()
 
+    @staticmethod
+    def unit_price(quantity, total):
+        """
+        Unit price of quantity bets traded for total. Unit price is an integer, so when total
+        isn't divisible by quantity, the rest is kept in price_remainder of the same ledger row;
+        quantity * price + price_remainder is always total.
+        :param quantity: bets count
+        :type quantity: int
+        :param total: price of all bets, negative for bought bets
+        :type total: int
+        :return: price and price_remainder, both with the sign of total
+        :rtype: (int, int)
+        """
+        sign = -1 if total < 0 else 1
+        price, remainder = divmod(abs(total), quantity)
+        return sign * price, sign * remainder
+
+    def create_trade(self, user_id, event_id, transaction_type, quantity, total):
+        """
+        Book bought or sold bets in the ledger, one row for the whole order, see unit_price
+        :param transaction_type: one of BUY_SELL_TYPES
+        :type transaction_type: int
+        :param quantity: bets count
+        :type quantity: int
+        :param total: price of all bets
+        :type total: int
+        :return: created transaction
+        :rtype: Transaction
+        """
+        # bought bets have negative price in transactions
+        sign = -1 if transaction_type in self.model.BUY_TYPES else 1
+        price, price_remainder = self.unit_price(quantity, sign * total)
+        return self.create(
+            user_id=user_id,
+            event_id=event_id,
+            type=transaction_type,
+            quantity=quantity,
+            price=price,
+            price_remainder=price_remainder
+        )
+
+    def refund_cancelled_event(self, event, after_id=0, limit=None):
+        """
+        Give back to users of cancelled event what they paid for its bets (or take what they
+        earned). Refund of every user is summed up by the database, cash is changed with bulk
+        UPDATEs and the ledger with one bulk INSERT. Users are refunded in id order, limit users
+        with id greater than after_id at once.
+        NOTE: Always remember about wrapping this in a transaction!
+
+        :param event: cancelled event
+        :type event: Event
+        :param after_id: last refunded user id
+        :type after_id: int
+        :param limit: users count, all users if None
+        :type limit: int
+        :return: number of users and id of the last one (None if there were no users)
+        :rtype: (int, int)
+        """
+        user_model = auth.get_user_model()
+        # for transaction type BUY the price is below 0 that means refund should be
+        # other side. For BUY (buy is always -) refund should be (+) (EVENT_CANCELLED_REFUND)
+        # but for BUY and SELL with profit refund should be (-) (EVENT_CANCELLED_DEBIT)
+        rows = self.filter(event=event, type__in=self.model.BUY_SELL_TYPES, user_id__gt=after_id).\
+            values('user_id').annotate(paid=models.Sum(
+                models.F('quantity') * models.F('price') + models.F('price_remainder')
+            )).order_by('user_id')
+        if limit is not None:
+            rows = rows[:limit]
+        rows = list(rows)
+        if not rows:
+            return 0, None
+
+        refunds = dict(
+            (row['user_id'], -row['paid']) for row in rows if row['paid']
+        )
+        user_model.objects.add_cash(refunds)
+        user_model.objects.recalculate_reputation(user_model.objects.filter(id__in=refunds))
+
+        self.bulk_create([
+            self.model(
+                user_id=user_id,
+                event=event,
+                type=self.model.EVENT_CANCELLED_REFUND if refund > 0 else
+                self.model.EVENT_CANCELLED_DEBIT,
+                price=refund
+            )
+            for user_id, refund in sorted(refunds.items())
+        ])
+
+        return len(rows), rows[-1]['user_id']
+
     def get_user_transactions_after_reset(self, user):
         return self.model.objects.filter(user=user, date__gte=user.reset_date).order_by('-date')\
             .select_related('event')
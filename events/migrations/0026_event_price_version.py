@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0025_auto_20170601_0239'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='price_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='wersja ceny'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('events', '0026_event_price_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LimitOrder',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('outcome', models.BooleanField(verbose_name='zakład na TAK', choices=[(True, 'udziały na TAK'), (False, 'udziały na NIE')])),
+                ('direction', models.BooleanField(verbose_name='kupno', choices=[(True, 'kupno'), (False, 'sprzedaż')])),
+                ('quantity', models.PositiveIntegerField(default=1, verbose_name='ilość')),
+                ('limit_price', models.PositiveIntegerField(verbose_name='limit ceny')),
+                ('status', models.PositiveIntegerField(default=1, verbose_name='status', choices=[(1, 'oczekujące'), (2, 'zrealizowane'), (3, 'anulowane'), (4, 'odrzucone')])),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='data utworzenia')),
+                ('executed_date', models.DateTimeField(null=True, verbose_name='data realizacji', blank=True)),
+                ('event', models.ForeignKey(related_query_name='limit_order', related_name='limit_orders', to='events.Event')),
+                ('user', models.ForeignKey(related_query_name='limit_order', related_name='limit_orders', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_date'],
+                'verbose_name': 'zlecenie z limitem ceny',
+                'verbose_name_plural': 'zlecenia z limitem ceny',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='limitorder',
+            index_together=set([('event', 'outcome', 'direction', 'limit_price')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0028_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventSettlement',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('outcome', models.PositiveIntegerField(verbose_name='rozstrzygnięcie', choices=[(1, 'w trakcie'), (2, 'anulowane'), (3, 'rozstrzygnięte na TAK'), (4, 'rozstrzygnięte na NIE')])),
+                ('status', models.PositiveIntegerField(default=1, verbose_name='status', choices=[(1, 'w trakcie'), (2, 'zakończone')])),
+                ('last_id', models.PositiveIntegerField(default=0, verbose_name='ostatnie rozliczone id')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='rozliczone')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='do rozliczenia')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='data utworzenia')),
+                ('finished_date', models.DateTimeField(null=True, verbose_name='data zakończenia', blank=True)),
+                ('event', models.OneToOneField(related_name='settlement', to='events.Event')),
+            ],
+            options={
+                'verbose_name': 'rozliczenie wydarzenia',
+                'verbose_name_plural': 'rozliczenia wydarzeń',
+            },
+        ),
+    ]
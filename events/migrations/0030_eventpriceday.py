@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0029_eventsettlement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventPriceDay',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField(verbose_name='dzień')),
+                ('points', models.BinaryField(default=b'', verbose_name='punkty')),
+                ('event', models.ForeignKey(related_name='price_days', to='events.Event')),
+            ],
+            options={
+                'ordering': ['day'],
+                'verbose_name': 'historia cen wydarzenia',
+                'verbose_name_plural': 'historie cen wydarzeń',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='eventpriceday',
+            unique_together=set([('event', 'day')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0030_eventpriceday'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='eventsnapshot',
+            index_together=set([('snapshot_of', 'created_at')]),
+        ),
+    ]
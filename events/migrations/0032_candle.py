@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0031_eventsnapshot_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Candle',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('interval', models.PositiveIntegerField(verbose_name='interwał', choices=[(300, '5 minut'), (3600, 'godzina'), (86400, 'dzień')])),
+                ('start', models.DateTimeField(verbose_name='początek')),
+                ('open', models.IntegerField(verbose_name='otwarcie')),
+                ('high', models.IntegerField(verbose_name='maksimum')),
+                ('low', models.IntegerField(verbose_name='minimum')),
+                ('close', models.IntegerField(verbose_name='zamknięcie')),
+                ('volume', models.PositiveIntegerField(default=0, verbose_name='wolumen')),
+                ('trades', models.PositiveIntegerField(default=0, verbose_name='liczba transakcji')),
+                ('event', models.ForeignKey(related_name='candles', to='events.Event')),
+            ],
+            options={
+                'ordering': ['start'],
+                'verbose_name': 'świeca',
+                'verbose_name_plural': 'świece',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='candle',
+            unique_together=set([('event', 'interval', 'start')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0032_candle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='price_remainder',
+            field=models.IntegerField(default=0, verbose_name='reszta ceny'),
+        ),
+    ]
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime, time, timedelta
 import json
 import logging
+import math
+import struct
 
 from dateutil.relativedelta import relativedelta
-from math import exp
+import numpy as np
 from unidecode import unidecode
 
 from django.conf import settings
@@ -14,8 +17,12 @@ from django.template.defaultfilters import slugify
 from django.utils import timezone
 from django.utils.translation import ugettext as _
 
+from . import charts, downsampling, pricing
 from .exceptions import UnknownOutcome, EventNotInProgress
-from .managers import EventManager, BetManager, TransactionManager
+from .managers import (
+    EventManager, BetManager, TransactionManager, LimitOrderManager, IdempotencyKeyManager,
+    EventSettlementManager, EventPriceDayManager, CandleManager
+)
 
 from bladepolska.snapshots import SnapshotAddon
 from bladepolska.site import current_domain
@@ -61,10 +68,14 @@ class Event(EsIndexable, models.Model):
     BEGIN_PRICE = 50
     FACTOR_B = 10
     PRIZE_FOR_WINNING = 100
+    # float error allowed when exact prices are rounded up or down
+    PRICE_PRECISION = 1e-9
 
     CHART_MARGIN = 3
     EVENT_SMALL_CHART_DAYS = 14
     EVENT_BIG_CHART_DAYS = 28
+    TICK_CHART_POINTS = 300
+    TICK_CHART_MAX_POINTS = 1000
 
     SMALL_IMAGE_WIDTH = 340
     SMALL_IMAGE_HEIGHT = 250
@@ -79,7 +90,7 @@ class Event(EsIndexable, models.Model):
         'Q_for',
         'Q_against',
         'B'
-    ])
+    ], only_on_change=True, hourly_retention_days=30, partition_by_month=True)
 
     title = models.CharField(u'tytuł wydarzenia', max_length=255)
     short_title = models.CharField(
@@ -156,6 +167,8 @@ class Event(EsIndexable, models.Model):
     Q_for = models.IntegerField(u'zakładów na TAK', default=0)
     Q_against = models.IntegerField(u'zakładów na NIE', default=0)
     turnover = models.IntegerField(u'obrót', default=0, db_index=True)
+    # incremented on every quantity change, used by optimistic trading
+    price_version = models.PositiveIntegerField(u'wersja ceny', default=0)
 
     absolute_price_change = models.IntegerField(
         u'zmiana ceny (wartość absolutna)', db_index=True, default=0
@@ -254,7 +267,7 @@ class Event(EsIndexable, models.Model):
         :return: chart points of EVENT_SMALL_CHART_DAYS days
         :rtype: {int, [], []}
         """
-        return self.__get_chart_points(self.EVENT_SMALL_CHART_DAYS)
+        return self.get_chart(self.EVENT_SMALL_CHART_DAYS)
 
     def get_event_big_chart(self):
         """
@@ -262,7 +275,73 @@ class Event(EsIndexable, models.Model):
         :return: chart points of EVENT_BIG_CHART_DAYS days
         :rtype: {int, [], []}
         """
-        return self.__get_chart_points(self.EVENT_BIG_CHART_DAYS)
+        return self.get_chart(self.EVENT_BIG_CHART_DAYS)
+
+    def get_chart(self, days):
+        """
+        Chart points cached until the next snapshot, see events.charts
+        :param days: number of days in past on chart
+        :type days: int
+        :rtype: {int, [], []}
+        """
+        # attached by EventManager.charts_for
+        attached_charts = getattr(self, 'attached_charts', {})
+        if days in attached_charts:
+            return attached_charts[days]
+        return charts.get_charts(
+            [self], days, lambda events: {self.id: self.get_chart_points(days)}
+        )[self.id]
+
+    def get_chart_range(self, days):
+        """
+        :param days: number of days in past on chart
+        :type days: int
+        :return: first and last date on chart
+        :rtype: (datetime, datetime)
+        """
+        last_date = self.end_date if self.end_date else timezone.now()
+        return max(last_date - relativedelta(days=days), self.created_date), last_date
+
+    def get_tick_chart(self, start=None, end=None, points=TICK_CHART_POINTS):
+        """
+        Intraday chart of YES price after every trade, downsampled with LTTB (see
+        events.downsampling) to at most points points.
+        :param start: from, event creation by default
+        :type start: datetime
+        :param end: to, event end or now by default
+        :type end: datetime
+        :param points: max number of points
+        :type points: int
+        :return: event id, times of points (ms since epoch) and YES prices
+        :rtype: {int, [], []}
+        """
+        transactions = Transaction._base_manager.filter(
+            event_id=self.id,
+            type__in=Transaction.BUY_SELL_TYPES,
+            date__gte=start or self.created_date,
+            date__lte=end or self.end_date or timezone.now(),
+        ).order_by('date', 'id').values_list('date', 'type', 'price')
+
+        rows = list(transactions)
+        if not rows:
+            return {'id': self.id, 'times': [], 'points': []}
+        dates, types, prices = zip(*rows)
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        times = np.array([(date - epoch).total_seconds() * 1000 for date in dates])
+        # bought bets have negative price in transactions
+        prices = np.abs(np.array(prices))
+        types = np.array(types)
+        yes_prices = np.where(
+            (types == Transaction.BUY_YES) | (types == Transaction.SELL_YES),
+            prices,
+            self.PRIZE_FOR_WINNING - prices
+        )
+        selected = downsampling.lttb(times, yes_prices, points)
+        return {
+            'id': self.id,
+            'times': np.round(times[selected]).astype(np.int64).tolist(),
+            'points': yes_prices[selected].tolist(),
+        }
 
     def get_JSON_small_chart(self):
         return json.dumps(self.get_event_small_chart())
@@ -270,28 +349,51 @@ class Event(EsIndexable, models.Model):
     def get_JSON_big_chart(self):
         return json.dumps(self.get_event_big_chart())
 
-    @transaction.atomic
-    def __get_chart_points(self, days):
+    def get_chart_points(self, days, price_days=None):
         """
         Get last transactions price for every day;
         :param days: number of days in past on chart
         :type days: int
+        :param price_days: price days of the event in chart range, with the day before, sorted
+            by day; read from the database if not given
+        :type price_days: [EventPriceDay]
         :return: chart points
         :rtype: {int, [], []}
         """
-        last_date = self.end_date if self.end_date else timezone.now()
-        first_date = max(last_date - relativedelta(days=days), self.created_date)
+        first_date, last_date = self.get_chart_range(days)
         labels = []
         points = []
 
-        snapshots = self.snapshots.filter(
-            snapshot_of_id=self.id,
-            created_at__gte=first_date,
-            created_at__lte=last_date,
-            created_at__hour=0
-        ).order_by('created_at')
+        # one point per day from the midnight hourly snapshot, read from packed price days;
+        # the latest point taken before the end of midnight hour is carried forward
+        first_day = timezone.localtime(first_date).date()
+        last_day = timezone.localtime(last_date).date()
+        if price_days is None:
+            with transaction.atomic():
+                price_days = list(self.price_days.filter(day__gte=first_day, day__lte=last_day))
+                previous_day = self.price_days.filter(day__lt=first_day).order_by('-day').first()
+            if previous_day is not None:
+                price_days.insert(0, previous_day)
+        price_points = [
+            (created_at, values[0])
+            for price_day in price_days
+            for created_at, values in price_day.get_points()
+        ]
+
+        chart_snapshots = []
+        day = first_day
+        price = None
+        while day <= last_day:
+            midnight = timezone.make_aware(datetime.combine(day, time()))
+            day += relativedelta(days=1)
+            while price_points and price_points[0][0] < midnight + relativedelta(hours=1):
+                price = price_points.pop(0)[1]
+            if price is None or midnight + relativedelta(hours=1) <= first_date or \
+                    midnight > last_date:
+                continue
+            chart_snapshots.append((midnight.astimezone(timezone.utc), price))
 
-        additional_points = min(days - len(snapshots), Event.CHART_MARGIN)
+        additional_points = min(days - len(chart_snapshots), Event.CHART_MARGIN)
         step_date = first_date - relativedelta(days=additional_points)
 
         for point in range(additional_points):
@@ -299,9 +401,8 @@ class Event(EsIndexable, models.Model):
             step_date += relativedelta(days=1)
             points.append(Event.BEGIN_PRICE)
 
-        for snapshot in snapshots:
-            labels.append(u'{0} {1}'.format(snapshot.created_at.day, _(snapshot.created_at.strftime('%B'))))
-            last_price = snapshot.current_buy_for_price
+        for date, last_price in chart_snapshots:
+            labels.append(u'{0} {1}'.format(date.day, _(date.strftime('%B'))))
             points.append(last_price)
 
         return {
@@ -403,9 +504,63 @@ class Event(EsIndexable, models.Model):
 
         attr = Bet.BET_OUTCOMES_TO_QUANTITY_ATTR[outcome]
         setattr(self, attr, getattr(self, attr) + by_amount)
+        self.price_version += 1
 
         self.recalculate_prices()
 
+    def quote(self, outcome, direction=True, quantity=1):
+        """
+        Price of quantity bets if they were bought or sold right now; reads the event as it is,
+        without locking it.
+        :param outcome: event outcome - YES or NO; True for YES
+        :type outcome: bool
+        :param direction: True for buy, False for sell
+        :type direction: bool
+        :param quantity: bets count
+        :type quantity: int
+        :return: average price of one bet and total price
+        :rtype: {}
+        """
+        return {
+            'event_id': self.id,
+            'outcome': outcome,
+            'buy': direction,
+            'quantity': quantity,
+            'price': self.price_for_quantity(outcome, direction, quantity),
+            'total': self.get_total_price(outcome, direction, quantity),
+            'price_version': self.price_version,
+        }
+
+    def lock_if_price_version(self, price_version):
+        """
+        Lock event row only if nobody has changed quantities and prices since event had
+        price_version
+        :param price_version: price_version read before the change
+        :type price_version: int
+        :return: True if locked
+        :rtype: bool
+        """
+        return bool(list(Event.objects.select_for_update().filter(
+            id=self.id, price_version=price_version, outcome=Event.IN_PROGRESS
+        ).values_list('id', flat=True)))
+
+    def save_if_price_version(self, price_version):
+        """
+        Save quantities and prices only if nobody has changed them since event had price_version
+        :param price_version: price_version read before the change
+        :type price_version: int
+        :return: True if saved
+        :rtype: bool
+        """
+        fields = [
+            'Q_for', 'Q_against', 'current_buy_for_price', 'current_buy_against_price',
+            'current_sell_for_price', 'current_sell_against_price', 'turnover', 'price_version'
+        ]
+        updated = Event.objects.filter(
+            id=self.id, price_version=price_version, outcome=Event.IN_PROGRESS
+        ).update(**{field: getattr(self, field) for field in fields})
+        return updated == 1
+
     def increment_turnover(self, by_amount):
         """
         Turnover increases +1 when operation buy or sell occurs
@@ -414,54 +569,127 @@ class Event(EsIndexable, models.Model):
         """
         self.turnover += by_amount
 
+    @classmethod
+    def calculate_prices(cls, Q_for, Q_against, B):
+        """
+        Calculate 4 prices for given event quantities: price of one bet bought or sold right
+        now, exactly what the user is charged or paid for it, see round_total
+        :param Q_for: bets for YES
+        :type Q_for: int
+        :param Q_against: bets for NO
+        :type Q_against: int
+        :param B: event constant B
+        :type B: float
+        :return: prices keyed by event price attribute
+        :rtype: {}
+        """
+        prices = {}
+        for (direction, outcome), attr in Bet.BET_OUTCOMES_TO_PRICE_ATTR.items():
+            moved = 1 if direction == Bet.BUY else -1
+            cost = pricing.cost_to_move(Q_for, Q_against, B, outcome, moved)
+            prices[attr] = cls.round_total(cls.PRIZE_FOR_WINNING * cost, direction)
+        return prices
+
     def recalculate_prices(self):
         """
         Calculate 4 prices for event
         """
-        factor = 100.
-
-        B = self.B
+        prices = self.calculate_prices(self.Q_for, self.Q_against, self.B)
+        for attr, price in prices.items():
+            setattr(self, attr, price)
 
-        Q_for = self.Q_for
-        Q_against = self.Q_against
-        Q_for_sell = max(0, Q_for - 1)
-        Q_against_sell = max(0, Q_against - 1)
+    @classmethod
+    def round_total(cls, cost, direction):
+        """
+        Cash is an integer, so exact price is rounded against the user (up for buy, down for
+        sell); bets bought one by one and sold at once (or the other way round) never give
+        a risk-free profit.
+        :param cost: exact cost of bets, negative for sell
+        :type cost: float
+        :param direction: True for buy, False for sell
+        :type direction: bool
+        :return: price paid for bought bets or received for sold bets
+        :rtype: int
+        """
+        if direction == Bet.BUY:
+            return int(math.ceil(cost - cls.PRICE_PRECISION))
+        return int(math.floor(-cost + cls.PRICE_PRECISION))
 
-        e_for_buy = exp(Q_for / B)
-        e_against_buy = exp(Q_against / B)
-        e_for_sell = exp(Q_for_sell / B)
-        e_against_sell = exp(Q_against_sell / B)
+    def get_total_price(self, outcome, direction=True, quantity=1):
+        """
+        Price of quantity bets bought or sold in one transaction: exact LMSR cost difference
+        C(q + quantity) - C(q), see events.pricing, rounded with round_total. Total price of one
+        bet is the current price of event.
+        :param outcome: event outcome - YES or NO; True for YES
+        :type outcome: bool
+        :param direction: True for buy, False for sell
+        :type direction: bool
+        :param quantity: bets count
+        :type quantity: int
+        :return: price of all bets
+        :rtype: int
+        """
+        if (direction, outcome) not in Bet.BET_OUTCOMES_TO_PRICE_ATTR:
+            raise UnknownOutcome()
 
-        buy_for_price = e_for_buy / float(e_for_buy + e_against_buy)
-        buy_against_price = e_against_buy / float(e_for_buy + e_against_buy)
-        sell_for_price = e_for_sell / float(e_for_sell + e_against_buy)
-        sell_against_price = e_against_sell / float(e_for_buy + e_against_sell)
+        moved = quantity if direction == Bet.BUY else -quantity
+        cost = self.PRIZE_FOR_WINNING * pricing.cost_to_move(
+            self.Q_for, self.Q_against, self.B, outcome, moved
+        )
+        return self.round_total(cost, direction)
 
-        self.current_buy_for_price = round(factor * buy_for_price, 0)
-        self.current_buy_against_price = round(factor * buy_against_price, 0)
-        self.current_sell_for_price = round(factor * sell_for_price, 0)
-        self.current_sell_against_price = round(factor * sell_against_price, 0)
+    def price_for_quantity(self, outcome, direction=True, quantity=1):
+        """
+        Average price of one bet when buying or selling quantity bets in one transaction,
+        rounded against the user like get_total_price
+        :param outcome: event outcome - YES or NO; True for YES
+        :type outcome: bool
+        :param direction: True for buy, False for sell
+        :type direction: bool
+        :param quantity: bets count
+        :type quantity: int
+        :return: price of one bet
+        :rtype: int
+        """
+        total = self.get_total_price(outcome, direction, quantity)
+        if direction == Bet.BUY:
+            return -(-total // quantity)
+        return total // quantity
 
     def vote_yes(self):
-        self.vote_yes_count += 1
-        if self.vote_yes_count >= config.VOICES_TO_RESOLVE:
-            self.finish_yes()
-        self.save()
-        return self.vote_yes_count
+        return self.vote(SolutionVote.YES)
 
     def vote_no(self):
-        self.vote_no_count += 1
-        if self.vote_no_count >= config.VOICES_TO_RESOLVE:
-            self.finish_no()
-        self.save()
-        return self.vote_no_count
+        return self.vote(SolutionVote.NO)
 
     def vote_cancel(self):
-        self.vote_cancel_count += 1
-        if self.vote_cancel_count >= config.VOICES_TO_RESOLVE:
-            self.cancel()
-        self.save()
-        return self.vote_cancel_count
+        return self.vote(SolutionVote.CANCEL)
+
+    @transaction.atomic
+    def vote(self, outcome_vote, previous_vote=None):
+        """
+        Add a vote for solution with one UPDATE of vote counters; the event is resolved when the
+        counter returned by the UPDATE reaches VOICES_TO_RESOLVE. Bets of event resolved by votes
+        are settled after commit by events.tasks.settle_event.
+        :param outcome_vote: SolutionVote outcome
+        :type outcome_vote: int
+        :param previous_vote: SolutionVote outcome taken back by the same user or None
+        :type previous_vote: int
+        :return: votes count of outcome_vote
+        :rtype: int
+        """
+        self.vote_yes_count, self.vote_no_count, self.vote_cancel_count = \
+            Event.objects.change_vote_counts(self.id, outcome_vote, previous_vote)
+
+        finish = {
+            SolutionVote.YES: (self.vote_yes_count, self.finish_yes),
+            SolutionVote.NO: (self.vote_no_count, self.finish_no),
+            SolutionVote.CANCEL: (self.vote_cancel_count, self.cancel),
+        }
+        count, finish_with_outcome = finish[outcome_vote]
+        if count >= config.VOICES_TO_RESOLVE:
+            finish_with_outcome(settle=False)
+        return count
 
     @transaction.atomic
     def __finish(self, outcome):
@@ -474,81 +702,61 @@ class Event(EsIndexable, models.Model):
             raise EventNotInProgress("Wydarzenie zostało już rozwiązane.")
         self.outcome = outcome
         self.end_date = timezone.now()
-        self.save()
+        # limit orders are locked before the event, like by LimitOrderManager.execute
+        self.limit_orders.filter(status=LimitOrder.OPEN).update(status=LimitOrder.CANCELLED)
+        # vote counters and prices may be stale
+        self.save(update_fields=['outcome', 'end_date'])
+        # chart ends at end_date
+        charts.invalidate(self.id)
 
     @transaction.atomic
-    def __finish_with_outcome(self, outcome):
+    def __finish_with_outcome(self, outcome, settle=True):
         """
         main finish status
         :param outcome: outcome status; EVENT_OUTCOME_CHOICES
         :type outcome: Choices
+        :param settle: settle bets now, otherwise events.tasks.settle_event has to be run after
+            commit
+        :type settle: bool
+        :return: settlement
+        :rtype: EventSettlement
         """
         self.__finish(outcome)
-        for bet in Bet.objects.filter(event=self):
-            if bet.outcome == self.BOOLEAN_OUTCOME_DICT[outcome]:
-                bet.rewarded_total = self.PRIZE_FOR_WINNING * bet.has
-                bet.user.total_cash += bet.rewarded_total
-                Transaction.objects.create(
-                    user=bet.user,
-                    event=self,
-                    type=Transaction.EVENT_WON_PRIZE,
-                    quantity=bet.has,
-                    price=self.PRIZE_FOR_WINNING
-                )
-            # TODO: tutaj wallet change
-            # bet.user.portfolio_value -= bet.has
-            bet.user.save()
-            # This cause display event in "latest outcome"
-            bet.is_new_resolved = True
-            bet.save()
+        # is_new_resolved of bets cause display event in "latest outcome"
+        # TODO: tutaj wallet change
+        settlement = EventSettlement.objects.start(self)
+        if settle:
+            settlement = EventSettlement.objects.settle(settlement.id)
+        return settlement
 
     @transaction.atomic
-    def finish_yes(self):
+    def finish_yes(self, settle=True):
         """
         if event is finished on YES then prizes calculate
         """
-        self.__finish_with_outcome(self.FINISHED_YES)
+        return self.__finish_with_outcome(self.FINISHED_YES, settle)
 
     @transaction.atomic
-    def finish_no(self):
+    def finish_no(self, settle=True):
         """
         if event is finished on NO then prizes calculate
         """
-        self.__finish_with_outcome(self.FINISHED_NO)
+        return self.__finish_with_outcome(self.FINISHED_NO, settle)
 
     @transaction.atomic
-    def cancel(self):
+    def cancel(self, settle=True):
         """
         refund for users on cancel event.
         """
-        self.__finish(self.CANCELLED)
-        users = {}
-        for t in Transaction.objects.filter(event=self).order_by('user'):
-            if t.user not in users:
-                users.update({
-                    t.user: 0
-                })
-            if t.type in Transaction.BUY_SELL_TYPES:
-                # for transaction type BUY the price is below 0 that means refund should be
-                # other side. For BUY (buy is always -) refund should be (+) (EVENT_CANCELLED_REFUND)
-                # but for BUY and SELL with profit refund should be (-) (EVENT_CANCELLED_DEBIT)
-                users[t.user] -= t.quantity * t.price
-
-        for user, refund in users.iteritems():
-            if refund == 0:
-                continue
-            user.total_cash += refund
-            user.save()
-            if refund > 0:
-                transaction_type = Transaction.EVENT_CANCELLED_REFUND
-            else:
-                transaction_type = Transaction.EVENT_CANCELLED_DEBIT
-            Transaction.objects.create(
-                user=user,
-                event=self,
-                type=transaction_type,
-                price=refund
-            )
+        return self.__finish_with_outcome(self.CANCELLED, settle)
+
+    @property
+    def is_settling(self):
+        """
+        Event is finished, but prizes or refunds are still being paid
+        :rtype: bool
+        """
+        return EventSettlement.objects.pending().filter(event=self).exists()
 
 
 class SolutionVote(models.Model):
@@ -772,6 +980,8 @@ class Transaction(models.Model):
     date = models.DateTimeField('data', auto_now_add=True)
     quantity = models.PositiveIntegerField(u'ilość', default=1)
     price = models.IntegerField(u'cena jednostkowa', default=0, null=False)
+    # total price isn't always divisible by quantity, see TransactionManager.unit_price
+    price_remainder = models.IntegerField(u'reszta ceny', default=0)
 
     objects = TransactionManager()
 
@@ -785,7 +995,7 @@ class Transaction(models.Model):
         :return: total amount
         :rtype: int
         """
-        return self.quantity * self.price
+        return self.quantity * self.price + self.price_remainder
 
     @property
     def total_wallet(self):
@@ -794,4 +1004,280 @@ class Transaction(models.Model):
         :return: total amount
         :rtype: int
         """
-        return -1 * self.quantity * self.price
+        return -1 * (self.quantity * self.price + self.price_remainder)
+
+
+class LimitOrder(models.Model):
+    """
+    Resting order to buy or sell bets as soon as price reaches the limit. Orders are executed by
+    LimitOrderManager.match_event after every trade of the event.
+    """
+    class Meta:
+        ordering = ['-created_date']
+        verbose_name = 'zlecenie z limitem ceny'
+        verbose_name_plural = 'zlecenia z limitem ceny'
+        index_together = [
+            ('event', 'outcome', 'direction', 'limit_price'),
+        ]
+
+    OPEN, FILLED, CANCELLED, REJECTED = range(1, 5)
+    STATUS_CHOICES = (
+        (OPEN, u'oczekujące'),
+        (FILLED, u'zrealizowane'),
+        (CANCELLED, u'anulowane'),
+        (REJECTED, u'odrzucone'),
+    )
+
+    DIRECTION_CHOICES = (
+        (Bet.BUY, u'kupno'),
+        (Bet.SELL, u'sprzedaż'),
+    )
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='limit_orders', related_query_name='limit_order'
+    )
+    event = models.ForeignKey(Event, related_name='limit_orders', related_query_name='limit_order')
+    outcome = models.BooleanField(u'zakład na TAK', choices=Bet.BET_OUTCOME_CHOICES)
+    direction = models.BooleanField(u'kupno', choices=DIRECTION_CHOICES)
+    quantity = models.PositiveIntegerField(u'ilość', default=1)
+    limit_price = models.PositiveIntegerField(u'limit ceny')
+    status = models.PositiveIntegerField(u'status', choices=STATUS_CHOICES, default=OPEN)
+    created_date = models.DateTimeField(u'data utworzenia', auto_now_add=True)
+    executed_date = models.DateTimeField(u'data realizacji', null=True, blank=True)
+
+    objects = LimitOrderManager()
+
+    def __unicode__(self):
+        return u'%s %d %s po %d przez %s' % (
+            self.get_direction_display(), self.quantity, self.get_outcome_display(),
+            self.limit_price, self.user
+        )
+
+    @property
+    def limit_order_dict(self):
+        """
+        Dictionary with limit order values
+        :return: limit order values
+        :rtype: {}
+        """
+        return {
+            'limit_order_id': self.id,
+            'event_id': self.event_id,
+            'outcome': self.outcome,
+            'buy': self.direction,
+            'quantity': self.quantity,
+            'limit_price': self.limit_price,
+            'status': self.status,
+        }
+
+
+class IdempotencyKey(models.Model):
+    """
+    Idempotency-Key of a trading request; retried request gets the stored response instead of
+    being executed again. Keys expire after IdempotencyKeyManager.TTL.
+    """
+    class Meta:
+        unique_together = ('user', 'key')
+        verbose_name = 'klucz idempotentności'
+        verbose_name_plural = 'klucze idempotentności'
+
+    KEY_MAX_LENGTH = 64
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+')
+    key = models.CharField(u'klucz', max_length=KEY_MAX_LENGTH)
+    response = models.TextField(u'odpowiedź', blank=True, default='')
+    created_date = models.DateTimeField(u'data utworzenia', auto_now_add=True, db_index=True)
+
+    objects = IdempotencyKeyManager()
+
+    def __unicode__(self):
+        return u'%s przez %s' % (self.key, self.user)
+
+
+class EventSettlement(models.Model):
+    """
+    Paying out prizes (or refunds) of a finished (or cancelled) event. Event outcome is set at
+    once, bets are settled later in chunks by events.tasks.settle_event; last_id is the
+    checkpoint: id of the last settled bet, or user for cancelled event.
+    """
+    class Meta:
+        verbose_name = 'rozliczenie wydarzenia'
+        verbose_name_plural = 'rozliczenia wydarzeń'
+
+    PENDING, DONE = range(1, 3)
+    STATUS_CHOICES = (
+        (PENDING, u'w trakcie'),
+        (DONE, u'zakończone'),
+    )
+
+    event = models.OneToOneField(Event, related_name='settlement')
+    outcome = models.PositiveIntegerField(u'rozstrzygnięcie', choices=Event.EVENT_OUTCOME_CHOICES)
+    status = models.PositiveIntegerField(u'status', choices=STATUS_CHOICES, default=PENDING)
+    last_id = models.PositiveIntegerField(u'ostatnie rozliczone id', default=0)
+    processed = models.PositiveIntegerField(u'rozliczone', default=0)
+    total = models.PositiveIntegerField(u'do rozliczenia', default=0)
+    created_date = models.DateTimeField(u'data utworzenia', auto_now_add=True)
+    finished_date = models.DateTimeField(u'data zakończenia', null=True, blank=True)
+
+    objects = EventSettlementManager()
+
+    def __unicode__(self):
+        return u'rozliczenie %s' % self.event
+
+    @property
+    def progress(self):
+        """
+        Settled percent
+        :rtype: int
+        """
+        if self.status == self.DONE:
+            return 100
+        if not self.total:
+            return 0
+        return min(99, 100 * self.processed // self.total)
+
+    @property
+    def settlement_dict(self):
+        """
+        Dictionary with settlement values
+        :return: settlement values
+        :rtype: {}
+        """
+        return {
+            'event_id': self.event_id,
+            'outcome': self.outcome,
+            'status': self.status,
+            'processed': self.processed,
+            'total': self.total,
+            'progress': self.progress,
+        }
+
+
+class EventPriceDay(models.Model):
+    """
+    Price history of an event in one day (current timezone). The hourly snapshot task appends
+    a point: minute of the day and POINT_FIELDS of the event, packed into one binary array of
+    32-bit big-endian integers. Charts read a row per day instead of hourly snapshots.
+    """
+    class Meta:
+        unique_together = ('event', 'day')
+        ordering = ['day']
+        verbose_name = 'historia cen wydarzenia'
+        verbose_name_plural = 'historie cen wydarzeń'
+
+    POINT_FIELDS = (
+        'current_buy_for_price',
+        'current_buy_against_price',
+        'current_sell_for_price',
+        'current_sell_against_price',
+        'Q_for',
+        'Q_against',
+    )
+    POINT_FORMAT = '>%di' % (len(POINT_FIELDS) + 1)
+
+    event = models.ForeignKey(Event, related_name='price_days')
+    day = models.DateField(u'dzień')
+    points = models.BinaryField(u'punkty', default=b'')
+
+    objects = EventPriceDayManager()
+
+    def __unicode__(self):
+        return u'%s %s' % (self.event, self.day)
+
+    @classmethod
+    def pack_points(cls, points):
+        """
+        :param points: minute of the day followed by values of POINT_FIELDS
+        :type points: [tuple]
+        :rtype: bytes
+        """
+        return b''.join(struct.pack(cls.POINT_FORMAT, *point) for point in points)
+
+    @classmethod
+    def unpack_points(cls, data):
+        """
+        :type data: bytes
+        :return: minute of the day followed by values of POINT_FIELDS
+        :rtype: [tuple]
+        """
+        data = bytes(data)
+        size = struct.calcsize(cls.POINT_FORMAT)
+        return [
+            struct.unpack_from(cls.POINT_FORMAT, data, offset)
+            for offset in range(0, len(data), size)
+        ]
+
+    def get_points(self):
+        """
+        Points of the day
+        :return: time of the point and values of POINT_FIELDS
+        :rtype: [(datetime, tuple)]
+        """
+        return [
+            (timezone.make_aware(datetime.combine(self.day, time(point[0] // 60, point[0] % 60))),
+             point[1:])
+            for point in self.unpack_points(self.points)
+        ]
+
+
+class Candle(models.Model):
+    """
+    Open, high, low and close YES price and volume of trades of an event in one interval.
+    Candles of every interval are upserted in the same transaction as the trade; buckets are
+    aligned to the Unix epoch (UTC).
+    """
+    class Meta:
+        unique_together = ('event', 'interval', 'start')
+        ordering = ['start']
+        verbose_name = u'świeca'
+        verbose_name_plural = u'świece'
+
+    FIVE_MINUTES, HOUR, DAY = 300, 3600, 86400
+    INTERVAL_CHOICES = (
+        (FIVE_MINUTES, u'5 minut'),
+        (HOUR, u'godzina'),
+        (DAY, u'dzień'),
+    )
+    INTERVALS = (FIVE_MINUTES, HOUR, DAY)
+
+    event = models.ForeignKey(Event, related_name='candles')
+    interval = models.PositiveIntegerField(u'interwał', choices=INTERVAL_CHOICES)
+    start = models.DateTimeField(u'początek')
+    open = models.IntegerField(u'otwarcie')
+    high = models.IntegerField(u'maksimum')
+    low = models.IntegerField(u'minimum')
+    close = models.IntegerField(u'zamknięcie')
+    volume = models.PositiveIntegerField(u'wolumen', default=0)
+    trades = models.PositiveIntegerField(u'liczba transakcji', default=0)
+
+    objects = CandleManager()
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.event, self.get_interval_display(), self.start)
+
+    @classmethod
+    def get_start(cls, date, interval):
+        """
+        Start of the interval containing date
+        :type date: datetime
+        :param interval: length in seconds, one of INTERVALS
+        :type interval: int
+        :rtype: datetime
+        """
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        seconds = int((date - epoch).total_seconds())
+        return epoch + timedelta(seconds=seconds - seconds % interval)
+
+    @staticmethod
+    def get_yes_price(transaction_type, price):
+        """
+        YES price of a trade
+        :param transaction_type: one of Transaction.BUY_SELL_TYPES
+        :type transaction_type: int
+        :param price: price of the transaction, negative for bought bets
+        :type price: int
+        :rtype: int
+        """
+        if transaction_type in Transaction.YES_OUTCOME:
+            return abs(price)
+        return Event.PRIZE_FOR_WINNING - abs(price)
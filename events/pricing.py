@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+LMSR (logarithmic market scoring rule) pricing of two-outcome events.
+
+Prices are logistic functions of (Q_for - Q_against) / B and the cost function is written with
+log-sum-exp, so nothing overflows however large the quantities are compared to B (plain
+exp(Q / B) overflows a float from Q / B > 709).
+
+Scalar functions are used by Event for single events, batch_* functions take NumPy arrays
+(one element per event) for portfolio valuations and simulations over many events at once.
+Prices are fractions of PRIZE_FOR_WINNING (0..1), rounding is left to callers.
+"""
+from math import exp, log
+
+import numpy as np
+
+
+def logistic(x):
+    """
+    1 / (1 + e^-x) without overflow for large |x|
+    :type x: float
+    :rtype: float
+    """
+    if x >= 0:
+        return 1. / (1. + exp(-x))
+    z = exp(x)
+    return z / (1. + z)
+
+
+def price(Q_for, Q_against, B):
+    """
+    Price of one YES bet, the price of NO bet is 1 - price
+    :param Q_for: bets for YES
+    :type Q_for: int
+    :param Q_against: bets for NO
+    :type Q_against: int
+    :param B: event constant B
+    :type B: float
+    :rtype: float
+    """
+    return logistic((Q_for - Q_against) / float(B))
+
+
+def prices(Q_for, Q_against, B):
+    """
+    Marginal buy and sell prices of both outcomes. Sell price is the price before the last bet
+    was bought. Event prices are rounded costs of one bet instead, see Event.calculate_prices.
+    :return: buy_for, buy_against, sell_for, sell_against
+    :rtype: (float, float, float, float)
+    """
+    B = float(B)
+    Q_for_sell = max(0, Q_for - 1)
+    Q_against_sell = max(0, Q_against - 1)
+    return (
+        logistic((Q_for - Q_against) / B),
+        logistic((Q_against - Q_for) / B),
+        logistic((Q_for_sell - Q_against) / B),
+        logistic((Q_against_sell - Q_for) / B),
+    )
+
+
+def cost(Q_for, Q_against, B):
+    """
+    LMSR cost function B * ln(e^(Q_for / B) + e^(Q_against / B))
+    :rtype: float
+    """
+    B = float(B)
+    a, b = Q_for / B, Q_against / B
+    high = max(a, b)
+    return B * (high + log(exp(a - high) + exp(b - high)))
+
+
+def cost_to_move(Q_for, Q_against, B, outcome, quantity):
+    """
+    Cost of buying (quantity > 0) or selling (quantity < 0) bets at the continuous LMSR price
+    :param outcome: True for YES, False for NO
+    :type outcome: bool
+    :param quantity: bets count, negative for sell
+    :type quantity: int
+    :rtype: float
+    """
+    if outcome:
+        return cost(Q_for + quantity, Q_against, B) - cost(Q_for, Q_against, B)
+    return cost(Q_for, Q_against + quantity, B) - cost(Q_for, Q_against, B)
+
+
+def batch_logistic(x):
+    """
+    logistic for array
+    :type x: np.ndarray
+    :rtype: np.ndarray
+    """
+    return np.exp(-np.logaddexp(0., -x))
+
+
+def batch_price(Q_for, Q_against, B):
+    """
+    price for arrays of events
+    :type Q_for: np.ndarray
+    :type Q_against: np.ndarray
+    :type B: np.ndarray
+    :rtype: np.ndarray
+    """
+    return batch_logistic((np.asarray(Q_for, dtype=float) - Q_against) / B)
+
+
+def batch_prices(Q_for, Q_against, B):
+    """
+    prices for arrays of events
+    :return: buy_for, buy_against, sell_for, sell_against
+    :rtype: (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+    """
+    Q_for = np.asarray(Q_for, dtype=float)
+    Q_against = np.asarray(Q_against, dtype=float)
+    B = np.asarray(B, dtype=float)
+    Q_for_sell = np.maximum(0., Q_for - 1)
+    Q_against_sell = np.maximum(0., Q_against - 1)
+    return (
+        batch_logistic((Q_for - Q_against) / B),
+        batch_logistic((Q_against - Q_for) / B),
+        batch_logistic((Q_for_sell - Q_against) / B),
+        batch_logistic((Q_against_sell - Q_for) / B),
+    )
+
+
+def batch_cost(Q_for, Q_against, B):
+    """
+    cost for arrays of events
+    :rtype: np.ndarray
+    """
+    B = np.asarray(B, dtype=float)
+    return B * np.logaddexp(np.asarray(Q_for, dtype=float) / B, np.asarray(Q_against) / B)
+
+
+def batch_cost_to_move(Q_for, Q_against, B, outcome, quantity):
+    """
+    cost_to_move for arrays of events
+    :param outcome: True for YES, False for NO, one for all events or array
+    :type outcome: bool or np.ndarray
+    :param quantity: bets count, negative for sell
+    :type quantity: int or np.ndarray
+    :rtype: np.ndarray
+    """
+    Q_for = np.asarray(Q_for, dtype=float)
+    Q_against = np.asarray(Q_against, dtype=float)
+    outcome = np.asarray(outcome, dtype=bool)
+    moved_for = Q_for + np.where(outcome, quantity, 0)
+    moved_against = Q_against + np.where(outcome, 0, quantity)
+    return batch_cost(moved_for, moved_against, B) - batch_cost(Q_for, Q_against, B)
@@ -4,7 +4,8 @@ import logging
 from celery import task
 from django.utils.timezone import now
 
-from .models import Event
+from . import charts
+from .models import Event, EventPriceDay, LimitOrder, IdempotencyKey, EventSettlement
 
 
 logger = logging.getLogger(__name__)
@@ -17,20 +18,26 @@ def create_open_events_snapshot():
     """
     logger.debug("'events:tasks:create_open_events_snapshot' worker up")
 
-    for event in Event.objects.ongoing_only_queryset().exclude(is_published=False):
-        try:
-            logger.debug(
-                "'events:tasks:create_open_events_snapshot' snapshotting event"
-                " <%s>" % unicode(event.pk)
-            )
-            event.snapshots.create_snapshot()
-        except:
-            logger.exception(
-                "Fatal error during create_open_events_snapshot of event"
-                " #%d" % (event.id,)
-            )
+    events = Event.objects.ongoing_only_queryset().exclude(is_published=False)
+    count = Event.snapshots.bulk_snapshot(events)
+    EventPriceDay.objects.append_points(events)
+    charts.invalidate()
+
+    logger.debug(
+        "'events:tasks:create_open_events_snapshot' finished snapshotting %d Events." % count
+    )
 
-    logger.debug("'events:tasks:create_open_events_snapshot' finished snapshotting Events.")
+
+@task
+def compact_events_snapshots():
+    """
+    Roll up event snapshots older than their hourly retention to daily ones and create
+    partitions for next months if the snapshot table is partitioned
+    """
+    deleted = Event.snapshots.compact()
+    logger.debug("'events:tasks:compact_events_snapshots' deleted %d snapshots." % deleted)
+    for partition in Event.snapshots.create_partitions():
+        logger.debug("'events:tasks:compact_events_snapshots' created partition %s" % partition)
 
 
 @task
@@ -53,3 +60,55 @@ def calculate_price_change():
         event.price_change = event.current_buy_for_price - last_price
         event.absolute_price_change = abs(event.price_change)
         event.save()
+
+
+@task
+def match_limit_orders(event_id):
+    """
+    Execute limit orders reached by current prices of the event; dispatched after every
+    committed trade
+    """
+    filled = LimitOrder.objects.match_event(event_id)
+    if filled:
+        logger.debug(
+            "'events:tasks:match_limit_orders' filled %d orders of event #%d" % (
+                len(filled), event_id
+            )
+        )
+
+
+@task
+def delete_expired_idempotency_keys():
+    """
+    Delete idempotency keys older than IdempotencyKeyManager.TTL
+    """
+    IdempotencyKey.objects.expired().delete()
+
+
+@task
+def settle_event(settlement_id):
+    """
+    Settle finished event chunk by chunk, every chunk in its own transaction
+    """
+    logger.debug("'events:tasks:settle_event' worker up")
+
+    settlement = EventSettlement.objects.settle_chunk(settlement_id)
+    while settlement.status != EventSettlement.DONE:
+        logger.debug(
+            "'events:tasks:settle_event' event #%d settled %d/%d" % (
+                settlement.event_id, settlement.processed, settlement.total
+            )
+        )
+        settlement = EventSettlement.objects.settle_chunk(settlement_id)
+
+    logger.debug("'events:tasks:settle_event' finished settling event #%d" % settlement.event_id)
+
+
+@task
+def resume_settlements():
+    """
+    Continue settlements interrupted by a crash of worker; chunks are locked, so settlement
+    running in another worker is not settled twice
+    """
+    for settlement_id in EventSettlement.objects.pending().values_list('id', flat=True):
+        settle_event.delay(settlement_id)
@@ -2,7 +2,7 @@
 from django import template
 from django.utils import timezone
 
-from events.models import Bet
+from events.models import Bet, Event
 
 
 register = template.Library()
@@ -21,7 +21,11 @@ def render_events(context, events):
     try:
         r_events = [event.object for event in events]
     except AttributeError:
-        r_events = events
+        r_events = list(events)
+    # charts of all cards in one query instead of one per card
+    Event.objects.charts_for(
+        [event for event in r_events if event is not None], Event.EVENT_SMALL_CHART_DAYS
+    )
     return {
         'events': r_events,
         'request': context.get('request')
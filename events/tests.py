@@ -2,23 +2,36 @@
 """
 Test events module
 """
-from datetime import timedelta
+from datetime import datetime, time, timedelta
 from freezegun import freeze_time
 import json
+from mock import patch
+from StringIO import StringIO
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection
+from django.test import RequestFactory, TestCase
 from django.test.utils import override_settings
 from django.utils import timezone
 from django.utils.translation import ugettext as _
+from unittest import skipUnless
 
-from .exceptions import NonexistantEvent, PriceMismatch, EventNotInProgress, UnknownOutcome, \
-    InsufficientCash, InsufficientBets
+from .exceptions import NonexistantEvent, DraftEvent, PriceMismatch, EventNotInProgress, \
+    UnknownOutcome, InsufficientCash, InsufficientBets, InvalidQuantity, InvalidLimitPrice, \
+    MarketEngineError, MarketEngineTimeout
+from . import counters, downsampling, pricing
+from .engine import LocalQueue, MarketEngine, MarketEngineClient
 from .factories import EventFactory, ShortEventFactory, BetFactory, TransactionFactory
-from .models import Bet, Event, Transaction
-from .tasks import create_open_events_snapshot, calculate_price_change
-from .templatetags.display import render_bet, render_event, render_events, render_featured_event, \
+from .models import Bet, Event, Transaction, LimitOrder, IdempotencyKey, EventSettlement, \
+    SolutionVote, EventPriceDay, Candle
+from .tasks import create_open_events_snapshot, calculate_price_change, settle_event, \
+    compact_events_snapshots
+from .templatetags.display import render_bet, render_events, render_featured_event, \
     render_featured_events, render_bet_status, outcome, render_finish_date, og_title
 
 from accounts.factories import UserFactory
@@ -38,6 +51,98 @@ class EventsModelTestCase(TestCase):
         event = ShortEventFactory()
         self.assertIsInstance(event, Event)
 
+    def test_snapshots_manager(self):
+        """
+        Snapshot manager classes are created once per model
+        """
+        event = EventFactory()
+        other_event = EventFactory()
+        self.assertIs(Event.snapshots, Event.snapshots)
+        self.assertIs(type(event.snapshots), type(other_event.snapshots))
+        self.assertIs(event, event.snapshots.instance)
+        self.assertIs(other_event, other_event.snapshots.instance)
+        event.snapshots.create_snapshot()
+        self.assertEqual(1, event.snapshots.filter(snapshot_of=event).count())
+        self.assertEqual(0, other_event.snapshots.filter(snapshot_of=other_event).count())
+
+    def test_snapshots_partitions(self):
+        """
+        Snapshot table index and monthly partitions
+        """
+        model = Event.snapshots.model
+        self.assertIn(('snapshot_of', 'created_at'), model._meta.index_together)
+        self.assertEqual([
+            ('events_event_snapshot_201611', datetime(2016, 11, 1).date(),
+             datetime(2016, 12, 1).date()),
+            ('events_event_snapshot_201612', datetime(2016, 12, 1).date(),
+             datetime(2017, 1, 1).date()),
+            ('events_event_snapshot_201701', datetime(2017, 1, 1).date(),
+             datetime(2017, 2, 1).date()),
+        ], Event.snapshots.get_partitions(datetime(2016, 11, 30).date(),
+                                          datetime(2017, 1, 1).date()))
+        if connection.vendor != 'postgresql':
+            self.assertFalse(Event.snapshots.is_partitioned())
+            self.assertEqual([], Event.snapshots.create_partitions())
+            with self.assertRaises(ImproperlyConfigured):
+                Event.snapshots.partition()
+            with self.assertRaises(CommandError):
+                call_command('partition_snapshots', convert=True, stdout=StringIO())
+
+    def test_chart_cache(self):
+        """
+        Charts are cached until the next snapshot
+        """
+        cache.clear()
+        today = timezone.localtime(timezone.now()).date()
+        midnight = timezone.make_aware(datetime.combine(today, time()))
+        with freeze_time(midnight - timedelta(hours=1)):
+            event = EventFactory()
+        with freeze_time(midnight + timedelta(minutes=11)) as frozen_time:
+            create_open_events_snapshot()
+            chart = event.get_event_small_chart()
+            self.assertEqual(Event.CHART_MARGIN + 1, len(chart['points']))
+            self.assertEqual(event.current_buy_for_price, chart['points'][-1])
+
+            event.current_buy_for_price = 70
+            event.save()
+            with self.assertNumQueries(0):
+                self.assertEqual(chart, event.get_event_small_chart())
+                self.assertEqual(json.dumps(chart), event.get_JSON_small_chart())
+
+            frozen_time.tick(delta=timedelta(minutes=30))
+            create_open_events_snapshot()
+            self.assertEqual(70, event.get_event_small_chart()['points'][-1])
+            self.assertEqual(70, event.get_event_big_chart()['points'][-1])
+
+    def test_get_chart_points_carry_forward(self):
+        """
+        Get chart points when unchanged snapshots are not stored
+        """
+        today = timezone.localtime(timezone.now()).date()
+        initial_time = timezone.make_aware(datetime.combine(today - timedelta(days=3), time()))
+        with freeze_time(initial_time - timedelta(hours=1)):
+            event = EventFactory()
+        with freeze_time(initial_time + timedelta(minutes=11)) as frozen_time:
+            event.current_buy_for_price = 60
+            event.save()
+            create_open_events_snapshot()
+            frozen_time.tick(delta=timedelta(days=1))
+            create_open_events_snapshot()
+            frozen_time.tick(delta=timedelta(days=1))
+            event.current_buy_for_price = 70
+            event.save()
+            create_open_events_snapshot()
+            frozen_time.tick(delta=timedelta(days=1))
+            event.current_buy_for_price = 80
+            event.save()
+            create_open_events_snapshot()
+
+            self.assertEqual(3, event.snapshots.filter(snapshot_of=event).count())
+            chart = event.get_event_small_chart()
+            self.assertEqual([Event.BEGIN_PRICE] * Event.CHART_MARGIN + [60, 60, 70, 80],
+                             chart['points'])
+            self.assertEqual(len(chart['points']), len(chart['labels']))
+
     def test_event_with_attributes(self):
         """
         Create event with all attributes
@@ -54,12 +159,13 @@ class EventsModelTestCase(TestCase):
         # self.assertEqual('http://example.com/event/1-a', event.get_absolute_url())
         self.assertTrue(event.is_in_progress)
         self.assertEqual('event_1', event.publish_channel)
+        # prices of one bet rounded against the user: 100 * 10 * ln((e^0.1 + 1) / 2) = 51.25
         self.assertEqual({
             'event_id': 1,
-            'buy_for_price': 50,
-            'buy_against_price': 50,
-            'sell_for_price': 50,
-            'sell_against_price': 50
+            'buy_for_price': 52,
+            'buy_against_price': 52,
+            'sell_for_price': 48,
+            'sell_against_price': 48
         }, event.event_dict)
 
         outcome1 = event.price_for_outcome(Bet.YES, Bet.BUY)
@@ -231,21 +337,154 @@ class EventsModelTestCase(TestCase):
         self.assertNotEqual(start_event_dict['buy_against_price'], event.event_dict['buy_against_price'])
         self.assertNotEqual(start_event_dict['buy_for_price'], event.event_dict['buy_for_price'])
         self.assertNotEqual(start_event_dict['buy_against_price'], event.event_dict['buy_against_price'])
-        self.assertEqual(start_event_dict['sell_for_price'], event.event_dict['sell_for_price'])
+        # sell price is what one bet pays: 100 * (C(2, 0) - C(1, 0)) = 67.8, rounded down; B is
+        # a float field, an integer B (only possible before save) is not floored anymore
+        self.assertEqual(67, event.event_dict['sell_for_price'])
 
         event.increment_quantity(Bet.NO, amount)
         self.assertEqual(amount, event.Q_for)
         self.assertEqual(amount, event.Q_against)
-        self.assertNotEqual(start_event_dict, event.event_dict)
-        self.assertEqual(start_event_dict['buy_against_price'], event.event_dict['buy_against_price'])
-        self.assertEqual(start_event_dict['buy_for_price'], event.event_dict['buy_for_price'])
-        self.assertNotEqual(start_event_dict['sell_against_price'], event.event_dict['sell_against_price'])
-        self.assertNotEqual(start_event_dict['sell_for_price'], event.event_dict['sell_for_price'])
+        # prices depend only on Q_for - Q_against
+        self.assertEqual(start_event_dict, event.event_dict)
 
         bad_outcome = 'OOOPS'
         with self.assertRaises(UnknownOutcome):
             event.increment_quantity(bad_outcome, amount)
 
+    def test_price_for_quantity(self):
+        """
+        Price for quantity
+        """
+        event = EventFactory()
+        # 100 * (C(1, 0) - C(0, 0)) = 51.25 rounded up
+        self.assertEqual(52, event.get_total_price(Bet.YES, Bet.BUY))
+        # 161.21 rounded up
+        self.assertEqual(162, event.get_total_price(Bet.YES, Bet.BUY, 3))
+        self.assertEqual(54, event.price_for_quantity(Bet.YES, Bet.BUY, 3))
+        self.assertEqual(54, event.price_for_quantity(Bet.NO, Bet.BUY, 3))
+
+        # 52 + 54 + 57 for bets bought one by one
+        one_by_one = 0
+        for i in range(3):
+            one_by_one += event.get_total_price(Bet.YES, Bet.BUY)
+            event.increment_quantity(Bet.YES, 1)
+        self.assertEqual(163, one_by_one)
+        # 161.21 rounded down, selling at once gives no profit
+        self.assertEqual(161, event.get_total_price(Bet.YES, Bet.SELL, 3))
+        self.assertEqual(53, event.price_for_quantity(Bet.YES, Bet.SELL, 3))
+
+        with self.assertRaises(UnknownOutcome):
+            event.price_for_quantity('OOOPS', Bet.BUY, 3)
+
+    def test_quote(self):
+        """
+        Quote
+        """
+        event = EventFactory()
+        quote = event.quote(Bet.YES, Bet.BUY, 3)
+        self.assertEqual(event.id, quote['event_id'])
+        self.assertEqual(54, quote['price'])
+        self.assertEqual(162, quote['total'])
+        self.assertEqual(event.price_version, quote['price_version'])
+
+        event.increment_quantity(Bet.YES, 3)
+        quote = event.quote(Bet.YES, Bet.SELL)
+        # 56.22 rounded down
+        self.assertEqual(56, quote['price'])
+        self.assertEqual(56, quote['total'])
+        self.assertEqual(event.price_version, quote['price_version'])
+
+    def test_quote_view(self):
+        """
+        Quote endpoint
+        """
+        event = EventFactory()
+        path = reverse('quote', kwargs={'event_id': event.id})
+        response = self.client.get(path, {'outcome': 'true'}, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(302, response.status_code)
+
+        user = UserFactory()
+        user.set_password('password')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='password'))
+        response = self.client.get(path, {'outcome': 'true', 'quantity': 3},
+                                   HTTP_HOST='testserver', secure=True)
+        self.assertEqual(200, response.status_code)
+        result = json.loads(response.content)
+        self.assertEqual(162, result['quote']['total'])
+        self.assertIn('token', result)
+
+        response = self.client.get(path, {
+            'outcome': 'true',
+            'quantity': Bet.objects.MAX_QUANTITY + 1,
+        }, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(400, response.status_code)
+
+        draft = EventFactory(is_published=False)
+        response = self.client.get(reverse('quote', kwargs={'event_id': draft.id}),
+                                   {'outcome': 'true'}, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(404, response.status_code)
+
+    def test_get_tick_chart(self):
+        """
+        Tick chart from transactions
+        """
+        user = UserFactory()
+        initial_time = timezone.now().replace(microsecond=0)
+        # chart starts at event creation and ends now, both have to be frozen with transactions
+        with freeze_time(initial_time) as frozen_time:
+            event = EventFactory()
+            for transaction_type, price in [
+                (Transaction.BUY_YES, -60),
+                (Transaction.SELL_YES, 58),
+                (Transaction.BONUS, 100),
+                (Transaction.BUY_NO, -45),
+                (Transaction.SELL_NO, 30),
+            ]:
+                TransactionFactory(user=user, event=event, type=transaction_type, price=price)
+                frozen_time.tick(delta=timedelta(minutes=1))
+
+            chart = event.get_tick_chart()
+            self.assertEqual(event.id, chart['id'])
+            self.assertEqual([60, 58, 55, 70], chart['points'])
+            epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+            start_ms = int((initial_time - epoch).total_seconds()) * 1000
+            self.assertEqual([start_ms + i * 60000 for i in (0, 1, 3, 4)], chart['times'])
+
+            chart = event.get_tick_chart(start=initial_time + timedelta(seconds=30), points=3)
+            self.assertEqual([58, 55, 70], chart['points'])
+            self.assertEqual(3, len(event.get_tick_chart(points=3)['points']))
+            self.assertEqual([], EventFactory().get_tick_chart()['points'])
+
+    def test_tick_chart_view(self):
+        """
+        Tick chart endpoint
+        """
+        event = EventFactory()
+        TransactionFactory(user=UserFactory(), event=event, type=Transaction.BUY_YES, price=-52)
+        path = reverse('tick_chart', kwargs={'event_id': event.id})
+
+        response = self.client.get(path, {'points': 100}, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([52], json.loads(response.content)['points'])
+
+        response = self.client.get(path, {'start': 'yesterday'}, HTTP_HOST='testserver',
+                                   secure=True)
+        self.assertEqual(400, response.status_code)
+
+        # draft events are visible only to staff
+        event.is_published = False
+        event.save()
+        response = self.client.get(path, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(404, response.status_code)
+
+        admin = UserFactory(is_staff=True)
+        admin.set_password('password')
+        admin.save()
+        self.assertTrue(self.client.login(username=admin.username, password='password'))
+        response = self.client.get(path, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(200, response.status_code)
+
     def test_increment_by_turnover(self):
         """
         Increment by turnover
@@ -376,6 +615,46 @@ class EventsModelTestCase(TestCase):
         self.assertIsNotNone(event.end_date)
         self.assertEqual(Event.FINISHED_NO, event.outcome)
 
+    def test_finish_yes_settlement(self):
+        """
+        Prizes are paid for winning bets with set-based settlement
+        """
+        winner, loser, sold_out = UserFactory.create_batch(3, total_cash=100, portfolio_value=50)
+        event = EventFactory()
+        BetFactory(event=event, user=winner, outcome=Bet.YES, has=3)
+        BetFactory(event=event, user=winner, outcome=Bet.NO, has=2)
+        BetFactory(event=event, user=loser, outcome=Bet.NO, has=4)
+        BetFactory(event=event, user=sold_out, outcome=Bet.YES, has=0)
+        other_bet = BetFactory(event=EventFactory(), user=winner, outcome=Bet.YES, has=1)
+
+        event.finish_yes()
+
+        winner.refresh_from_db()
+        self.assertEqual(100 + 3 * Event.PRIZE_FOR_WINNING, winner.total_cash)
+        self.assertEqual(UserProfile.reputation_formula(50, winner.total_cash), winner.reputation)
+        loser.refresh_from_db()
+        self.assertEqual(100, loser.total_cash)
+        self.assertEqual(UserProfile.reputation_formula(50, 100), loser.reputation)
+
+        # one transaction for every winning bet, also without bets left
+        transactions = Transaction.objects.filter(event=event).order_by('id')
+        self.assertEqual([
+            (winner.id, 3, Event.PRIZE_FOR_WINNING),
+            (sold_out.id, 0, Event.PRIZE_FOR_WINNING),
+        ], [(t.user_id, t.quantity, t.price) for t in transactions])
+        self.assertTrue(all(t.type == Transaction.EVENT_WON_PRIZE for t in transactions))
+
+        bets = Bet.objects.filter(event=event)
+        self.assertEqual({
+            (winner.id, Bet.YES): 3 * Event.PRIZE_FOR_WINNING,
+            (winner.id, Bet.NO): 0,
+            (loser.id, Bet.NO): 0,
+            (sold_out.id, Bet.YES): 0,
+        }, {(bet.user_id, bet.outcome): bet.rewarded_total for bet in bets})
+        self.assertTrue(all(bet.is_new_resolved for bet in bets))
+        other_bet.refresh_from_db()
+        self.assertFalse(other_bet.is_new_resolved)
+
     def test_cancel(self):
         """
         Cancel event
@@ -411,6 +690,40 @@ class EventsModelTestCase(TestCase):
         user = UserProfile.objects.get(pk=user.pk)
         self.assertEqual(user.total_cash, 178)
 
+    def test_cancel_refunds_many_users(self):
+        """
+        Refunds of every user are summed up
+        """
+        event = EventFactory()
+        buyer, trader, even = UserFactory.create_batch(3, total_cash=100, portfolio_value=0)
+        TransactionFactory(user=buyer, event=event, type=Transaction.BUY_YES, price=-50,
+                           quantity=3)
+        TransactionFactory(user=buyer, event=event, type=Transaction.BUY_NO, price=-40)
+        TransactionFactory(user=trader, event=event, type=Transaction.BUY_YES, price=-30,
+                           quantity=2)
+        TransactionFactory(user=trader, event=event, type=Transaction.SELL_YES, price=45,
+                           quantity=2)
+        TransactionFactory(user=even, event=event, type=Transaction.BUY_NO, price=-20)
+        TransactionFactory(user=even, event=event, type=Transaction.SELL_NO, price=20)
+        TransactionFactory(user=even, event=EventFactory(), type=Transaction.BUY_NO, price=-20)
+
+        event.cancel()
+
+        refunds = Transaction.objects.filter(event=event).\
+            exclude(type__in=Transaction.BUY_SELL_TYPES).order_by('user_id')
+        self.assertEqual([
+            (buyer.id, Transaction.EVENT_CANCELLED_REFUND, 1, 190),
+            (trader.id, Transaction.EVENT_CANCELLED_DEBIT, 1, -30),
+        ], [(t.user_id, t.type, t.quantity, t.price) for t in refunds])
+
+        buyer.refresh_from_db()
+        self.assertEqual(290, buyer.total_cash)
+        self.assertEqual(UserProfile.reputation_formula(0, 290), buyer.reputation)
+        trader.refresh_from_db()
+        self.assertEqual(70, trader.total_cash)
+        even.refresh_from_db()
+        self.assertEqual(100, even.total_cash)
+
     def test_cancel_and_reputy_debit(self):
         """
         Test calculation reputy after cancel event
@@ -448,10 +761,284 @@ class EventsModelTestCase(TestCase):
         self.assertEqual(user.total_cash, 90)
 
 
+class EventPriceDayTestCase(TestCase):
+    """
+    Packed daily price history
+    """
+    def test_pack_points(self):
+        """
+        Pack and unpack points
+        """
+        points = [(11, 50, 50, 49, 49, 0, 0), (71, 60, 40, 59, 39, 10, -1)]
+        data = EventPriceDay.pack_points(points)
+        self.assertEqual(2 * 7 * 4, len(data))
+        self.assertEqual(points, EventPriceDay.unpack_points(data))
+
+    def test_append_points(self):
+        """
+        Append current points of events to their price days
+        """
+        event = EventFactory()
+        event.current_buy_for_price = 60
+        event.save()
+        other_event = EventFactory()
+        moment = timezone.make_aware(datetime(2016, 3, 1, 0, 11))
+        events = Event.objects.filter(id__in=[event.id, other_event.id])
+        self.assertEqual(2, EventPriceDay.objects.append_points(events, moment))
+        event.current_buy_for_price = 70
+        event.save()
+        self.assertEqual(2, EventPriceDay.objects.append_points(
+            events, moment + timedelta(hours=1)
+        ))
+
+        price_day = event.price_days.get()
+        self.assertEqual(datetime(2016, 3, 1).date(), price_day.day)
+        points = price_day.get_points()
+        self.assertEqual([moment, moment + timedelta(hours=1)], [point[0] for point in points])
+        self.assertEqual([60, 70], [point[1][0] for point in points])
+        self.assertEqual(2, len(other_event.price_days.get().get_points()))
+
+    def test_merge_points(self):
+        """
+        Merge points keeping already stored ones
+        """
+        event = EventFactory()
+        day = datetime(2016, 3, 1).date()
+        EventPriceDay.objects.merge_points({event.id: {day: [(11, 50, 50, 49, 49, 0, 0)]}})
+        EventPriceDay.objects.merge_points({event.id: {day: [
+            (11, 1, 1, 1, 1, 1, 1), (71, 60, 40, 59, 39, 10, 0)
+        ]}})
+        self.assertEqual(
+            [(11, 50, 50, 49, 49, 0, 0), (71, 60, 40, 59, 39, 10, 0)],
+            EventPriceDay.unpack_points(event.price_days.get().points)
+        )
+
+
+class CandleTestCase(TestCase):
+    """
+    OHLC candles of trades
+    """
+    def test_get_start(self):
+        """
+        Start of the interval
+        """
+        date = datetime(2016, 3, 1, 10, 17, 31, tzinfo=timezone.utc)
+        self.assertEqual(datetime(2016, 3, 1, 10, 15, tzinfo=timezone.utc),
+                         Candle.get_start(date, Candle.FIVE_MINUTES))
+        self.assertEqual(datetime(2016, 3, 1, 10, tzinfo=timezone.utc),
+                         Candle.get_start(date, Candle.HOUR))
+        self.assertEqual(datetime(2016, 3, 1, tzinfo=timezone.utc),
+                         Candle.get_start(date, Candle.DAY))
+        self.assertEqual(60, Candle.get_yes_price(Transaction.BUY_YES, -60))
+        self.assertEqual(70, Candle.get_yes_price(Transaction.SELL_NO, 30))
+
+    def test_record_trades(self):
+        """
+        Buying and selling bets updates candles of every interval
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=1000)
+        initial_time = datetime(2016, 3, 1, 10, 3, tzinfo=timezone.utc)
+        with freeze_time(initial_time) as frozen_time:
+            user, event, bet = Bet.objects.buy_a_bet(
+                user, event.id, Bet.YES, event.price_for_quantity(Bet.YES, Bet.BUY, 3), 3
+            )
+            frozen_time.tick(delta=timedelta(minutes=1))
+            user, event, bet = Bet.objects.buy_a_bet(user, event.id, Bet.NO,
+                                                     event.current_buy_against_price)
+            frozen_time.tick(delta=timedelta(minutes=1))
+            user, event, bet = Bet.objects.sell_a_bet(
+                user, event.id, Bet.YES, event.price_for_quantity(Bet.YES, Bet.SELL, 2), 2
+            )
+            frozen_time.tick(delta=timedelta(minutes=5))
+            Bet.objects.sell_a_bet(user, event.id, Bet.YES, event.current_sell_for_price)
+
+        # every order is one candle trade at its average unit price
+        rows = [
+            (Candle.get_start(transaction.date, Candle.FIVE_MINUTES),
+             Candle.get_yes_price(transaction.type, transaction.price), transaction.quantity)
+            for transaction in Transaction._base_manager.filter(event=event).order_by('date', 'id')
+        ]
+        candles = event.candles.filter(interval=Candle.FIVE_MINUTES).order_by('start')
+        # intervals are half-open, so the sale at 10:05 starts the second candle
+        self.assertEqual(
+            [datetime(2016, 3, 1, 10, minute, tzinfo=timezone.utc) for minute in (0, 5, 10)],
+            [candle.start for candle in candles]
+        )
+        for candle in candles:
+            prices = [price for start, price, quantity in rows if start == candle.start]
+            self.assertEqual(
+                (prices[0], max(prices), min(prices), prices[-1],
+                 sum(quantity for start, price, quantity in rows if start == candle.start),
+                 len(prices)),
+                (candle.open, candle.high, candle.low, candle.close, candle.volume, candle.trades)
+            )
+        self.assertEqual(4, len(rows))
+        self.assertEqual([4, 2, 1], [candle.volume for candle in candles])
+        self.assertEqual([2, 1, 1], [candle.trades for candle in candles])
+
+        prices = [price for start, price, quantity in rows]
+        for interval in (Candle.HOUR, Candle.DAY):
+            candle = event.candles.get(interval=interval)
+            self.assertEqual(
+                (prices[0], max(prices), min(prices), prices[-1], 7, 4),
+                (candle.open, candle.high, candle.low, candle.close, candle.volume,
+                 candle.trades)
+            )
+
+    def test_backfill_candles(self):
+        """
+        Rebuild candles from transactions
+        """
+        event = EventFactory()
+        user = UserFactory()
+        with freeze_time(datetime(2016, 3, 1, 10, 3, tzinfo=timezone.utc)) as frozen_time:
+            for transaction_type, price, quantity in [
+                (Transaction.BUY_YES, -60, 2),
+                (Transaction.BONUS, 100, 1),
+                (Transaction.SELL_NO, 30, 1),
+                (Transaction.SELL_YES, 55, 3),
+            ]:
+                TransactionFactory(user=user, event=event, type=transaction_type, price=price,
+                                   quantity=quantity)
+                frozen_time.tick(delta=timedelta(hours=1))
+        Candle.objects.create(event=event, interval=Candle.DAY, start=timezone.now(), open=1,
+                              high=1, low=1, close=1)
+
+        call_command('backfill_candles', stdout=StringIO())
+        self.assertEqual(3, event.candles.filter(interval=Candle.FIVE_MINUTES).count())
+        self.assertEqual(3, event.candles.filter(interval=Candle.HOUR).count())
+        candle = event.candles.get(interval=Candle.DAY)
+        self.assertEqual(
+            (60, 70, 55, 55, 6, 3),
+            (candle.open, candle.high, candle.low, candle.close, candle.volume, candle.trades)
+        )
+
+
+class DownsamplingTestCase(TestCase):
+    """
+    events/downsampling
+    """
+    def test_lttb(self):
+        """
+        Largest-Triangle-Three-Buckets
+        """
+        x = range(1000)
+        y = [50] * 1000
+        y[437] = 90
+        y[700] = 10
+        selected = downsampling.lttb(x, y, 20).tolist()
+        self.assertEqual(20, len(selected))
+        self.assertEqual(0, selected[0])
+        self.assertEqual(999, selected[-1])
+        self.assertEqual(sorted(selected), selected)
+        self.assertIn(437, selected)
+        self.assertIn(700, selected)
+
+        self.assertEqual([0, 1, 2], downsampling.lttb([0, 1, 2], [1, 2, 3], 20).tolist())
+
+
+class PricingTestCase(TestCase):
+    """
+    events/pricing
+    """
+    def test_prices(self):
+        """
+        Prices
+        """
+        self.assertEqual((.5, .5, .5, .5), pricing.prices(0, 0, 10))
+        buy_for, buy_against, sell_for, sell_against = pricing.prices(3, 0, 10)
+        self.assertAlmostEqual(1, buy_for + buy_against)
+        self.assertGreater(buy_for, sell_for)
+        self.assertEqual(sell_against, buy_against)
+
+    def test_no_overflow(self):
+        """
+        Large quantities at small B
+        """
+        self.assertEqual((1., 0., 1., 0.), pricing.prices(100000, 0, 1))
+        self.assertEqual((0., 1., 0., 1.), pricing.prices(0, 100000, 1))
+        self.assertAlmostEqual(100000, pricing.cost(100000, 0, 1))
+        self.assertAlmostEqual(1, pricing.cost_to_move(100000, 0, 1, True, 1))
+        self.assertEqual({
+            'current_buy_for_price': 100,
+            'current_buy_against_price': 0,
+            'current_sell_for_price': 100,
+            'current_sell_against_price': 0,
+        }, Event.calculate_prices(100000, 0, 1))
+
+    def test_cost_to_move(self):
+        """
+        Cost of bets equals cost function difference
+        """
+        self.assertAlmostEqual(pricing.cost(13, 4, 10) - pricing.cost(10, 4, 10),
+                               pricing.cost_to_move(10, 4, 10, True, 3))
+        self.assertAlmostEqual(-pricing.cost_to_move(10, 1, 10, False, 3),
+                               pricing.cost_to_move(10, 4, 10, False, -3))
+        self.assertGreater(pricing.cost_to_move(0, 0, 10, True, 1), pricing.price(0, 0, 10))
+
+    def test_batch(self):
+        """
+        Batch functions give the same results as scalar ones
+        """
+        Q_for = [0, 3, 250, 100000, 0]
+        Q_against = [0, 0, 17, 0, 100000]
+        B = [10., 10., 50., 1., 1.]
+        batch = pricing.batch_prices(Q_for, Q_against, B)
+        costs = pricing.batch_cost(Q_for, Q_against, B)
+        moves = pricing.batch_cost_to_move(Q_for, Q_against, B, [True, False, True, True, False],
+                                           [3, 1, -2, 1, 5])
+        for i, (q_for, q_against, b) in enumerate(zip(Q_for, Q_against, B)):
+            for price, batch_price in zip(pricing.prices(q_for, q_against, b), batch):
+                self.assertAlmostEqual(price, batch_price[i])
+            self.assertAlmostEqual(pricing.cost(q_for, q_against, b), costs[i], places=6)
+        self.assertAlmostEqual(pricing.cost_to_move(250, 17, 50., True, -2), moves[2])
+        self.assertAlmostEqual(pricing.cost_to_move(0, 100000, 1., False, 5), moves[4])
+
+
 class EventsManagerTestCase(TestCase):
     """
     events/managers EventManager
     """
+    def test_charts_for(self):
+        """
+        Charts of a page of events are read with constant number of queries
+        """
+        days = Event.EVENT_SMALL_CHART_DAYS
+        today = timezone.localtime(timezone.now()).date()
+        midnight = timezone.make_aware(datetime.combine(today, time()))
+        with freeze_time(midnight - timedelta(hours=1)):
+            events = EventFactory.create_batch(10)
+        with freeze_time(midnight + timedelta(minutes=11)):
+            create_open_events_snapshot()
+            for page_size in (3, 10):
+                cache.clear()
+                page = list(Event.objects.filter(id__in=[e.id for e in events[:page_size]]))
+                with self.assertNumQueries(1):
+                    charts = Event.objects.charts_for(page, days)
+                self.assertEqual(page_size, len(charts))
+                with self.assertNumQueries(0):
+                    for event in page:
+                        self.assertEqual(charts[event.id], event.get_event_small_chart())
+
+            self.assertEqual(events[0].get_chart_points(days), charts[events[0].id])
+            self.assertEqual(events[0].current_buy_for_price, charts[events[0].id]['points'][-1])
+            self.assertEqual(Event.CHART_MARGIN + 1, len(charts[events[0].id]['points']))
+
+            # cached charts
+            page = list(Event.objects.filter(id__in=[e.id for e in events]))
+            with self.assertNumQueries(0):
+                self.assertEqual(charts, Event.objects.charts_for(page, days))
+
+            # finishing an event makes only its chart stale
+            events[1].finish_yes()
+            page = list(Event.objects.filter(id__in=[e.id for e in events]))
+            with self.assertNumQueries(1):
+                finished_charts = Event.objects.charts_for(page, days)
+            self.assertEqual(events[1].get_chart_points(days), finished_charts[events[1].id])
+            del charts[events[1].id], finished_charts[events[1].id]
+            self.assertEqual(charts, finished_charts)
+
     def test_ongoing_only_queryset(self):
         """
         Ongoing only queryset
@@ -566,6 +1153,30 @@ class EventsManagerTestCase(TestCase):
         with self.assertRaises(EventNotInProgress):
             Event.objects.vote_for_solution(user, event.id, 'NO')
 
+    def test_change_vote_counts(self):
+        """
+        Votes of stale event objects are not lost
+        """
+        event = EventFactory()
+        stale_event = Event.objects.get(id=event.id)
+        self.assertEqual((1, 0, 0), Event.objects.change_vote_counts(event.id, SolutionVote.YES))
+        self.assertEqual(2, event.vote_yes())
+        self.assertEqual(1, stale_event.vote_no())
+        self.assertEqual((2, 1, 0), (stale_event.vote_yes_count, stale_event.vote_no_count,
+                                     stale_event.vote_cancel_count))
+        self.assertEqual((1, 1, 1), Event.objects.change_vote_counts(
+            event.id, SolutionVote.CANCEL, SolutionVote.YES
+        ))
+
+        event.finish_no()
+        with self.assertRaises(EventNotInProgress):
+            Event.objects.change_vote_counts(event.id, SolutionVote.YES)
+        self.assertEqual(
+            (1, 1, 1),
+            Event.objects.filter(id=event.id).
+            values_list('vote_yes_count', 'vote_no_count', 'vote_cancel_count').get()
+        )
+
 
 class EventsTasksTestCase(TestCase):
     """
@@ -583,10 +1194,72 @@ class EventsTasksTestCase(TestCase):
         """
         Create open events snapshot
         """
-        #  events = EventFactory.create_batch(5)
-        EventFactory.create_batch(5)
+        events = EventFactory.create_batch(5)
+        events[0].current_buy_for_price = 70
+        events[0].Q_for = 12
+        events[0].save()
+        events[1].is_published = False
+        events[1].save()
+        events[2].outcome = Event.FINISHED_NO
+        events[2].save()
         create_open_events_snapshot.delay()
 
+        self.assertEqual(3, Event.snapshots.count())
+        self.assertEqual(0, events[1].snapshots.filter(snapshot_of=events[1]).count())
+        self.assertEqual(0, events[2].snapshots.filter(snapshot_of=events[2]).count())
+        snapshot = events[0].snapshots.get(snapshot_of=events[0])
+        self.assertEqual(70, snapshot.current_buy_for_price)
+        self.assertEqual(12, snapshot.Q_for)
+        self.assertEqual(events[0].B, snapshot.B)
+        self.assertIsNotNone(snapshot.created_at)
+
+        # only changed events are snapshotted again
+        events[3].current_buy_for_price = 55
+        events[3].save()
+        self.assertEqual(1, Event.snapshots.bulk_snapshot(Event.objects.filter(
+            id__in=[events[3].id, events[4].id]
+        )))
+        self.assertEqual(2, events[3].snapshots.filter(snapshot_of=events[3]).count())
+        self.assertEqual(1, events[4].snapshots.filter(snapshot_of=events[4]).count())
+        self.assertIsNone(events[4].snapshots.create_snapshot())
+
+    def test_compact_events_snapshots(self):
+        """
+        Roll up snapshots older than hourly retention
+        """
+        today = timezone.localtime(timezone.now()).date()
+        old_day = timezone.make_aware(datetime.combine(
+            today - timedelta(days=Event.snapshots.model.hourly_retention_days + 10), time()
+        ))
+        with freeze_time(old_day - timedelta(hours=2)):
+            event = EventFactory()
+            other_event = EventFactory()
+        # hourly snapshots from 23:11 of the previous day to 04:11
+        with freeze_time(old_day - timedelta(minutes=49)) as frozen_time:
+            for price in range(20, 26):
+                for e in (event, other_event):
+                    e.current_buy_for_price = price
+                    e.save()
+                create_open_events_snapshot()
+                frozen_time.tick(delta=timedelta(hours=1))
+        event.current_buy_for_price = 30
+        event.save()
+        create_open_events_snapshot()
+        self.assertEqual(7, event.snapshots.filter(snapshot_of=event).count())
+        self.assertEqual(6, other_event.snapshots.filter(snapshot_of=other_event).count())
+
+        # pages end in the middle of days and events
+        self.assertEqual(8, Event.snapshots.compact(batch_size=3))
+        # days start at 1 a.m., the latest snapshot of each day is kept
+        self.assertEqual([21, 25, 30], list(event.snapshots.filter(
+            snapshot_of=event
+        ).order_by('created_at').values_list('current_buy_for_price', flat=True)))
+        self.assertEqual([21, 25], list(other_event.snapshots.filter(
+            snapshot_of=other_event
+        ).order_by('created_at').values_list('current_buy_for_price', flat=True)))
+        compact_events_snapshots()
+        self.assertEqual(5, Event.snapshots.count())
+
     @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
                        CELERY_ALWAYS_EAGER=True,
                        BROKER_BACKEND='memory')
@@ -635,32 +1308,24 @@ class EventsTemplatetagsTestCase(TestCase):
         """
         event = EventFactory()
         user = UserFactory()
+        request = RequestFactory().get('/')
+        request.user = user
         bet_line = event.get_user_bet(user)
         self.assertEqual({
             'event': event,
             'bet': bet_line,
-        }, render_bet(event, bet_line))
-
-    def test_render_event(self):
-        """
-        Render event
-        """
-        event = EventFactory()
-        user = UserFactory()
-        bet_line = event.get_user_bet(user)
-        self.assertEqual({
-            'event': event,
-            'bet_line': bet_line,
-        }, render_event(event, bet_line))
+        }, render_bet({'request': request}, event))
 
     def test_render_events(self):
         """
         Render events
         """
         events = EventFactory.create_batch(10)
+        request = RequestFactory().get('/')
         self.assertEqual({
-            'events': events
-        }, render_events(events))
+            'events': events,
+            'request': request,
+        }, render_events({'request': request}, events))
 
     def test_render_featured_event(self):
         """
@@ -932,28 +1597,31 @@ class BetsManagerTestCase(TestCase):
         Buy a bet
         """
         event = EventFactory()
-        user = UserFactory(total_cash=event.current_buy_for_price)
+        total = event.get_total_price(Bet.YES, Bet.BUY)
+        user = UserFactory(total_cash=total)
         old_price = event.current_buy_for_price
+        # user is charged exactly the price of event
+        self.assertEqual(total, old_price)
         bet_user, bet_event, bet = Bet.objects.buy_a_bet(user, event.id, Bet.YES,
                                                          event.current_buy_for_price)
         self.assertEqual(user, bet_user)
         self.assertEqual(event, bet_event)
-        self.assertEqual(event.current_buy_for_price, bet.bought_avg_price)
+        self.assertEqual(total, bet.bought_avg_price)
         self.assertEqual(1, bet.has)
         self.assertEqual(1, bet.bought)
         self.assertEqual(0, bet_user.total_cash)
-        self.assertEqual(old_price, bet_user.portfolio_value)
+        self.assertEqual(total, bet_user.portfolio_value)
         self.assertNotEqual(old_price, bet_event.current_buy_for_price)
         self.assertEqual(1, bet_event.turnover)
 
-        with self.assertRaises(PriceMismatch):
-            Bet.objects.buy_a_bet(user, event.id, Bet.YES, old_price)
-
         with self.assertRaises(InsufficientCash):
             Bet.objects.buy_a_bet(user, event.id, Bet.YES, bet_event.current_buy_for_price)
 
-        user.total_cash = bet_event.current_buy_against_price
+        user.total_cash = bet_event.get_total_price(Bet.NO, Bet.BUY)
         user.save()
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.buy_a_bet(user, event.id, Bet.NO, old_price)
+
         # TODO should throw exception
         Bet.objects.buy_a_bet(user, event.id, Bet.NO, bet_event.current_buy_against_price)
 
@@ -962,11 +1630,15 @@ class BetsManagerTestCase(TestCase):
         Sell a bet
         """
         event = EventFactory()
-        user = UserFactory(total_cash=event.current_buy_for_price)
-        old_price = event.current_sell_for_price
+        user = UserFactory(total_cash=100)
+        old_price = event.current_buy_for_price
         bet_user, bet_event, bet = Bet.objects.buy_a_bet(user, event.id, Bet.YES,
                                                          event.current_buy_for_price)
-        avg_price = bet_event.current_sell_for_price
+        bought_for = event.get_total_price(Bet.YES, Bet.BUY)
+        sold_for = bet_event.get_total_price(Bet.YES, Bet.SELL)
+        self.assertEqual((old_price, bet_event.current_sell_for_price), (bought_for, sold_for))
+        # rounding against the user makes a round trip cost at most 1
+        self.assertEqual(1, bought_for - sold_for)
 
         with self.assertRaises(PriceMismatch):
             Bet.objects.sell_a_bet(user, event.id, Bet.YES, bet_event.current_buy_for_price)
@@ -975,11 +1647,11 @@ class BetsManagerTestCase(TestCase):
                                                           bet_event.current_sell_for_price)
         self.assertEqual(user, bet_user)
         self.assertEqual(event, bet_event)
-        self.assertEqual(avg_price, bet.sold_avg_price)
+        self.assertEqual(sold_for, bet.sold_avg_price)
         self.assertEqual(0, bet.has)
         self.assertEqual(1, bet.sold)
-        self.assertEqual(old_price, bet_user.total_cash)
-        self.assertEqual(0, bet_user.portfolio_value)
+        self.assertEqual(100 - bought_for + sold_for, bet_user.total_cash)
+        self.assertEqual(bought_for - sold_for, bet_user.portfolio_value)
         self.assertEqual(old_price, bet_event.current_buy_for_price)
         self.assertEqual(2, bet_event.turnover)
 
@@ -991,6 +1663,342 @@ class BetsManagerTestCase(TestCase):
         bet_user, bet_event, bet = Bet.objects.sell_a_bet(user, event.id, Bet.NO,
                                                           bet_event.current_sell_against_price)
 
+    def test_buy_and_sell_a_bet_quantity(self):
+        """
+        Buy and sell many bets in one transaction
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=200)
+        # price of one bet isn't the average price of 3 bets
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.buy_a_bet(user, event.id, Bet.YES, event.current_buy_for_price, 3)
+        bet_user, bet_event, bet = Bet.objects.buy_a_bet(
+            user, event.id, Bet.YES, event.price_for_quantity(Bet.YES, Bet.BUY, 3), 3
+        )
+        self.assertEqual(3, bet.has)
+        self.assertEqual(3, bet.bought)
+        # 100 * (C(3, 0) - C(0, 0)) = 161.21 rounded up
+        self.assertEqual(54, bet.bought_avg_price)
+        self.assertEqual(200 - 162, bet_user.total_cash)
+        self.assertEqual(3, bet_event.Q_for)
+        self.assertEqual(3, bet_event.turnover)
+        # 100 * (C(4, 0) - C(3, 0)) = 58.66 rounded up
+        self.assertEqual(59, bet_event.current_buy_for_price)
+
+        transactions = Transaction.objects.filter(event=event, type=Transaction.BUY_YES)
+        self.assertEqual(1, len(transactions))
+        self.assertEqual((3, -54, 0), (transactions[0].quantity, transactions[0].price,
+                                       transactions[0].price_remainder))
+
+        with self.assertRaises(InsufficientBets):
+            Bet.objects.sell_a_bet(user, event.id, Bet.YES, bet_event.current_sell_for_price, 4)
+
+        sell_price = bet_event.price_for_quantity(Bet.YES, Bet.SELL, 3)
+        self.assertEqual(53, sell_price)
+        bet_user, bet_event, bet = Bet.objects.sell_a_bet(user, event.id, Bet.YES, sell_price, 3)
+        self.assertEqual(0, bet.has)
+        self.assertEqual(3, bet.sold)
+        # 161.21 rounded down
+        self.assertEqual(200 - 162 + 161, bet_user.total_cash)
+        self.assertEqual(0, bet_event.Q_for)
+        self.assertEqual(52, bet_event.current_buy_for_price)
+
+        # 161 is booked in one row: 3 bets for 53 and the remainder of 2
+        transaction = Transaction.objects.get(event=event, type=Transaction.SELL_YES)
+        self.assertEqual((3, 53, 2), (transaction.quantity, transaction.price,
+                                      transaction.price_remainder))
+        self.assertEqual(161, transaction.total_cash)
+
+        with self.assertRaises(InvalidQuantity):
+            Bet.objects.buy_a_bet(user, event.id, Bet.YES, bet_event.current_buy_for_price, 0)
+        with self.assertRaises(InvalidQuantity):
+            Bet.objects.buy_a_bet(user, event.id, Bet.YES, bet_event.current_buy_for_price,
+                                  Bet.objects.MAX_QUANTITY + 1)
+        # cash is checked before the order is priced
+        with self.assertRaises(InsufficientCash):
+            Bet.objects.buy_a_bet(user, event.id, Bet.YES, bet_event.current_buy_for_price,
+                                  Bet.objects.MAX_QUANTITY)
+
+    def test_buy_and_sell_a_bet_price_limit(self):
+        """
+        Buy and sell at quoted price or better
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=500)
+        quote = event.quote(Bet.YES, Bet.BUY, 3)
+        Bet.objects.buy_a_bet(UserFactory(total_cash=100), event.id, Bet.YES,
+                              event.current_buy_for_price)
+
+        # price has moved above the quote
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.buy_a_bet(user, event.id, Bet.YES, quote['price'], 3, quote['price'])
+        bet_user, bet_event, bet = Bet.objects.buy_a_bet(user, event.id, Bet.YES, quote['price'],
+                                                         3, quote['price'] + 10)
+        self.assertEqual(3, bet.has)
+
+        quote = bet_event.quote(Bet.YES, Bet.SELL, 3)
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.sell_a_bet(user, event.id, Bet.YES, quote['price'], 3, quote['price'] + 1)
+        bet_user, bet_event, bet = Bet.objects.sell_a_bet(user, event.id, Bet.YES, quote['price'],
+                                                          3, quote['price'])
+        self.assertEqual(0, bet.has)
+
+    def test_execute_orders(self):
+        """
+        Execute basket of orders
+        """
+        events = EventFactory.create_batch(3)
+        user = UserFactory(total_cash=1000)
+        orders = [{
+            'event_id': event.id,
+            'buy': True,
+            'outcome': Bet.YES,
+            'for_price': event.price_for_quantity(Bet.YES, Bet.BUY, 2),
+            'quantity': 2,
+        } for event in reversed(events)]
+        bet_user, bet_events, bets = Bet.objects.execute_orders(user, orders)
+        self.assertEqual(events, bet_events)
+        self.assertEqual([2, 2, 2], [bet.has for bet in bets])
+        self.assertEqual(1000 - 3 * 105, bet_user.total_cash)
+        # one ledger row for every order
+        self.assertEqual(3, Transaction.objects.filter(type=Transaction.BUY_YES).count())
+
+        orders = [{
+            'event_id': events[0].id,
+            'buy': False,
+            'outcome': Bet.YES,
+            'for_price': bet_events[0].current_sell_for_price,
+            'quantity': 1,
+        }, {
+            'event_id': events[1].id,
+            'buy': False,
+            'outcome': Bet.YES,
+            'for_price': bet_events[1].current_sell_for_price,
+            'quantity': 3,
+        }]
+        with self.assertRaises(InsufficientBets):
+            Bet.objects.execute_orders(user, orders)
+
+        orders[0]['event_id'] = -1
+        with self.assertRaises(NonexistantEvent):
+            Bet.objects.execute_orders(user, orders)
+
+        with self.assertRaises(InvalidQuantity):
+            Bet.objects.execute_orders(user, [])
+
+    def test_create_transactions_view(self):
+        """
+        Basket endpoint executes all orders or none of them
+        """
+        events = EventFactory.create_batch(2)
+        path = reverse('create_transactions')
+        orders = [{
+            'event_id': event.id,
+            'buy': True,
+            'outcome': True,
+            'for_price': event.price_for_quantity(Bet.YES, Bet.BUY, 2),
+            'quantity': 2,
+        } for event in events]
+        response = self.client.post(path, json.dumps(orders), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(302, response.status_code)
+
+        user = UserFactory(total_cash=1000)
+        user.set_password('password')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='password'))
+        response = self.client.post(path, json.dumps(orders), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(200, response.status_code)
+        updates = json.loads(response.content)['updates']
+        self.assertEqual([event.id for event in events],
+                         [event_dict['event_id'] for event_dict in updates['events']])
+        self.assertEqual([2, 2], [bet_dict['has'] for bet_dict in updates['bets']])
+        self.assertEqual(1000 - 2 * 105, UserProfile.objects.get(id=user.id).total_cash)
+
+        # second order fails, first one is rolled back
+        orders = [{
+            'event_id': events[0].id,
+            'buy': False,
+            'outcome': True,
+            'for_price': Event.objects.get(id=events[0].id).current_sell_for_price,
+        }, {
+            'event_id': events[1].id,
+            'buy': False,
+            'outcome': True,
+            'for_price': Event.objects.get(id=events[1].id).current_sell_for_price,
+            'quantity': 3,
+        }]
+        response = self.client.post(path, json.dumps(orders), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(2, Event.objects.get(id=events[0].id).Q_for)
+
+        orders[1]['quantity'] = Bet.objects.MAX_QUANTITY + 1
+        response = self.client.post(path, json.dumps(orders), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(400, response.status_code)
+        response = self.client.post(path, json.dumps(orders[0]), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(400, response.status_code)
+        orders[0]['event_id'] = 0
+        response = self.client.post(path, json.dumps(orders[:1]),
+                                    content_type='application/json', HTTP_HOST='testserver',
+                                    secure=True)
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(2, Transaction.objects.filter(user=user).count())
+
+    def test_execute_order(self):
+        """
+        Execute order with default trading mode
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=200)
+        bet_user, bet_event, bet = Bet.objects.execute_order(
+            user, event.id, True, Bet.YES, event.price_for_quantity(Bet.YES, Bet.BUY, 2), 2
+        )
+        self.assertEqual(2, bet.has)
+        # 104.99 rounded up
+        self.assertEqual(200 - 105, bet_user.total_cash)
+        bet_user, bet_event, bet = Bet.objects.execute_order(
+            user, event.id, False, Bet.YES, bet_event.price_for_quantity(Bet.YES, Bet.SELL, 2), 2
+        )
+        self.assertEqual(0, bet.has)
+        # 104.99 rounded down
+        self.assertEqual(200 - 105 + 104, bet_user.total_cash)
+
+    def test_execute_order_slippage(self):
+        """
+        Orders with max_price or min_price are executed at the current price and counted
+        """
+        counters.reset_counters()
+        event = EventFactory()
+        user = UserFactory(total_cash=500)
+        stale_price = event.current_buy_for_price
+        Bet.objects.execute_order(UserFactory(total_cash=100), event.id, True, Bet.YES,
+                                  stale_price)
+
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.execute_order(user, event.id, True, Bet.YES, stale_price)
+        bet_user, bet_event, bet = Bet.objects.execute_order(user, event.id, True, Bet.YES,
+                                                             stale_price, 1, stale_price + 5)
+        self.assertEqual(1, bet.has)
+        # 53.74 rounded up
+        self.assertEqual(500 - 54, bet_user.total_cash)
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.execute_order(user, event.id, False, Bet.YES, 60, 1, 60)
+
+        self.assertEqual({
+            counters.ORDERS: 4,
+            counters.TOLERANT_ORDERS: 2,
+            counters.PRICE_MISMATCHES: 2,
+            counters.TOLERANT_PRICE_MISMATCHES: 1,
+            counters.OPTIMISTIC_RETRIES: 0,
+        }, counters.get_counters())
+
+    def test_counters_flush(self):
+        """
+        Counters are summed in the process and written to the cache at once
+        """
+        counters.reset_counters()
+        counters.incr(counters.ORDERS)
+        counters.incr(counters.ORDERS, 2)
+        self.assertIsNone(cache.get(counters.KEY % counters.ORDERS))
+        self.assertEqual(3, counters.get_counters()[counters.ORDERS])
+        self.assertEqual(3, cache.get(counters.KEY % counters.ORDERS))
+
+    def test_trade_optimistic(self):
+        """
+        Buy and sell with compare-and-swap on event price version
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=event.get_total_price(Bet.YES, Bet.BUY))
+        bet_user, bet_event, bet = Bet.objects.trade_optimistic(user, event.id, True, Bet.YES,
+                                                                event.current_buy_for_price)
+        self.assertEqual(1, bet.has)
+        self.assertEqual(0, bet_user.total_cash)
+        event.refresh_from_db()
+        self.assertEqual(1, event.price_version)
+        self.assertEqual(1, event.Q_for)
+        self.assertEqual(bet_event.current_buy_for_price, event.current_buy_for_price)
+
+        stale_event = Event.objects.get(id=event.id)
+        stale_event.increment_quantity(Bet.YES, 1)
+        self.assertTrue(stale_event.save_if_price_version(1))
+        stale_event.increment_quantity(Bet.YES, 1)
+        self.assertFalse(stale_event.save_if_price_version(1))
+        self.assertFalse(stale_event.lock_if_price_version(1))
+        self.assertTrue(stale_event.lock_if_price_version(2))
+
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.trade_optimistic(user, event.id, False, Bet.YES,
+                                         bet_event.current_sell_for_price)
+
+    def test_trade_optimistic_conflict(self):
+        """
+        Event traded by someone else after it was read is detected by the guarded UPDATE and
+        the trade is repeated on fresh quantities
+        """
+        counters.reset_counters()
+        event = EventFactory()
+        user = UserFactory(total_cash=1000)
+        other_user = UserFactory(total_cash=1000)
+        get_bet_for_update = Bet.objects.get_bet_for_update
+        traded_meanwhile = []
+
+        def trade_meanwhile(*args):
+            if not traded_meanwhile:
+                traded_meanwhile.append(True)
+                Bet.objects.buy_a_bet(other_user, event.id, Bet.NO,
+                                      event.current_buy_against_price)
+            return get_bet_for_update(*args)
+
+        with patch.object(Bet.objects, 'get_bet_for_update', side_effect=trade_meanwhile):
+            bet_user, bet_event, bet = Bet.objects.trade_optimistic(
+                user, event.id, True, Bet.YES, event.current_buy_for_price,
+                price_limit=event.current_buy_for_price
+            )
+        self.assertEqual(1, counters.get_counters()[counters.OPTIMISTIC_RETRIES])
+        # tests share one connection, so the other trade is rolled back with the first attempt
+        self.assertEqual(0, Transaction.objects.filter(user=other_user).count())
+        event.refresh_from_db()
+        self.assertEqual((1, 0, 1), (event.Q_for, event.Q_against, event.price_version))
+        self.assertEqual(1000 - 52, bet_user.total_cash)
+        self.assertEqual(1, Transaction.objects.filter(user=user).count())
+
+    @skipUnless(connection.vendor == 'postgresql', 'UPDATE ... RETURNING needs PostgreSQL')
+    def test_trade_returning(self):
+        """
+        Buy and sell with guarded UPDATE ... RETURNING statements
+        """
+        event = EventFactory()
+        total = event.get_total_price(Bet.YES, Bet.BUY)
+        user = UserFactory(total_cash=total)
+        bet_user, bet_event, bet = Bet.objects.trade_returning(user, event.id, True, Bet.YES,
+                                                               event.current_buy_for_price)
+        self.assertEqual(1, bet.has)
+        self.assertEqual(0, bet_user.total_cash)
+        self.assertEqual(total, bet_user.portfolio_value)
+        self.assertEqual(1, bet_event.Q_for)
+        self.assertEqual(1, bet_event.turnover)
+        self.assertEqual(1, Transaction.objects.filter(type=Transaction.BUY_YES).count())
+
+        with self.assertRaises(PriceMismatch):
+            Bet.objects.trade_returning(user, event.id, True, Bet.YES, event.current_buy_for_price)
+        with self.assertRaises(InsufficientCash):
+            Bet.objects.trade_returning(user, event.id, True, Bet.YES,
+                                        bet_event.current_buy_for_price)
+        with self.assertRaises(InsufficientBets):
+            Bet.objects.trade_returning(user, event.id, False, Bet.YES,
+                                        bet_event.current_sell_for_price, 2)
+
+        bet_user, bet_event, bet = Bet.objects.trade_returning(user, event.id, False, Bet.YES,
+                                                               bet_event.current_sell_for_price)
+        self.assertEqual(0, bet.has)
+        self.assertEqual(1, bet.sold)
+        self.assertEqual(event.current_buy_for_price, bet_user.total_cash)
+        self.assertEqual(0, bet_event.Q_for)
+
     def test_get_in_progress(self):
         """
         Get in progress
@@ -1018,6 +2026,434 @@ class BetsManagerTestCase(TestCase):
         self.assertEqual([bets[3], bets[2], bets[1]], list(Bet.objects.get_finished(user)))
 
 
+class EventSettlementManagerTestCase(TestCase):
+    """
+    events/managers EventSettlementManager
+    """
+    def test_settle_in_chunks(self):
+        """
+        Settle bets chunk by chunk
+        """
+        event = EventFactory()
+        users = UserFactory.create_batch(5, total_cash=0)
+        for user in users:
+            BetFactory(event=event, user=user, outcome=Bet.YES, has=2)
+
+        with patch.object(EventSettlement.objects, 'CHUNK_SIZE', 2):
+            settlement = event.finish_yes(settle=False)
+            self.assertTrue(event.is_settling)
+            self.assertEqual(Event.FINISHED_YES, event.outcome)
+            self.assertEqual(5, settlement.total)
+            self.assertEqual(0, Transaction.objects.filter(event=event).count())
+
+            settlement = EventSettlement.objects.settle_chunk(settlement.id)
+            self.assertEqual(EventSettlement.PENDING, settlement.status)
+            self.assertEqual(2, settlement.processed)
+            self.assertEqual(40, settlement.progress)
+            self.assertEqual(2, Transaction.objects.filter(event=event).count())
+
+            # restarted after crash, continues from the checkpoint
+            settlement = EventSettlement.objects.settle(settlement.id)
+            self.assertEqual(EventSettlement.DONE, settlement.status)
+            self.assertEqual(5, settlement.processed)
+            self.assertEqual(100, settlement.progress)
+            # settled settlement is not settled again
+            EventSettlement.objects.settle_chunk(settlement.id)
+
+        self.assertFalse(event.is_settling)
+        self.assertEqual(5, Transaction.objects.filter(event=event).count())
+        for user in users:
+            user.refresh_from_db()
+            self.assertEqual(2 * Event.PRIZE_FOR_WINNING, user.total_cash)
+
+    def test_cancel_in_chunks(self):
+        """
+        Refund users of cancelled event chunk by chunk
+        """
+        event = EventFactory()
+        users = UserFactory.create_batch(3, total_cash=0)
+        for user in users:
+            TransactionFactory(user=user, event=event, type=Transaction.BUY_YES, price=-40)
+
+        with patch.object(EventSettlement.objects, 'CHUNK_SIZE', 2):
+            settlement = event.cancel(settle=False)
+            self.assertEqual(3, settlement.total)
+            settle_event(settlement.id)
+
+        settlement.refresh_from_db()
+        self.assertEqual(EventSettlement.DONE, settlement.status)
+        for user in users:
+            user.refresh_from_db()
+            self.assertEqual(40, user.total_cash)
+
+    def test_vote_does_not_settle(self):
+        """
+        Deciding vote only finishes event
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=0)
+        BetFactory(event=event, user=user, outcome=Bet.NO, has=1)
+        for i in range(config.VOICES_TO_RESOLVE):
+            event.vote_no()
+
+        self.assertEqual(Event.FINISHED_NO, event.outcome)
+        self.assertTrue(event.is_settling)
+        user.refresh_from_db()
+        self.assertEqual(0, user.total_cash)
+
+        settle_event(event.settlement.id)
+        self.assertFalse(event.is_settling)
+        user.refresh_from_db()
+        self.assertEqual(Event.PRIZE_FOR_WINNING, user.total_cash)
+
+
+class LimitOrderManagerTestCase(TestCase):
+    """
+    events/managers LimitOrderManager
+    """
+    def test_place(self):
+        """
+        Place limit order
+        """
+        event = EventFactory()
+        user = UserFactory()
+        limit_order = LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 2, 45)
+        self.assertEqual(LimitOrder.OPEN, limit_order.status)
+        self.assertEqual(2, limit_order.quantity)
+
+        with self.assertRaises(InvalidQuantity):
+            LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 0, 45)
+        with self.assertRaises(InvalidLimitPrice):
+            LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 1, 0)
+        with self.assertRaises(NonexistantEvent):
+            LimitOrder.objects.place(user, 0, Bet.BUY, Bet.YES, 1, 45)
+
+        self.assertTrue(LimitOrder.objects.cancel(user, limit_order.id))
+        self.assertFalse(LimitOrder.objects.cancel(user, limit_order.id))
+
+    def test_limit_order_views(self):
+        """
+        Place and cancel limit order endpoints
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=100)
+        user.set_password('password')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='password'))
+
+        path = reverse('create_limit_order', kwargs={'event_id': event.id})
+        data = {'buy': True, 'outcome': True, 'quantity': 2, 'limit_price': 45}
+        response = self.client.post(path, json.dumps(data), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(200, response.status_code)
+        limit_order_dict = json.loads(response.content)['limit_order']
+        self.assertEqual((LimitOrder.OPEN, 2, 45), (
+            limit_order_dict['status'], limit_order_dict['quantity'],
+            limit_order_dict['limit_price']
+        ))
+
+        response = self.client.post(reverse('create_limit_order', kwargs={'event_id': 0}),
+                                    json.dumps(data), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(404, response.status_code)
+        response = self.client.post(path, json.dumps({'buy': True}),
+                                    content_type='application/json', HTTP_HOST='testserver',
+                                    secure=True)
+        self.assertEqual(400, response.status_code)
+        data['limit_price'] = 0
+        response = self.client.post(path, json.dumps(data), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(400, response.status_code)
+
+        # marketable order is executed right away
+        data.update({'quantity': 1, 'limit_price': 52})
+        response = self.client.post(path, json.dumps(data), content_type='application/json',
+                                    HTTP_HOST='testserver', secure=True)
+        self.assertEqual(LimitOrder.FILLED, json.loads(response.content)['limit_order']['status'])
+
+        path = reverse('cancel_limit_order',
+                       kwargs={'limit_order_id': limit_order_dict['limit_order_id']})
+        response = self.client.post(path, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(LimitOrder.CANCELLED,
+                         json.loads(response.content)['limit_order']['status'])
+        response = self.client.post(path, HTTP_HOST='testserver', secure=True)
+        self.assertEqual(400, response.status_code)
+
+        other = LimitOrder.objects.place(UserFactory(), event.id, Bet.BUY, Bet.YES, 1, 45)
+        response = self.client.post(
+            reverse('cancel_limit_order', kwargs={'limit_order_id': other.id}),
+            HTTP_HOST='testserver', secure=True
+        )
+        self.assertEqual(404, response.status_code)
+
+    def test_match_event(self):
+        """
+        Execute marketable limit orders
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=100)
+        poor_user = UserFactory(total_cash=0)
+        waiting = LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 1, 45)
+        buy = LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 1, 52)
+        self.assertEqual([buy], LimitOrder.objects.match_event(event.id))
+
+        bet = Bet.objects.get(user=user, event=event, outcome=Bet.YES)
+        self.assertEqual(1, bet.has)
+        buy.refresh_from_db()
+        self.assertEqual(LimitOrder.FILLED, buy.status)
+        self.assertIsNotNone(buy.executed_date)
+
+        # sell brings the price back, waiting order is still not marketable
+        sell = LimitOrder.objects.place(user, event.id, Bet.SELL, Bet.YES, 1, 49)
+        rejected = LimitOrder.objects.place(poor_user, event.id, Bet.BUY, Bet.YES, 1, 60)
+        self.assertEqual([sell], LimitOrder.objects.match_event(event.id))
+        bet.refresh_from_db()
+        self.assertEqual(0, bet.has)
+        rejected.refresh_from_db()
+        self.assertEqual(LimitOrder.REJECTED, rejected.status)
+        waiting.refresh_from_db()
+        self.assertEqual(LimitOrder.OPEN, waiting.status)
+
+        event.finish_yes()
+        waiting.refresh_from_db()
+        self.assertEqual(LimitOrder.CANCELLED, waiting.status)
+
+    def test_match_event_skips_orders(self):
+        """
+        Order which can't be executed for its whole quantity doesn't stop matching
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=1000)
+        # average price of 10 bets is above 51
+        big = LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 10, 51)
+        small = LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 1, 52)
+        with patch.object(LimitOrder.objects, 'MATCHING_BATCH_SIZE', 1):
+            self.assertEqual([small], LimitOrder.objects.match_event(event.id))
+        big.refresh_from_db()
+        self.assertEqual(LimitOrder.OPEN, big.status)
+
+    @override_settings(TRADING_MODE='optimistic')
+    def test_match_event_trading_mode(self):
+        """
+        Limit orders are executed with the configured trading mode
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=100)
+        buy = LimitOrder.objects.place(user, event.id, Bet.BUY, Bet.YES, 1, 52)
+        with patch.object(Bet.objects, 'trade_optimistic',
+                          wraps=Bet.objects.trade_optimistic) as trade_optimistic:
+            self.assertEqual([buy], LimitOrder.objects.match_event(event.id))
+        self.assertEqual(1, trade_optimistic.call_count)
+
+
+class IdempotencyKeyTestCase(TestCase):
+    """
+    events/managers IdempotencyKeyManager and Idempotency-Key header of create_transaction
+    """
+    def test_claim(self):
+        """
+        Claim key
+        """
+        user = UserFactory()
+        stored_key = IdempotencyKey.objects.claim(user, 'key-1')
+        self.assertIsNotNone(stored_key)
+        # response is not saved yet
+        self.assertIsNone(IdempotencyKey.objects.get_response(user, 'key-1'))
+        self.assertIsNone(IdempotencyKey.objects.claim(user, 'key-1'))
+        self.assertIsNotNone(IdempotencyKey.objects.claim(UserFactory(), 'key-1'))
+
+        stored_key.response = '{}'
+        stored_key.save()
+        self.assertEqual('{}', IdempotencyKey.objects.get_response(user, 'key-1'))
+
+        with freeze_time(timezone.now() + IdempotencyKey.objects.TTL + timedelta(seconds=1)):
+            self.assertIsNone(IdempotencyKey.objects.get_response(user, 'key-1'))
+            self.assertEqual(2, IdempotencyKey.objects.expired().count())
+            self.assertIsNotNone(IdempotencyKey.objects.claim(user, 'key-1'))
+
+    def test_create_transaction_retry(self):
+        """
+        Retried transaction is executed once
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=100)
+        user.set_password('password')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='password'))
+
+        path = reverse('create_transaction', kwargs={'event_id': event.id})
+        data = json.dumps({
+            'buy': True,
+            'outcome': True,
+            'for_price': event.current_buy_for_price,
+        })
+        response = self.client.post(path, data, content_type='application/json',
+                                    HTTP_IDEMPOTENCY_KEY='retry-1', HTTP_HOST='testserver',
+                                    secure=True)
+        self.assertEqual(200, response.status_code)
+        retried = self.client.post(path, data, content_type='application/json',
+                                   HTTP_IDEMPOTENCY_KEY='retry-1', HTTP_HOST='testserver',
+                                   secure=True)
+        self.assertEqual(200, retried.status_code)
+        self.assertEqual(response.content, retried.content)
+
+        self.assertEqual(1, Transaction.objects.filter(event=event).count())
+        self.assertEqual(1, Event.objects.get(id=event.id).Q_for)
+
+    def test_create_transaction_retry_failed(self):
+        """
+        Failed transaction can be retried, unless the market engine may still execute it
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=100)
+        user.set_password('password')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='password'))
+
+        path = reverse('create_transaction', kwargs={'event_id': event.id})
+        data = json.dumps({
+            'buy': True,
+            'outcome': True,
+            'for_price': event.current_buy_for_price,
+        })
+        with patch.object(Bet.objects, 'execute_order',
+                          side_effect=DraftEvent("Draft")) as execute_order:
+            for i in range(2):
+                response = self.client.post(path, data, content_type='application/json',
+                                            HTTP_IDEMPOTENCY_KEY='retry-1',
+                                            HTTP_HOST='testserver', secure=True)
+                self.assertEqual(400, response.status_code)
+        self.assertEqual(2, execute_order.call_count)
+
+        # the engine has rolled the order back
+        with patch.object(Bet.objects, 'execute_order',
+                          side_effect=MarketEngineError("Failed")) as execute_order:
+            for i in range(2):
+                response = self.client.post(path, data, content_type='application/json',
+                                            HTTP_IDEMPOTENCY_KEY='retry-2',
+                                            HTTP_HOST='testserver', secure=True)
+                self.assertEqual(400, response.status_code)
+        self.assertEqual(2, execute_order.call_count)
+
+        with patch.object(Bet.objects, 'execute_order',
+                          side_effect=MarketEngineTimeout("Timeout")) as execute_order:
+            response = self.client.post(path, data, content_type='application/json',
+                                        HTTP_IDEMPOTENCY_KEY='retry-3', HTTP_HOST='testserver',
+                                        secure=True)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual('Timeout', json.loads(response.content)['error'])
+            retried = self.client.post(path, data, content_type='application/json',
+                                       HTTP_IDEMPOTENCY_KEY='retry-3', HTTP_HOST='testserver',
+                                       secure=True)
+            self.assertEqual(409, retried.status_code)
+        self.assertEqual(1, execute_order.call_count)
+
+
+class MarketEngineTestCase(TestCase):
+    """
+    events/engine
+    """
+    def setUp(self):
+        self.engine = MarketEngine(queue_class=LocalQueue)
+        self.client = MarketEngineClient(queue_class=LocalQueue)
+
+    def execute(self, user, event, buy, outcome, price, quantity=1):
+        reply_to = self.client.submit(user, event.id, buy, outcome, price, quantity)
+        self.engine.run_once()
+        return self.client.wait(reply_to, user, event.id, outcome)
+
+    def test_execute_orders(self):
+        """
+        Execute orders of many users in one batch
+        """
+        event = EventFactory()
+        users = UserFactory.create_batch(3, total_cash=100)
+        replies = [
+            self.client.submit(user, event.id, True, Bet.YES, event.current_buy_for_price)
+            for user in users
+        ]
+        self.engine.run_once()
+
+        bet_user, bet_event, bet = self.client.wait(replies[0], users[0], event.id, Bet.YES)
+        self.assertEqual(1, bet.has)
+        self.assertEqual(100 - 52, bet_user.total_cash)
+        self.assertEqual(1, bet_event.Q_for)
+        # price has changed after the first order
+        with self.assertRaises(PriceMismatch):
+            self.client.wait(replies[1], users[1], event.id, Bet.YES)
+        with self.assertRaises(PriceMismatch):
+            self.client.wait(replies[2], users[2], event.id, Bet.YES)
+
+        bet_user, bet_event, bet = self.execute(users[1], event, True, Bet.YES,
+                                                bet_event.current_buy_for_price)
+        self.assertEqual(2, bet_event.Q_for)
+        self.assertEqual(2, bet_event.price_version)
+        self.assertEqual(2, Transaction.objects.filter(event=event).count())
+
+        with self.assertRaises(InsufficientBets):
+            self.execute(users[2], event, False, Bet.YES, bet_event.current_sell_for_price)
+        with self.assertRaises(NonexistantEvent):
+            self.execute(users[2], Event(id=-1), True, Bet.YES, 50)
+
+    def test_state_changed_outside_engine(self):
+        """
+        Event traded outside of the engine
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=1000)
+        self.execute(user, event, True, Bet.YES, event.current_buy_for_price)
+        bet_user, bet_event, bet = Bet.objects.buy_a_bet(user, event.id, Bet.YES,
+                                                         Event.objects.get(id=event.id)
+                                                         .current_buy_for_price)
+        bet_user, bet_event, bet = self.execute(user, event, True, Bet.YES,
+                                                bet_event.current_buy_for_price)
+        self.assertEqual(3, bet.has)
+        self.assertEqual(3, bet_event.Q_for)
+
+    def test_recover_event(self):
+        """
+        Rebuild event from ledger
+        """
+        event = EventFactory()
+        user = UserFactory(total_cash=1000)
+        Bet.objects.buy_a_bet(user, event.id, Bet.YES,
+                              event.price_for_quantity(Bet.YES, Bet.BUY, 3), 3)
+        self.assertFalse(MarketEngine.recover_event(event.id))
+
+        Event.objects.filter(id=event.id).update(Q_for=0)
+        self.assertTrue(MarketEngine.recover_event(event.id))
+        event.refresh_from_db()
+        self.assertEqual(3, event.Q_for)
+        self.assertEqual(59, event.current_buy_for_price)
+
+    def test_recover_event_ignores_snapshot(self):
+        """
+        Event is rebuilt from the whole ledger, not from a snapshot of its broken state
+        """
+        user = UserFactory(total_cash=1000)
+        # quantities which aren't in the ledger
+        event = EventFactory(Q_for=10)
+        Event.snapshots.bulk_snapshot(Event.objects.filter(id=event.id))
+        Bet.objects.buy_a_bet(user, event.id, Bet.YES,
+                              event.price_for_quantity(Bet.YES, Bet.BUY, 3), 3)
+
+        self.assertTrue(MarketEngine.recover_event(event.id))
+        event.refresh_from_db()
+        self.assertEqual(3, event.Q_for)
+        self.assertFalse(MarketEngine.recover_event(event.id))
+
+    def test_idle_writer(self):
+        """
+        Writer without orders is stopped
+        """
+        event = EventFactory()
+        engine = MarketEngine(queue_class=LocalQueue, idle_timeout=0)
+        writer = engine.writer_for(event.id)
+        engine.run_writer(writer)
+        self.assertEqual({}, engine.writers)
+
+
 class TransactionsModelTestCase(TestCase):
     """
     Test methods for transaction
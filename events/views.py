@@ -1,11 +1,14 @@
+from datetime import datetime
 import json
 import logging
 
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.core import signing
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
 from django.http import Http404, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext as _
 from django.views.decorators.clickjacking import xframe_options_exempt
@@ -16,11 +19,15 @@ from django.views.generic import DetailView
 
 from .exceptions import (
     NonexistantEvent, DraftEvent, PriceMismatch, EventNotInProgress,
-    UnknownOutcome, InsufficientBets, InsufficientCash
+    UnknownOutcome, InsufficientBets, InsufficientCash, InvalidQuantity, InvalidLimitPrice,
+    DuplicateIdempotencyKey, MarketEngineError, MarketEngineTimeout
 )
-from .models import Event, Bet, SolutionVote, EventCategory
+from .models import (
+    Event, Bet, SolutionVote, EventCategory, LimitOrder, IdempotencyKey, EventSettlement
+)
+from .tasks import match_limit_orders, settle_event
 from accounts.models import UserProfile
-from bladepolska.http import JSONResponse, JSONResponseBadRequest
+from bladepolska.http import JSONResponse, JSONResponseBadRequest, JSONResponseConflict
 from haystack.generic_views import SearchView
 # from haystack.query import SearchQuerySet
 
@@ -72,6 +79,11 @@ class EventsListView(SearchView):
             context['active'] = self.kwargs['category']
         context['popular_tags'] = Event.tags.most_common()[:10]
         context['categories'] = EventCategory.objects.all()
+        # charts of the whole page in one query, attached to events rendered by render_events
+        Event.objects.charts_for(
+            [result.object for result in context['object_list'] if result.object is not None],
+            Event.EVENT_SMALL_CHART_DAYS
+        )
         return context
 
 
@@ -158,96 +170,434 @@ class EventEmbedDetailView(DetailView):
         return super(EventEmbedDetailView, self).dispatch(request, *args, **kwargs)
 
 
+QUOTE_MAX_AGE = 15  # seconds
+QUOTE_SALT = 'events.quote'
+
+
+def sign_quote(quote, user):
+    """
+    Short-lived token which lets the user trade at quoted price or better
+    :param quote: result of Event.quote
+    :type quote: {}
+    :param user: logged user
+    :type user: UserProfile
+    :return: token
+    :rtype: str
+    """
+    return signing.dumps(dict(quote, user_id=user.id), salt=QUOTE_SALT)
+
+
+def load_quote(token, user):
+    """
+    Quote of valid and not expired token of the user
+    :param token: token from sign_quote
+    :type token: str
+    :param user: logged user
+    :type user: UserProfile
+    :return: quote or None
+    :rtype: {}
+    """
+    try:
+        quote = signing.loads(token, salt=QUOTE_SALT, max_age=QUOTE_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if quote['user_id'] != user.id:
+        return None
+    return quote
+
+
+def get_price_limit(data, buy):
+    """
+    Slippage tolerance of an order: max_price for buy, min_price for sell. Order with a limit is
+    executed at the current price as long as the average price is within the limit.
+    :param data: order
+    :type data: {}
+    :param buy: True for buy, False for sell
+    :type buy: bool
+    :return: price limit or None
+    :rtype: int
+    """
+    price_limit = data.get('max_price' if buy else 'min_price')
+    if price_limit is None:
+        return None
+    return int(price_limit)
+
+
+def get_idempotency_key(request):
+    """
+    Idempotency-Key header; client sends the same key when it retries the request
+    :param request:
+    :type request: WSGIRequest
+    :return: key or None
+    :rtype: str
+    """
+    return request.META.get('HTTP_IDEMPOTENCY_KEY') or None
+
+
+def claim_idempotency_key(user, key):
+    """
+    Store the key in the current transaction
+    :return: key to save response in or None if there's no key
+    :rtype: IdempotencyKey
+    """
+    if key is None:
+        return None
+    idempotency_key = IdempotencyKey.objects.claim(user, key)
+    if idempotency_key is None:
+        raise DuplicateIdempotencyKey()
+    return idempotency_key
+
+
+def release_idempotency_key(stored_key):
+    """
+    Delete the key of a request which wasn't executed, so it can be retried
+    :param stored_key: key returned by claim_idempotency_key
+    :type stored_key: IdempotencyKey
+    """
+    if stored_key is not None:
+        stored_key.delete()
+
+
+def duplicate_request_response(user, key):
+    """
+    Response of the original request, 409 if it's still being executed
+    :rtype: JSONResponse
+    """
+    response = IdempotencyKey.objects.get_response(user, key)
+    if response is None:
+        return JSONResponseConflict(json.dumps({
+            'error': _("Request is already being processed."),
+        }))
+    return JSONResponse(response)
+
+
+TRANSACTION_ERRORS = (
+    DraftEvent, PriceMismatch, InsufficientCash, InsufficientBets, EventNotInProgress,
+    UnknownOutcome, InvalidQuantity, MarketEngineError
+)
+
+
+def transaction_error_response(e):
+    """
+    Bad request response for failed buy or sell
+    :param e: one of TRANSACTION_ERRORS
+    :type e: Exception
+    :return: json with error message and updated objects
+    :rtype: JSONResponseBadRequest
+    """
+    result = {
+        'error': unicode(e.message.decode('utf-8')),
+    }
+    if isinstance(e, PriceMismatch):
+        result['updates'] = {
+            'events': [
+                e.updated_event.event_dict
+            ]
+        }
+    elif isinstance(e, InsufficientCash):
+        result['updates'] = {
+            'user': [
+                e.updated_user.statistics_dict
+            ]
+        }
+    elif isinstance(e, InsufficientBets):
+        result['updates'] = {
+            'bets': [
+                e.updated_bet.bet_dict
+            ]
+        }
+
+    return JSONResponseBadRequest(json.dumps(result))
+
+
 @login_required
 @require_http_methods(["POST"])
 @csrf_exempt
-@transaction.atomic
 def create_transaction(request, event_id):
     """
-    Buy or sell bet
+    Buy or sell bet. Optional max_price (buy) or min_price (sell) lets the order be executed at
+    the current price instead of failing when the price has moved within the limit.
+    Retried request with the same Idempotency-Key header gets the original response.
+    Only the trade is wrapped in a transaction, not the whole view: limit orders are matched by
+    a task dispatched after the trade is committed, which must see the new prices.
     :param request:
     :param event_id:
     :return:
     """
+    idempotency_key = get_idempotency_key(request)
+    if idempotency_key is not None:
+        if len(idempotency_key) > IdempotencyKey.KEY_MAX_LENGTH:
+            return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+        if IdempotencyKey.objects.get_response(request.user, idempotency_key) is not None:
+            return duplicate_request_response(request.user, idempotency_key)
+
     data = json.loads(request.body)
     try:
         # simple params validation
         buy = bool(data['buy'])              # True - buy, False - sell
         outcome = bool(data['outcome'])      # True - YES,   False - NO
         for_price = int(data['for_price'])   # price
+        quantity = int(data.get('quantity', 1))
+        price_limit = get_price_limit(data, buy)
 
-    except KeyError:
+    except (KeyError, ValueError, TypeError):
         return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    if not 1 <= quantity <= Bet.objects.MAX_QUANTITY:
+        return JSONResponseBadRequest(json.dumps({
+            'error': _("Invalid quantity."),
+        }))
+
+    # quoted price or better is accepted even if price has changed since the quote
+    if data.get('quote'):
+        quote = load_quote(data['quote'], request.user)
+        if quote is None:
+            return JSONResponseBadRequest(json.dumps({
+                'error': _("Quote has expired."),
+            }))
+        if (quote['event_id'], quote['buy'], quote['outcome'], quote['quantity']) != \
+                (int(event_id), buy, outcome, quantity):
+            return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+        price_limit = quote['price']
+
+    # the key is committed before the trade: in the 'engine' trading mode the trade is committed
+    # by the engine process, so after a timeout the key has to stay until the order is done
     try:
-        if buy:
-            user, event, bet = Bet.objects.buy_a_bet(request.user, event_id, outcome, for_price)
-        else:
-            user, event, bet = Bet.objects.sell_a_bet(request.user, event_id, outcome, for_price)
+        with transaction.atomic():
+            stored_key = claim_idempotency_key(request.user, idempotency_key)
+    except DuplicateIdempotencyKey:
+        return duplicate_request_response(request.user, idempotency_key)
+
+    try:
+        try:
+            with transaction.atomic():
+                user, event, bet = Bet.objects.execute_order(request.user, event_id, buy,
+                                                             outcome, for_price, quantity,
+                                                             price_limit)
+                result = json.dumps({
+                    'updates': {
+                        'bets': [
+                            bet.bet_dict
+                        ],
+                        'events': [
+                            event.event_dict
+                        ],
+                        'user': user.statistics_dict
+                    }
+                })
+                if stored_key is not None:
+                    stored_key.response = result
+                    stored_key.save(update_fields=['response'])
+        except MarketEngineTimeout:
+            # order may still be executed by the engine, retries get 409
+            raise
+        except Exception:
+            release_idempotency_key(stored_key)
+            raise
     except NonexistantEvent:
         raise Http404
-    except DraftEvent as e:
-        result = {
-            'error': unicode(e.message.decode('utf-8')),
-        }
-        return JSONResponseBadRequest(json.dumps(result))
-    except PriceMismatch as e:
-        result = {
-            'error': unicode(e.message.decode('utf-8')),
-            'updates': {
-                'events': [
-                    e.updated_event.event_dict
-                ]
-            }
-        }
-        return JSONResponseBadRequest(json.dumps(result))
-    except InsufficientCash as e:
-        result = {
-            'error': unicode(e.message.decode('utf-8')),
-            'updates': {
-                'user': [
-                    e.updated_user.statistics_dict
-                ]
-            }
-        }
+    except TRANSACTION_ERRORS as e:
+        return transaction_error_response(e)
 
-        return JSONResponseBadRequest(json.dumps(result))
-    except InsufficientBets as e:
-        result = {
-            'error': unicode(e.message.decode('utf-8')),
-            'updates': {
-                'bets': [
-                    e.updated_bet.bet_dict
-                ]
-            }
-        }
+    # prices have changed and are committed
+    match_limit_orders.delay(event.id)
 
-        return JSONResponseBadRequest(json.dumps(result))
-    except EventNotInProgress as e:
-        result = {
-            'error': unicode(e.message.decode('utf-8')),
-        }
+    return JSONResponse(result)
 
-        return JSONResponseBadRequest(json.dumps(result))
-    except UnknownOutcome as e:
-        result = {
-            'error': unicode(e.message.decode('utf-8')),
-        }
 
-        return JSONResponseBadRequest(json.dumps(result))
-    
-    result = {
-        'updates': {
-            'bets': [
-                bet.bet_dict
-            ],
-            'events': [
-                event.event_dict
-            ],
-            'user': user.statistics_dict
-        }
-    }
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+def create_transactions(request):
+    """
+    Buy or sell bets of many events in one database transaction. If any order fails, none of
+    them is executed. Retried request with the same Idempotency-Key header gets the original
+    response.
+    :param request: json list of orders: event_id, buy, outcome, for_price, quantity and
+        optional max_price (buy) or min_price (sell)
+    :type request: WSGIRequest
+    :return: json with all changed bets and events
+    :rtype: JSONResponse
+    """
+    idempotency_key = get_idempotency_key(request)
+    if idempotency_key is not None:
+        if len(idempotency_key) > IdempotencyKey.KEY_MAX_LENGTH:
+            return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+        if IdempotencyKey.objects.get_response(request.user, idempotency_key) is not None:
+            return duplicate_request_response(request.user, idempotency_key)
 
-    return JSONResponse(json.dumps(result))
+    try:
+        orders = [{
+            'event_id': int(order['event_id']),
+            'buy': bool(order['buy']),
+            'outcome': bool(order['outcome']),
+            'for_price': int(order['for_price']),
+            'quantity': int(order.get('quantity', 1)),
+            'price_limit': get_price_limit(order, bool(order['buy'])),
+        } for order in json.loads(request.body)]
+    except (KeyError, ValueError, TypeError, AttributeError):
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+    if any(not 1 <= order['quantity'] <= Bet.objects.MAX_QUANTITY for order in orders):
+        return JSONResponseBadRequest(json.dumps({
+            'error': _("Invalid quantity."),
+        }))
+
+    try:
+        with transaction.atomic():
+            stored_key = claim_idempotency_key(request.user, idempotency_key)
+            user, events, bets = Bet.objects.execute_orders(request.user, orders)
+            result = json.dumps({
+                'updates': {
+                    'bets': [bet.bet_dict for bet in bets],
+                    'events': [event.event_dict for event in events],
+                    'user': user.statistics_dict
+                }
+            })
+            if stored_key is not None:
+                stored_key.response = result
+                stored_key.save(update_fields=['response'])
+    except DuplicateIdempotencyKey:
+        return duplicate_request_response(request.user, idempotency_key)
+    except NonexistantEvent:
+        raise Http404
+    except TRANSACTION_ERRORS as e:
+        return transaction_error_response(e)
+
+    for event in events:
+        match_limit_orders.delay(event.id)
+
+    return JSONResponse(result)
+
+
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+def create_limit_order(request, event_id):
+    """
+    Place resting order executed when price reaches the limit
+    :param request: json with buy, outcome, quantity, limit_price
+    :type request: WSGIRequest
+    :param event_id: event id
+    :type event_id: int
+    :return: json with limit order
+    :rtype: JSONResponse
+    """
+    try:
+        data = json.loads(request.body)
+        buy = bool(data['buy'])
+        outcome = bool(data['outcome'])
+        quantity = int(data.get('quantity', 1))
+        limit_price = int(data['limit_price'])
+    except (KeyError, ValueError, TypeError):
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    try:
+        limit_order = LimitOrder.objects.place(request.user, event_id, buy, outcome, quantity,
+                                               limit_price)
+    except NonexistantEvent:
+        raise Http404
+    except TRANSACTION_ERRORS + (InvalidLimitPrice,) as e:
+        return transaction_error_response(e)
+
+    # limit may be marketable already
+    match_limit_orders.delay(limit_order.event_id)
+    limit_order.refresh_from_db()
+
+    return JSONResponse(json.dumps({
+        'limit_order': limit_order.limit_order_dict,
+    }))
+
+
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+def cancel_limit_order(request, limit_order_id):
+    """
+    Cancel open limit order of logged user
+    :param request:
+    :type request: WSGIRequest
+    :param limit_order_id: limit order id
+    :type limit_order_id: int
+    :return: json with limit order
+    :rtype: JSONResponse
+    """
+    limit_order = get_object_or_404(LimitOrder, id=limit_order_id, user=request.user)
+    if not LimitOrder.objects.cancel(request.user, limit_order.id):
+        return JSONResponseBadRequest(json.dumps({
+            'error': _("Limit order is no longer open."),
+        }))
+    limit_order.refresh_from_db()
+
+    return JSONResponse(json.dumps({
+        'limit_order': limit_order.limit_order_dict,
+    }))
+
+
+@login_required
+@require_http_methods(["GET"])
+def quote(request, event_id):
+    """
+    Price of bets if they were bought or sold now, with a token which can be sent with
+    create_transaction to trade at the quoted price or better.
+    :param request: GET params: buy, outcome (true or false), quantity
+    :type request: WSGIRequest
+    :param event_id: event id
+    :type event_id: int
+    :return: json with quote and token
+    :rtype: JSONResponse
+    """
+    try:
+        buy = request.GET.get('buy', 'true') == 'true'
+        outcome = request.GET['outcome'] == 'true'
+        quantity = int(request.GET.get('quantity', 1))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    if not 1 <= quantity <= Bet.objects.MAX_QUANTITY:
+        return JSONResponseBadRequest(json.dumps({
+            'error': _("Invalid quantity."),
+        }))
+    event = get_object_or_404(Event, id=event_id, is_published=True)
+    if not event.is_in_progress:
+        return JSONResponseBadRequest(json.dumps({
+            'error': _("Event is no longer in progress."),
+        }))
+
+    quote = event.quote(outcome, buy, quantity)
+    return JSONResponse(json.dumps({
+        'quote': quote,
+        'token': sign_quote(quote, request.user),
+    }))
+
+
+@require_http_methods(["GET"])
+def tick_chart(request, event_id):
+    """
+    Price after every trade of the event in a time range, downsampled to a bounded number of
+    points
+    :param request: GET params: start, end (seconds since epoch), points
+    :type request: WSGIRequest
+    :param event_id: event id
+    :type event_id: int
+    :return: json with times (ms since epoch) and YES prices
+    :rtype: JSONResponse
+    """
+    try:
+        start, end = [
+            datetime.fromtimestamp(int(request.GET[param]), timezone.utc)
+            if request.GET.get(param) else None
+            for param in ('start', 'end')
+        ]
+        points = int(request.GET.get('points', Event.TICK_CHART_POINTS))
+    except (ValueError, OverflowError):
+        return HttpResponseBadRequest(_("Something went wrong, try again in a few seconds."))
+
+    event = get_object_or_404(Event, id=event_id)
+    if not request.user.is_staff and not event.is_published:
+        raise Http404
+    points = max(3, min(points, Event.TICK_CHART_MAX_POINTS))
+
+    return JSONResponse(json.dumps(event.get_tick_chart(start, end, points)))
 
 
 @login_required
@@ -279,10 +629,9 @@ def bets_viewed(request):
 @user_passes_test(lambda u: u.is_staff)
 @require_http_methods(["POST"])
 @csrf_exempt
-@transaction.atomic
 def resolve_event(request, event_id):
     """
-    Vote for yes or no
+    Vote for yes or no. The deciding vote finishes the event and bets are settled in background.
     :param request:
     :type request: WSGIRequest
     :param event_id: event id
@@ -291,7 +640,8 @@ def resolve_event(request, event_id):
     """
     data = json.loads(request.body)
     try:
-        vote_result = Event.objects.vote_for_solution(request.user, event_id, data['outcome'])
+        with transaction.atomic():
+            vote_result = Event.objects.vote_for_solution(request.user, event_id, data['outcome'])
     except EventNotInProgress as e:
         result = {
             'error': unicode(e.message.decode('utf-8')),
@@ -299,6 +649,11 @@ def resolve_event(request, event_id):
 
         return JSONResponseBadRequest(json.dumps(result))
 
+    # settlement is committed, so the task can see it
+    for settlement_id in EventSettlement.objects.pending().filter(event_id=event_id).\
+            values_list('id', flat=True):
+        settle_event.delay(settlement_id)
+
     result = {
         'updates': vote_result
     }
@@ -0,0 +1,32 @@
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+
+from events.models import Candle, Transaction
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds OHLC candles (events.models.Candle) of events from the transaction history. ' \
+           'Transactions are streamed, only candles of one event are kept in memory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, default=None, dest='event_id')
+
+    def handle(self, *args, **options):
+        transactions = Transaction._base_manager.filter(
+            type__in=Transaction.BUY_SELL_TYPES, event__isnull=False
+        )
+        if options['event_id']:
+            transactions = transactions.filter(event_id=options['event_id'])
+        rows = transactions.order_by('event_id', 'date', 'id').values_list(
+            'event_id', 'date', 'type', 'price', 'quantity'
+        )
+
+        events = total = 0
+        for event_id, event_rows in groupby(rows.iterator(), key=lambda row: row[0]):
+            count = Candle.objects.rebuild(event_id, (row[1:] for row in event_rows))
+            events += 1
+            total += count
+            self.stdout.write('event #%d: %d candles' % (event_id, count))
+
+        self.stdout.write('%d candles of %d events' % (total, events))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
+
+from events.models import Event, EventPriceDay
+
+
+class Command(BaseCommand):
+    help = 'Converts event snapshots to packed price days (events.models.EventPriceDay) used by ' \
+           'charts. Points already stored for the same minute are kept.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, default=None, dest='event_id')
+
+    def handle(self, *args, **options):
+        snapshots = Event.snapshots.all()
+        if options['event_id']:
+            snapshots = snapshots.filter(snapshot_of_id=options['event_id'])
+        event_ids = list(snapshots.order_by('snapshot_of_id').values_list(
+            'snapshot_of_id', flat=True
+        ).distinct())
+
+        total = 0
+        for event_id in event_ids:
+            points_by_day = {}
+            rows = snapshots.filter(snapshot_of_id=event_id).order_by('created_at').values_list(
+                'created_at', *EventPriceDay.POINT_FIELDS
+            )
+            for row in rows.iterator():
+                created_at = localtime(row[0])
+                points_by_day.setdefault(created_at.date(), []).append(
+                    (created_at.hour * 60 + created_at.minute,) + tuple(row[1:])
+                )
+            EventPriceDay.objects.merge_points({event_id: points_by_day})
+            total += len(points_by_day)
+            self.stdout.write('event #%d: %d days' % (event_id, len(points_by_day)))
+
+        self.stdout.write('%d price days of %d events' % (total, len(event_ids)))
@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from events import pricing
+from events.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Compares scalar and batched LMSR pricing throughput (events.pricing) over random ' \
+           'markets. Doesn\'t touch the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--markets', default=100000, dest='markets', type=int)
+        parser.add_argument('--seed', default=0, dest='seed', type=int)
+
+    def handle(self, *args, **options):
+        markets = options['markets']
+        random = np.random.RandomState(options['seed'])
+        Q_for = random.randint(0, 5000, markets)
+        Q_against = random.randint(0, 5000, markets)
+        B = random.choice([5., 10., 50., 100., 1000.], markets)
+        markets_list = list(zip(Q_for.tolist(), Q_against.tolist(), B.tolist()))
+
+        self.measure('Event.calculate_prices', markets, lambda: [
+            Event.calculate_prices(q_for, q_against, b) for q_for, q_against, b in markets_list
+        ])
+        self.measure('pricing.prices', markets, lambda: [
+            pricing.prices(q_for, q_against, b) for q_for, q_against, b in markets_list
+        ])
+        self.measure('pricing.batch_prices', markets, lambda: pricing.batch_prices(
+            Q_for, Q_against, B
+        ))
+        self.measure('pricing.cost_to_move', markets, lambda: [
+            pricing.cost_to_move(q_for, q_against, b, True, 10)
+            for q_for, q_against, b in markets_list
+        ])
+        self.measure('pricing.batch_cost_to_move', markets, lambda: pricing.batch_cost_to_move(
+            Q_for, Q_against, B, True, 10
+        ))
+
+    def measure(self, name, markets, function):
+        start = time.time()
+        function()
+        seconds = time.time() - start
+        self.stdout.write('%s: %d markets in %.3fs, %.0f markets/s' % (
+            name, markets, seconds, markets / seconds
+        ))
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bladepolska.snapshots import create_snapshot_manager_class, \
+    create_snapshot_manager_with_pk_class
+from events.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Compares accessing snapshot managers (bladepolska.snapshots.SnapshotDescriptor) ' \
+           'with creating manager classes on every access. Doesn\'t touch the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accesses', default=100000, dest='accesses', type=int)
+
+    def handle(self, *args, **options):
+        accesses = options['accesses']
+        event = Event(id=1)
+        manager = Event.snapshots.model._default_manager
+
+        self.measure('event.snapshots', accesses, lambda: [
+            event.snapshots for i in range(accesses)
+        ])
+        self.measure('new class per event.snapshots', accesses, lambda: [
+            create_snapshot_manager_with_pk_class(manager, 'snapshot_of')(event)
+            for i in range(accesses)
+        ])
+        self.measure('Event.snapshots', accesses, lambda: [
+            Event.snapshots for i in range(accesses)
+        ])
+        self.measure('new class per Event.snapshots', accesses, lambda: [
+            create_snapshot_manager_class(manager)() for i in range(accesses)
+        ])
+
+    def measure(self, name, accesses, function):
+        start = time.time()
+        function()
+        seconds = time.time() - start
+        self.stdout.write('%s: %d accesses in %.3fs, %.0f accesses/s' % (
+            name, accesses, seconds, accesses / seconds
+        ))
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from accounts.models import UserProfile
+from events.exceptions import PriceMismatch
+from events.models import Bet, Event, Transaction
+
+
+class Command(BaseCommand):
+    help = 'Measures trades per second on a single hot event for every trading mode. ' \
+           'Creates a temporary event and users and removes them afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default='locking,optimistic', dest='modes')
+        parser.add_argument('--threads', default=8, dest='threads', type=int)
+        parser.add_argument('--trades', default=100, dest='trades', type=int,
+                            help='trades per thread')
+        parser.add_argument('--slippage', default=None, dest='slippage', type=int,
+                            help='send max_price = price + slippage with every order')
+
+    def handle(self, *args, **options):
+        for mode in options['modes'].split(','):
+            event = Event.objects.create(
+                title='benchmark_trading %s' % mode,
+                estimated_end_date=now(),
+                is_published=True,
+                B=1000,
+            )
+            users = [
+                UserProfile.objects.create(
+                    username='benchmark_trading_%s_%d' % (mode, i),
+                    total_cash=10 ** 9,
+                )
+                for i in range(options['threads'])
+            ]
+            try:
+                stats = self.run_mode(mode, event, users, options['trades'], options['slippage'])
+            finally:
+                Transaction.objects.filter(event=event).delete()
+                Bet.objects.filter(event=event).delete()
+                event.delete()
+                UserProfile.objects.filter(id__in=[u.id for u in users]).delete()
+
+            self.stdout.write(
+                '%(mode)s: %(trades)d trades in %(seconds).2fs, %(tps).1f trades/s, '
+                '%(mismatches)d price mismatches' % stats
+            )
+
+    def run_mode(self, mode, event, users, trades, slippage=None):
+        """
+        Every thread buys one YES bet at a time, re-reading the price after mismatches like the
+        web client does.
+        """
+        mismatches = []
+
+        def trader(user):
+            mismatched = 0
+            price = Event.objects.get(id=event.id).current_buy_for_price
+            done = 0
+            while done < trades:
+                try:
+                    with transaction.atomic():
+                        _, traded_event, _ = Bet.objects.execute_order(
+                            user, event.id, True, Bet.YES, price,
+                            price_limit=None if slippage is None else price + slippage, mode=mode
+                        )
+                    price = traded_event.current_buy_for_price
+                    done += 1
+                except PriceMismatch as e:
+                    price = e.updated_event.current_buy_for_price
+                    mismatched += 1
+            mismatches.append(mismatched)
+            connection.close()
+
+        threads = [threading.Thread(target=trader, args=(user,)) for user in users]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+
+        total = trades * len(users)
+        return {
+            'mode': mode,
+            'trades': total,
+            'seconds': seconds,
+            'tps': total / seconds,
+            'mismatches': sum(mismatches),
+        }
@@ -0,0 +1,41 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = 'Rolls up snapshots older than their hourly retention (see bladepolska.snapshots) ' \
+           'and shows sizes of snapshot tables before and after.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False, dest='dry_run',
+                            help='Only show sizes of snapshot tables')
+        parser.add_argument('--batch-size', type=int, default=None, dest='batch_size')
+
+    def table_size(self, model):
+        rows = model._default_manager.count()
+        if connection.vendor != 'postgresql':
+            return '%d rows' % rows
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_size_pretty(pg_total_relation_size(%s))', [model._meta.db_table]
+            )
+            return '%d rows, %s' % (rows, cursor.fetchone()[0])
+
+    def handle(self, *args, **options):
+        snapshot_models = [
+            model for model in apps.get_models() if hasattr(model, 'snapshotted_fields')
+        ]
+        for model in snapshot_models:
+            table = model._meta.db_table
+            self.stdout.write('%s: %s' % (table, self.table_size(model)))
+            if options['dry_run']:
+                continue
+            if model.hourly_retention_days is None:
+                self.stdout.write('%s: no retention' % table)
+                continue
+
+            deleted = model.snapshots_model.snapshots.compact(batch_size=options['batch_size'])
+            self.stdout.write('%s: deleted %d snapshots older than %d days, %s' % (
+                table, deleted, model.hourly_retention_days, self.table_size(model)
+            ))
@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Monthly partitions of snapshot tables (see bladepolska.snapshots), PostgreSQL 11 or ' \
+           'newer. --convert converts existing tables of models with partition_by_month, run it ' \
+           'after migrate. Without options creates partitions for next months.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', default=False, dest='convert')
+        parser.add_argument('--months-ahead', type=int, default=2, dest='months_ahead')
+        parser.add_argument('--drop-before', default=None, dest='drop_before',
+                            help='Drop partitions of months ending before YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        drop_before = None
+        if options['drop_before']:
+            try:
+                drop_before = datetime.strptime(options['drop_before'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--drop-before has to be YYYY-MM-DD')
+
+        snapshot_models = [
+            model for model in apps.get_models()
+            if getattr(model, 'partition_by_month', False)
+        ]
+        for model in snapshot_models:
+            table = model._meta.db_table
+            manager = model.snapshots_model.snapshots
+            if options['convert']:
+                try:
+                    created = manager.partition(months_ahead=options['months_ahead'])
+                except ImproperlyConfigured as e:
+                    raise CommandError('%s: %s' % (table, e))
+            else:
+                created = manager.create_partitions(months_ahead=options['months_ahead'])
+            if not manager.is_partitioned():
+                self.stdout.write('%s: not partitioned' % table)
+                continue
+            for name in created:
+                self.stdout.write('%s: created %s' % (table, name))
+            if drop_before:
+                for name in manager.drop_partitions(drop_before):
+                    self.stdout.write('%s: dropped %s' % (table, name))
@@ -0,0 +1,34 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from events.engine import MarketEngine
+from events.models import Event
+
+
+class Command(BaseCommand):
+    help = 'Runs the single writer market engine used in the "engine" trading mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--recover',
+            action='store_true',
+            default=False,
+            dest='recover',
+            help='rebuild quantities of ongoing events from the transaction ledger first'
+        )
+        parser.add_argument('--batch-size', default=50, dest='batch_size', type=int)
+
+    def handle(self, *args, **options):
+        if options['recover']:
+            for event_id in Event.objects.ongoing_only_queryset().values_list('id', flat=True):
+                if MarketEngine.recover_event(event_id):
+                    self.stdout.write('Event #%d recovered from ledger' % event_id)
+
+        engine = MarketEngine(batch_size=options['batch_size'])
+        signal.signal(signal.SIGTERM, lambda signum, frame: engine.stopped.set())
+        try:
+            engine.run()
+        except KeyboardInterrupt:
+            pass
+        engine.stop()
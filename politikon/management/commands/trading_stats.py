@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from events import counters
+
+
+class Command(BaseCommand):
+    help = 'Shows price mismatch and retry counters of trading, see events.counters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', default=False, dest='reset')
+
+    def handle(self, *args, **options):
+        stats = counters.get_counters()
+        for name in counters.COUNTERS:
+            self.stdout.write('%s: %d' % (name, stats[name]))
+
+        exact_orders = stats[counters.ORDERS] - stats[counters.TOLERANT_ORDERS]
+        exact_mismatches = stats[counters.PRICE_MISMATCHES] - \
+            stats[counters.TOLERANT_PRICE_MISMATCHES]
+        if exact_orders:
+            self.stdout.write('exact price mismatch rate: %.1f%%' % (
+                100.0 * exact_mismatches / exact_orders
+            ))
+        if stats[counters.TOLERANT_ORDERS]:
+            self.stdout.write('tolerant price mismatch rate: %.1f%%' % (
+                100.0 * stats[counters.TOLERANT_PRICE_MISMATCHES] / stats[counters.TOLERANT_ORDERS]
+            ))
+
+        if options['reset']:
+            counters.reset_counters()
@@ -106,6 +106,14 @@ CELERYBEAT_SCHEDULE = {
     #     'task': 'canvas.tasks.consume_publish_activities_tasks',
     #     'schedule': timedelta(minutes=5)
     # },
+    'compact_events_snapshots': {
+        'task': 'events.tasks.compact_events_snapshots',
+        'schedule': crontab(hour=3, minute=21)
+    },
+    'compact_accounts_snapshots': {
+        'task': 'accounts.tasks.compact_accounts_snapshots',
+        'schedule': crontab(hour=3, minute=41)
+    },
     'calculate_price_change': {
         'task': 'events.tasks.calculate_price_change',
         'schedule': crontab(hour=0, minute=0)
@@ -117,9 +125,22 @@ CELERYBEAT_SCHEDULE = {
     'update_users_last_transaction': {
         'task': 'accounts.tasks.update_users_last_transaction',
         'schedule': crontab(hour=0, minute=1)
+    },
+    'delete_expired_idempotency_keys': {
+        'task': 'events.tasks.delete_expired_idempotency_keys',
+        'schedule': crontab(minute=51)
+    },
+    'resume_settlements': {
+        'task': 'events.tasks.resume_settlements',
+        'schedule': timedelta(minutes=10)
     }
 }
 
+# How bets are bought and sold, see events.managers.BetManager.execute_order
+TRADING_MODE = os.environ.get('TRADING_MODE', 'locking')
+# Queue between web processes and the market engine used in 'engine' trading mode
+MARKET_ENGINE_QUEUE = 'events.engine.RedisQueue'
+
 CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
 # CONSTANCE_DATABASE_CACHE_BACKEND = 'default' # prior to changes in
 # django-constances
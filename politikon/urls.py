@@ -27,6 +27,14 @@ urlpatterns = patterns(
     url(r'^.well-known/acme-challenge/(?P<acme>\w+)$', acme_challenge, name='acme_challenge'),
     url(r'^event/(?P<event_id>\d+)/transaction/create/$', 'events.views.create_transaction',
         name="create_transaction"),
+    url(r'^event/(?P<event_id>\d+)/quote/$', 'events.views.quote', name="quote"),
+    url(r'^event/(?P<event_id>\d+)/tick-chart/$', 'events.views.tick_chart', name="tick_chart"),
+    url(r'^event/(?P<event_id>\d+)/limit-order/create/$', 'events.views.create_limit_order',
+        name="create_limit_order"),
+    url(r'^limit-order/(?P<limit_order_id>\d+)/cancel/$', 'events.views.cancel_limit_order',
+        name="cancel_limit_order"),
+    url(r'^transactions/create/$', 'events.views.create_transactions',
+        name="create_transactions"),
     url(r'^event/(?P<event_id>\d+)/resolve/$', 'events.views.resolve_event',
         name="resolve_event"),
 )